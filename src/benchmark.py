@@ -0,0 +1,1004 @@
+import argparse
+import asyncio
+import copy
+import itertools
+import json
+import os
+import pickle
+import platform
+import random
+import select
+import socket
+import subprocess
+import sys
+import threading
+import time
+import timeit
+import uuid
+import pygame
+import server_loop
+import simulator
+import snapshot
+from broadcast import SnapshotQueue
+from collections import deque
+from input import INPUT_MESSAGE_SIZE, INPUT_REDUNDANCY, Input, InputDecoder, KeyChanges, encode_input_packet, input_to_keys, keys_to_input
+from loadgen import join_as_bot, random_inputs, receive_message_async
+from room import Room
+from state import Ball, MatchState, Player, State, Team, SCREEN_HEIGHT, SCREEN_WIDTH, PLAYER_AREA_TL_X, PLAYER_AREA_TL_Y, PLAYER_AREA_BR_X, PLAYER_AREA_BR_Y
+
+
+def make_state(player_count, seed=0):
+    rng = random.Random(seed)
+    state = State()
+    for i in range(player_count):
+        team = Team.RED if i % 2 == 0 else Team.BLUE
+        player = Player(
+            f"player{i}",
+            team,
+            rng.uniform(PLAYER_AREA_TL_X + 45, PLAYER_AREA_BR_X - 45),
+            rng.uniform(PLAYER_AREA_TL_Y + 45, PLAYER_AREA_BR_Y - 45),
+            rng.uniform(-1, 1),
+            rng.uniform(-1, 1),
+        )
+        state.players[str(uuid.UUID(int=rng.getrandbits(128)))] = player
+    state.ball.x = rng.uniform(PLAYER_AREA_TL_X + 30, PLAYER_AREA_BR_X - 30)
+    state.ball.y = rng.uniform(PLAYER_AREA_TL_Y + 30, PLAYER_AREA_BR_Y - 30)
+    return state
+
+
+def measure(fun, number):
+    # Best of 5 runs, in microseconds per call
+    return min(timeit.repeat(fun, number=number, repeat=5)) / number * 1e6
+
+
+def bench_snapshot(args):
+    print(f"{'players':>7} | {'format':>14} | {'bytes':>6} | {'encode us':>9} | {'decode us':>9}")
+    for player_count in args.players:
+        state = make_state(player_count)
+        state.tick = 1
+        baseline = snapshot.capture(state)
+        baselines = {baseline.tick: baseline}
+
+        # Next tick with everything at rest, only the match timer changes
+        state.tick = 2
+        state.match_manager.time_remaining -= 1 / 60
+        at_rest = snapshot.capture(state)
+
+        # Next tick with every player and the ball moving
+        for circle in [state.ball, *state.players.values()]:
+            circle.x += circle.vx
+            circle.y += circle.vy
+        moving = snapshot.capture(state)
+
+        pickled = pickle.dumps(state)
+        keyframe = snapshot.encode(moving)
+        delta_at_rest = snapshot.encode(at_rest, baseline)
+        delta_moving = snapshot.encode(moving, baseline)
+
+        rows = [
+            ("pickle", pickled, lambda: pickle.dumps(state), lambda: pickle.loads(pickled)),
+            ("keyframe", keyframe, lambda: snapshot.encode(snapshot.capture(state)), lambda: snapshot.to_state(snapshot.decode(keyframe, baselines))),
+            ("delta at rest", delta_at_rest, lambda: snapshot.encode(snapshot.capture(state), baseline), lambda: snapshot.to_state(snapshot.decode(delta_at_rest, baselines))),
+            ("delta moving", delta_moving, lambda: snapshot.encode(snapshot.capture(state), baseline), lambda: snapshot.to_state(snapshot.decode(delta_moving, baselines))),
+        ]
+        for name, data, encode, decode in rows:
+            encode_us = measure(encode, args.number)
+            decode_us = measure(decode, args.number)
+            print(f"{player_count:>7} | {name:>14} | {len(data):>6} | {encode_us:>9.1f} | {decode_us:>9.1f}")
+
+
+def bench_input(args):
+    # A player pressing random keys for a while, read at the frame rate
+    frame_rate = 60
+    frames = list(itertools.islice(random_inputs(random.Random(0)), int(args.seconds * frame_rate)))
+
+    # Before: an Input with the window size and ack, pickled every frame
+    legacy = Input()
+    legacy.window_width, legacy.window_height, legacy.ack = SCREEN_WIDTH, SCREEN_HEIGHT, 1000
+    pickled = pickle.dumps(legacy)
+    pickle_bytes = (4 + len(pickled)) * len(frames)
+
+    key_changes = KeyChanges()
+    messages = [key_changes.message(input_to_keys(input), 1000, n / frame_rate) for n, input in enumerate(frames)]
+    messages = [message for message in messages if message is not None]
+    message_bytes = INPUT_MESSAGE_SIZE * len(messages)
+
+    decoder = InputDecoder()
+    message = bytearray(messages[0])
+
+    print(f"{'format':>8} | {'messages/s':>10} | {'bytes/s':>7} | {'decode us':>9}")
+    rows = [
+        ("pickle", len(frames), pickle_bytes, lambda: pickle.loads(pickled)),
+        ("message", len(messages), message_bytes, lambda: decoder.decode(message)),
+    ]
+    for name, count, size, decode in rows:
+        decode_us = measure(decode, args.number)
+        print(f"{name:>8} | {count / args.seconds:>10.1f} | {size / args.seconds:>7.0f} | {decode_us:>9.2f}")
+
+
+def hotpath_results(player_count, number, clients):
+    # Time per call in microseconds and sizes in bytes, by name
+    from client_loop import scale_and_offset_state
+    from server import frame
+
+    pygame.init()
+    rng = random.Random(player_count)
+    state = make_state(player_count)
+    state.match_manager.start_match()
+    inputs = {player_id: Input(rng.random() < 0.5, rng.random() < 0.5, rng.random() < 0.5, rng.random() < 0.5, rng.random() < 0.1) for player_id in state.players}
+    results = {}
+
+    # One tick, phase by phase, in the order server_loop.simulate runs them
+    def apply_inputs():
+        for player_id, player in state.players.items():
+            server_loop.apply_input(player, inputs[player_id])
+
+    def update_positions():
+        for circle in server_loop.moving_circles(state):
+            server_loop.update_position(circle)
+
+    phases = [
+        ("input", apply_inputs),
+        ("integration", update_positions),
+        ("collisions", lambda: server_loop.handle_collisions(state)),
+        ("kicks", lambda: server_loop.handle_kicks(state)),
+        ("goal", lambda: server_loop.check_goal(state)),
+        ("snapshot", lambda: snapshot.capture(state)),
+        ("total", lambda: server_loop.simulate(state, inputs, 1 / 60)),
+    ]
+    for name, phase in phases:
+        results[f"tick.{name}.us"] = measure(phase, number)
+
+    # Serialization, on the server and on the client
+    state.tick = 1
+    baseline = snapshot.capture(state)
+    server_loop.simulate(state, inputs, 1 / 60)
+    moving = snapshot.capture(state)
+    keyframe = snapshot.encode(moving)
+    delta = snapshot.encode(moving, baseline)
+    baselines = {baseline.tick: baseline}
+    results["serialize.keyframe.bytes"] = len(keyframe)
+    results["serialize.delta.bytes"] = len(delta)
+    results["serialize.keyframe_encode.us"] = measure(lambda: snapshot.encode(moving), number)
+    results["serialize.delta_encode.us"] = measure(lambda: snapshot.encode(moving, baseline), number)
+    results["serialize.delta_decode.us"] = measure(lambda: snapshot.decode(delta, baselines), number)
+    results["client.to_state.us"] = measure(lambda: snapshot.to_state(moving), number)
+    client_state = snapshot.to_state(moving)
+    results["client.scale_and_offset.us"] = measure(lambda: scale_and_offset_state(client_state, 1920, 1080), number)
+
+    # Sending one tick to a client: choosing its baseline, encoding against
+    # it and writing it to the client's socket, like GameTCPHandler
+    snapshots = []
+    for _ in range(number):
+        server_loop.simulate(state, inputs, 1 / 60)
+        snapshots.append(snapshot.capture(state))
+
+    pairs = [socket.socketpair() for _ in range(clients)]
+    readers = [reader for _, reader in pairs]
+    running = True
+
+    def drain():
+        while running:
+            for reader in select.select(readers, [], [], 0.1)[0]:
+                reader.recv(1 << 16)
+
+    drain_thread = threading.Thread(target=drain, daemon=True)
+    drain_thread.start()
+    encoders = [snapshot.DeltaEncoder() for _ in range(clients)]
+    start = time.perf_counter()
+    previous = None
+    for last_snapshot in snapshots:
+        for encoder, (writer, _) in zip(encoders, pairs):
+            if previous is not None:
+                encoder.ack(previous.tick)
+            writer.sendall(frame(encoder.encode(last_snapshot)))
+        previous = last_snapshot
+    results["send.per_client.us"] = (time.perf_counter() - start) / (len(snapshots) * clients) * 1e6
+
+    running = False
+    drain_thread.join()
+    for writer, reader in pairs:
+        writer.close()
+        reader.close()
+
+    return results
+
+
+# Defaults of the hot path benchmark, shared by the command and the tests so
+# that their results can be compared with the same baselines
+HOTPATH_PLAYERS = [2, 8, 32]
+HOTPATH_NUMBER = 500
+HOTPATH_CLIENTS = 8
+HOTPATH_THRESHOLD = 0.2
+
+
+def run_hotpath(players=HOTPATH_PLAYERS, number=HOTPATH_NUMBER, clients=HOTPATH_CLIENTS):
+    # Every result, named after its player count
+    results = {}
+    for player_count in players:
+        for name, value in hotpath_results(player_count, number, clients).items():
+            results[f"{player_count}p.{name}"] = value
+    return results
+
+
+def save_hotpath(results, path):
+    with open(path, "w") as f:
+        json.dump({"python": sys.version.split()[0], "machine": platform.machine(), "results": results}, f, indent=2)
+
+
+def load_hotpath(path):
+    with open(path) as f:
+        return json.load(f)["results"]
+
+
+def hotpath_changes(results, baseline, threshold=HOTPATH_THRESHOLD):
+    # (name, baseline, current, change, regressed) of every result, the
+    # baseline and change are None if the baseline doesn't have it. Every
+    # result is a time or a size, lower is better.
+    changes = []
+    for name, value in results.items():
+        old = baseline.get(name)
+        if old is None:
+            changes.append((name, None, value, None, False))
+            continue
+        change = value / old - 1 if old else 0
+        changes.append((name, old, value, change, change > threshold))
+    return changes
+
+
+def compare_hotpath(results, baseline, threshold):
+    # Prints the comparison, returns the number of regressions
+    print(f"{'benchmark':<40} | {'baseline':>10} | {'current':>10} | {'change':>7}")
+    changes = hotpath_changes(results, baseline, threshold)
+    for name, old, value, change, regressed in changes:
+        if old is None:
+            print(f"{name:<40} | {'-':>10} | {value:>10.1f} |")
+        else:
+            print(f"{name:<40} | {old:>10.1f} | {value:>10.1f} | {change:>+7.0%}{' slower' if regressed else ''}")
+    return sum(regressed for *_, regressed in changes)
+
+
+def bench_hotpath(args):
+    results = run_hotpath(args.players, args.number, args.clients)
+
+    if args.output:
+        save_hotpath(results, args.output)
+
+    if args.baseline:
+        regressions = compare_hotpath(results, load_hotpath(args.baseline), args.threshold)
+        if regressions:
+            print(f"{regressions} benchmarks more than {args.threshold:.0%} worse than the baseline")
+            sys.exit(1)
+    else:
+        for name, value in results.items():
+            print(f"{name:<40} | {value:>10.1f}")
+
+
+def bench_render(args):
+    # Headless, frames are drawn to memory but everything else is the same
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    import client_loop
+
+    pygame.init()
+    screen = pygame.display.set_mode((args.width, args.height))
+    name_font = pygame.font.SysFont("arial", 30)
+
+    print(f"{'players':>7} | {'first ms':>8} | {'p50 ms':>6} | {'p90 ms':>6} | {'p99 ms':>6} | {'fps':>6}")
+    for player_count in args.players:
+        state = make_state(player_count)
+        state.match_manager.start_match()
+        rng = random.Random(player_count)
+        inputs = {player_id: Input(rng.random() < 0.5, rng.random() < 0.5, rng.random() < 0.5, rng.random() < 0.5) for player_id in state.players}
+
+        # The states of every frame are made up front, render changes them
+        frames = []
+        for i in range(args.frames + 1):
+            server_loop.simulate(state, inputs, 1 / 60)
+            for player in state.players.values():
+                player.kick = i % 20 == 0
+            frames.append(snapshot.to_state(snapshot.capture(state)))
+        player_id = next(iter(state.players))
+
+        times = []
+        for frame_state in frames:
+            start = time.perf_counter()
+            client_loop.render(frame_state, screen, name_font, player_id)
+            times.append(time.perf_counter() - start)
+
+        # The first frame may fill caches
+        first = times.pop(0)
+        times.sort()
+        percentile = lambda p: times[min(len(times) - 1, int(p / 100 * len(times)))] * 1000
+        print(f"{player_count:>7} | {first * 1000:>8.2f} | {percentile(50):>6.2f} | {percentile(90):>6.2f} | {percentile(99):>6.2f} | {len(times) / sum(times):>6.0f}")
+
+
+def bench_rooms(args):
+    pygame.init()
+    rng = random.Random(0)
+    # Random key presses, generated up front so only the tick is timed
+    random_inputs = itertools.cycle([
+        Input(rng.random() < 0.5, rng.random() < 0.5, rng.random() < 0.5, rng.random() < 0.5, rng.random() < 0.1)
+        for _ in range(1024)
+    ])
+    print(f"{'players':>7} | {'us/room tick':>12} | {'rooms per core at 60 Hz':>23}")
+    for player_count in args.players:
+        rooms = [make_room(player_count, seed=i) for i in range(args.rooms)]
+
+        def tick_all():
+            for room in rooms:
+                for player_id in room.state.players:
+                    room.inputs[player_id] = next(random_inputs)
+                server_loop.tick(room, 1 / 60)
+
+        room_us = measure(tick_all, args.number) / len(rooms)
+        print(f"{player_count:>7} | {room_us:>12.1f} | {int(1e6 / 60 / room_us):>23}")
+
+
+BROADPHASE_MIN_CIRCLES = server_loop.BROADPHASE_MIN_CIRCLES
+
+
+def make_room(player_count, seed=0):
+    room = Room(f"room-{seed}")
+    room.state = make_state(player_count, seed)
+    room.state.match_manager.state = MatchState.PLAYING
+    room.state.match_manager.time_remaining = float("inf")
+    return room
+
+
+def simulate_match(tick_rate, seconds, seed=0):
+    # The same random key presses, held for 1/60 s each at any tick rate
+    rng = random.Random(seed)
+    room = make_room(8, seed)
+    ticks_per_input = tick_rate // 60
+    for _ in range(seconds * 60):
+        for player_id in room.state.players:
+            room.inputs[player_id] = Input(rng.random() < 0.5, rng.random() < 0.5, rng.random() < 0.5, rng.random() < 0.5, rng.random() < 0.1)
+        server_loop.tick(room, 1 / tick_rate, ticks_per_input)
+    return room.state
+
+
+def bench_collisions(args):
+    pygame.init()
+    print(f"{'players':>7} | {'all pairs us':>12} | {'broadphase us':>13} | {'speedup':>7} | {'same result':>11}")
+    for player_count in args.players:
+        times = []
+        results = []
+        for min_circles in [float("inf"), 0]:
+            server_loop.BROADPHASE_MIN_CIRCLES = min_circles
+            state = make_state(player_count)
+            times.append(measure(lambda: server_loop.handle_collisions(state), args.number))
+
+            # A few seconds of play from the same start, to check the
+            # broadphase doesn't change the outcome
+            room = make_room(player_count)
+            rng = random.Random(0)
+            for _ in range(args.ticks):
+                for player_id in room.state.players:
+                    room.inputs[player_id] = Input(rng.random() < 0.5, rng.random() < 0.5, rng.random() < 0.5, rng.random() < 0.5, rng.random() < 0.1)
+                server_loop.tick(room, 1 / 60)
+            results.append([(circle.x, circle.y, circle.vx, circle.vy) for circle in server_loop.moving_circles(room.state)])
+
+        server_loop.BROADPHASE_MIN_CIRCLES = BROADPHASE_MIN_CIRCLES
+        same = "yes" if results[0] == results[1] else "no"
+        print(f"{player_count:>7} | {times[0]:>12.1f} | {times[1]:>13.1f} | {times[0] / times[1]:>7.2f} | {same:>11}")
+
+
+def physics_difference(body_count, ticks, scale=1):
+    # Largest position difference between the two backends playing the same
+    # match side by side, every player moving and a third of them kicking
+    import physics_numpy
+
+    python_state = make_state(body_count - 1)
+    for i, player in enumerate(python_state.players.values()):
+        player.kick = i % 3 == 0
+    numpy_state = copy.deepcopy(python_state)
+
+    difference = 0
+    for _ in range(ticks):
+        server_loop.move(python_state, scale)
+        physics_numpy.move(numpy_state, scale)
+        for a, b in zip(server_loop.moving_circles(python_state), server_loop.moving_circles(numpy_state)):
+            difference = max(difference, abs(a.x - b.x), abs(a.y - b.y))
+    return difference
+
+
+def bench_physics(args):
+    import physics_numpy
+
+    print(f"{'bodies':>6} | {'python us':>9} | {'numpy us':>8} | {'speedup':>7} | {'max difference px':>17}")
+    for body_count in args.bodies:
+        # Every body moving, as in the middle of a match
+        state = make_state(body_count - 1)
+        python_us = measure(lambda: server_loop.move(state, 1), args.number)
+        state = make_state(body_count - 1)
+        numpy_us = measure(lambda: physics_numpy.move(state, 1), args.number)
+
+        difference = physics_difference(body_count, args.ticks)
+        print(f"{body_count:>6} | {python_us:>9.1f} | {numpy_us:>8.1f} | {python_us / numpy_us:>7.2f} | {difference:>17.3g}")
+
+
+class DictEntity:
+    # The same fields kept in a __dict__, as the entity classes did before
+    # they had __slots__
+    def __init__(self, entity):
+        for cls in type(entity).__mro__:
+            for name in getattr(cls, "__slots__", ()):
+                setattr(self, name, getattr(entity, name))
+
+
+def entity_size(entity):
+    size = sys.getsizeof(entity)
+    if hasattr(entity, "__dict__"):
+        size += sys.getsizeof(entity.__dict__)
+    return size
+
+
+def read_motion(entity):
+    return entity.x + entity.y + entity.vx + entity.vy
+
+
+def write_motion(entity):
+    entity.x += entity.vx
+    entity.y += entity.vy
+
+
+def bench_entities(args):
+    entities = [
+        ("Player", Player("player", Team.RED, 100, 200, 0.5, -0.5)),
+        ("Ball", Ball(300, 400, 1, 1)),
+    ]
+    print(f"{'entity':>6} | {'layout':>6} | {'bytes':>5} | {'read ns':>7} | {'write ns':>8} | {'copy us':>7} | {'pickle bytes':>12} | {'pickle us':>9}")
+    for name, slotted in entities:
+        for layout, entity in [("dict", DictEntity(slotted)), ("slots", slotted)]:
+            read_ns = measure(lambda: read_motion(entity), args.number) * 1000
+            write_ns = measure(lambda: write_motion(entity), args.number) * 1000
+            copy_us = measure(lambda: copy.deepcopy(entity), args.number // 10)
+            pickle_us = measure(lambda: pickle.dumps(entity), args.number // 10)
+            print(f"{name:>6} | {layout:>6} | {entity_size(entity):>5} | {read_ns:>7.1f} | {write_ns:>8.1f} | {copy_us:>7.2f} | {len(pickle.dumps(entity)):>12} | {pickle_us:>9.2f}")
+
+
+class TimedLock:
+    # Records how long every holder kept the lock
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.holds = []
+
+    def __enter__(self):
+        self.lock.acquire()
+        self.acquired = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.holds.append(time.perf_counter() - self.acquired)
+        self.lock.release()
+
+
+def send_snapshots(queue):
+    # A connection's sender thread, without the socket
+    delta_encoder = snapshot.DeltaEncoder()
+    while (last_snapshot := queue.get()) is not None:
+        delta_encoder.encode(last_snapshot)
+        delta_encoder.ack(last_snapshot.tick)
+
+
+def bench_lock(args):
+    pygame.init()
+    print(f"{'players':>7} | {'hold p50 us':>11} | {'hold p99 us':>11} | {'hold max us':>11}")
+    for player_count in args.players:
+        room = make_room(player_count)
+        room.state_lock = TimedLock()
+
+        queues = [SnapshotQueue() for _ in range(player_count)]
+        for queue in queues:
+            room.broadcaster.subscribe(queue)
+            threading.Thread(target=send_snapshots, args=(queue,), daemon=True).start()
+
+        rng = random.Random(0)
+        for _ in range(args.ticks):
+            for player_id in room.state.players:
+                room.inputs[player_id] = Input(rng.random() < 0.5, rng.random() < 0.5, rng.random() < 0.5, rng.random() < 0.5, rng.random() < 0.1)
+            server_loop.tick(room, 1 / 60)
+            time.sleep(1 / 600)
+
+        for queue in queues:
+            queue.close()
+
+        holds = sorted(room.state_lock.holds)
+        percentile = lambda p: holds[min(len(holds) - 1, int(p / 100 * len(holds)))] * 1e6
+        print(f"{player_count:>7} | {percentile(50):>11.1f} | {percentile(99):>11.1f} | {holds[-1] * 1e6:>11.1f}")
+
+
+def bench_simulator(args):
+    players = {}
+    for i in range(args.team_size):
+        players[f"red{i}"] = (Team.RED, simulator.chase_ball)
+        players[f"blue{i}"] = (Team.BLUE, simulator.chase_ball)
+    matches = [{"players": players, "match_duration": args.match_duration} for _ in range(args.matches)]
+
+    start = time.perf_counter()
+    results = simulator.run_batch(matches, args.processes)
+    elapsed = time.perf_counter() - start
+
+    ticks = sum(result.ticks for result in results)
+    winners = [result.winner for result in results]
+    print(f"{len(results)} matches of {args.team_size}v{args.team_size}, {args.match_duration} s each, in {elapsed:.1f} s")
+    print(f"{len(results) / elapsed * 60:.0f} matches per minute, {ticks / elapsed:.0f} ticks per second")
+    print(f"Red won {winners.count(Team.RED)}, blue won {winners.count(Team.BLUE)}, {winners.count(None)} draws")
+
+
+def bench_vector_env(args):
+    import numpy as np
+    from vector_env import VectorEnv
+
+    rng = np.random.default_rng(0)
+    players = 2 * args.team_size
+    print(f"{'matches':>7} | {'states steps/s':>14} | {'batch steps/s':>13} | {'speedup':>7}")
+    for env_count in args.envs:
+        actions = rng.integers(0, 32, size=(args.ticks, env_count, players), dtype=np.uint8)
+
+        # One State per match, each stepped by server_loop.simulate
+        states = []
+        for _ in range(env_count):
+            state = State()
+            for i in range(players):
+                state.players[f"player{i}"] = Player(f"player{i}", Team.RED if i < args.team_size else Team.BLUE)
+            server_loop.reset_ball(state)
+            server_loop.reset_players(state)
+            state.match_manager.start_match()
+            states.append(state)
+        inputs = [[{f"player{i}": keys_to_input(keys) for i, keys in enumerate(row.tolist())} for row in tick] for tick in actions[:args.states_ticks]]
+        start = time.perf_counter()
+        for tick in inputs:
+            for state, state_inputs in zip(states, tick):
+                server_loop.simulate(state, state_inputs, 1 / server_loop.TICK_RATE)
+                server_loop.clear_kicks(state)
+        states_rate = env_count * len(inputs) / (time.perf_counter() - start)
+
+        env = VectorEnv(env_count, args.team_size)
+        start = time.perf_counter()
+        for tick in actions:
+            env.step(tick)
+        batch_rate = env_count * args.ticks / (time.perf_counter() - start)
+
+        print(f"{env_count:>7} | {states_rate:>14.0f} | {batch_rate:>13.0f} | {batch_rate / states_rate:>7.1f}")
+
+
+class LoadedRooms:
+    # Rooms plus a fixed amount of extra work per step, standing in for a
+    # busy machine
+    def __init__(self, rooms, load):
+        self.rooms = rooms
+        self.load = load
+
+    def all(self):
+        time.sleep(self.load)
+        return self.rooms
+
+
+def bench_timestep(args):
+    pygame.init()
+
+    # Same inputs, same result: compare the full state of two runs
+    runs = [simulate_match(server_loop.TICK_RATE, args.seconds) for _ in range(2)]
+    circles = [[(circle.x, circle.y, circle.vx, circle.vy) for circle in server_loop.moving_circles(state)] for state in runs]
+    print(f"Deterministic over {args.seconds} s: {'yes' if circles[0] == circles[1] else 'NO'}")
+
+    # Game speed must not depend on the tick rate
+    for tick_rate in [60, 120, 240]:
+        player = next(iter(simulate_match(tick_rate, args.seconds).players.values()))
+        print(f"  {tick_rate:>3} Hz: first player at ({player.x:.1f}, {player.y:.1f})")
+
+    print(f"{'load ms':>7} | {'game s/s':>8} | {'snapshots/s':>11} | {'dropped ticks':>13}")
+    for load in args.load:
+        rooms = LoadedRooms([make_room(8, seed) for seed in range(4)], load / 1000)
+        timestep = server_loop.Timestep(args.tick_rate)
+        snapshots = [0]
+        rooms.rooms[0].broadcaster.add_listener(lambda _: snapshots.__setitem__(0, snapshots[0] + 1))
+
+        start = time.perf_counter()
+        while time.perf_counter() - start < args.duration:
+            server_loop.step(rooms, timestep)
+        elapsed = time.perf_counter() - start
+
+        game_seconds = rooms.rooms[0].state.tick / args.tick_rate
+        print(f"{load:>7} | {game_seconds / elapsed:>8.2f} | {snapshots[0] / elapsed:>11.1f} | {timestep.dropped:>13}")
+
+
+def start_server(port, *server_args):
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(os.path.dirname(__file__), "server.py"), "-p", str(port), *server_args],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        env={**os.environ, "SDL_VIDEODRIVER": "dummy"},
+    )
+    for _ in range(100):
+        if server.poll() is not None:
+            break
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return server
+        except ConnectionRefusedError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("Server did not start")
+
+
+def cpu_seconds(pid):
+    # utime + stime of a process, Linux only
+    with open(f"/proc/{pid}/stat") as stat:
+        fields = stat.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def tree_cpu_seconds(pid):
+    # The process and its children, like the workers of a sharded server
+    with open(f"/proc/{pid}/task/{pid}/children") as children:
+        return cpu_seconds(pid) + sum(tree_cpu_seconds(int(child)) for child in children.read().split())
+
+
+async def run_bot(port, index, stop, stats):
+    reader, writer, _, _ = await join_as_bot(port, index)
+
+    decoder = snapshot.DeltaDecoder()
+    key_changes = KeyChanges()
+    keys = input_to_keys(Input(right=index % 3 == 0))
+    while not stop.is_set():
+        message = key_changes.message(keys, decoder.last_tick, time.perf_counter())
+        if message is not None:
+            writer.write(message)
+            await writer.drain()
+        decoder.decode(await receive_message_async(reader))
+        stats["snapshots"] += 1
+        stats["ticks"].add(decoder.last_tick)
+
+    writer.close()
+
+
+async def measure_connections(port, client_count, warmup, duration):
+    stop = asyncio.Event()
+    stats = {"snapshots": 0, "ticks": set()}
+    bots = [asyncio.create_task(run_bot(port, i, stop, stats)) for i in range(client_count)]
+
+    await asyncio.sleep(warmup)
+    stats["snapshots"] = 0
+    stats["ticks"].clear()
+    await asyncio.sleep(duration)
+    snapshots, ticks = stats["snapshots"], len(stats["ticks"])
+
+    stop.set()
+    await asyncio.gather(*bots, return_exceptions=True)
+    return snapshots, ticks
+
+
+def bench_connections(args):
+    print(f"{'mode':>8} | {'clients':>7} | {'tick Hz':>7} | {'snapshots/s/client':>18} | {'server cpu %':>12}")
+    for mode in args.modes:
+        for client_count in args.clients:
+            server = start_server(args.port, *(["--asyncio"] if mode == "asyncio" else []))
+            try:
+                cpu_start = cpu_seconds(server.pid)
+                snapshots, ticks = asyncio.run(measure_connections(args.port, client_count, args.warmup, args.duration))
+                cpu = (cpu_seconds(server.pid) - cpu_start) / (args.warmup + args.duration) * 100
+            finally:
+                server.kill()
+                server.wait()
+            print(f"{mode:>8} | {client_count:>7} | {ticks / args.duration:>7.1f} | {snapshots / args.duration / client_count:>18.1f} | {cpu:>12.1f}")
+
+
+async def run_room_bot(port, index, room, stop, ticks):
+    reader, writer, _, _ = await join_as_bot(port, index, room)
+
+    # Only the header is read, decoding every snapshot of every room would
+    # make the benchmark itself the bottleneck
+    key_changes = KeyChanges()
+    keys = input_to_keys(Input(right=index % 3 == 0, kick=index % 5 == 0))
+    while not stop.is_set():
+        data = await receive_message_async(reader)
+        _, tick, _, _ = snapshot.HEADER.unpack_from(data)
+        message = key_changes.message(keys, tick, time.perf_counter())
+        if message is not None:
+            writer.write(message)
+            await writer.drain()
+        ticks.add(tick)
+
+    writer.close()
+
+
+async def measure_shards(server, port, room_count, players, warmup, duration):
+    stop = asyncio.Event()
+    ticks = [set() for _ in range(room_count)]
+    bots = []
+    for room in range(room_count):
+        for player in range(players):
+            index = room * players + player
+            bots.append(asyncio.create_task(run_room_bot(port, index, f"bench-{room}", stop, ticks[room])))
+            # Don't overflow the listen backlog
+            await asyncio.sleep(0.005)
+
+    # Physics only run while a match is being played
+    for room in range(room_count):
+        server.stdin.write(f"start_match bench-{room}\n".encode())
+    server.stdin.flush()
+
+    await asyncio.sleep(warmup)
+    for room_ticks in ticks:
+        room_ticks.clear()
+    await asyncio.sleep(duration)
+    tick_rates = [len(room_ticks) / duration for room_ticks in ticks]
+
+    stop.set()
+    await asyncio.gather(*bots, return_exceptions=True)
+    return tick_rates
+
+
+def bench_shards(args):
+    print(f"{'workers':>7} | {'rooms':>5} | {'mean tick Hz':>12} | {'min tick Hz':>11} | {'server cpu %':>12}")
+    for workers in args.workers:
+        server = start_server(args.port, "--workers", str(workers))
+        try:
+            cpu_start = tree_cpu_seconds(server.pid)
+            tick_rates = asyncio.run(measure_shards(server, args.port, args.rooms, args.players, args.warmup, args.duration))
+            cpu = (tree_cpu_seconds(server.pid) - cpu_start) / (args.warmup + args.duration) * 100
+        finally:
+            server.kill()
+            server.wait()
+        print(f"{workers:>7} | {args.rooms:>5} | {sum(tick_rates) / len(tick_rates):>12.1f} | {min(tick_rates):>11.1f} | {cpu:>12.1f}")
+
+
+# Server to client link of the transport benchmark: fixed latency and random
+# loss. UDP datagrams are really dropped. TCP loss is only modelled, the proxy
+# drops nothing: a lost segment holds back everything sent after it until it
+# is retransmitted, so a snapshot picked as lost is delivered one minimum
+# retransmission timeout late, along with the ones behind it. Real TCP may
+# retransmit sooner, after duplicate acks, or later, backing off on repeated
+# losses, so the TCP rows are an estimate, not a measurement.
+TCP_MIN_RTO = 0.2
+
+
+async def proxy_tcp(server_port, proxy_port, latency, loss, entered, rng):
+    event_loop = asyncio.get_running_loop()
+
+    async def pipe(reader, writer):
+        while data := await reader.read(65536):
+            writer.write(data)
+
+    async def handle(client_reader, client_writer):
+        server_reader, server_writer = await asyncio.open_connection("127.0.0.1", server_port)
+        upstream = asyncio.create_task(pipe(client_reader, server_writer))
+        release = 0
+        try:
+            while True:
+                header = await server_reader.readexactly(4)
+                data = await server_reader.readexactly(int.from_bytes(header, "big"))
+                now = event_loop.time()
+                if data[0] == snapshot.SNAPSHOT_VERSION:
+                    entered.setdefault(snapshot.HEADER.unpack_from(data)[1], now)
+
+                deliver = now + latency + (TCP_MIN_RTO if rng.random() < loss else 0)
+                release = max(release + 1e-6, deliver)
+                event_loop.call_at(release, client_writer.write, header + data)
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            upstream.cancel()
+            server_writer.close()
+            client_writer.close()
+
+    return await asyncio.start_server(handle, "127.0.0.1", proxy_port)
+
+
+class UDPProxy(asyncio.DatagramProtocol):
+    def __init__(self, server_port, latency, loss, entered, rng):
+        self.server_address = ("127.0.0.1", server_port)
+        self.latency = latency
+        self.loss = loss
+        self.entered = entered
+        self.rng = rng
+        self.client_address = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        if address != self.server_address:
+            self.client_address = address
+            self.transport.sendto(data, self.server_address)
+            return
+
+        self.entered.setdefault(snapshot.HEADER.unpack_from(data)[1], asyncio.get_running_loop().time())
+        if self.rng.random() >= self.loss:
+            asyncio.get_running_loop().call_later(self.latency, self.transport.sendto, data, self.client_address)
+
+
+class UDPBot(asyncio.DatagramProtocol):
+    def __init__(self, on_snapshot):
+        self.on_snapshot = on_snapshot
+
+    def datagram_received(self, data, address):
+        self.on_snapshot(data)
+
+
+async def measure_transport(transport, server_port, proxy_port, latency, loss, duration, bot_index):
+    event_loop = asyncio.get_running_loop()
+    rng = random.Random(0)
+    entered = {}
+    decoder = snapshot.DeltaDecoder()
+
+    def on_snapshot(data):
+        if snapshot.HEADER.unpack_from(data)[1] > decoder.last_tick:
+            try:
+                decoder.decode(data)
+            except KeyError:
+                pass
+
+    proxy = await proxy_tcp(server_port, proxy_port, latency, loss, entered, rng)
+    reader, writer, player_id, udp_token = await join_as_bot(proxy_port, bot_index)
+
+    if transport == "udp":
+        udp_proxy, _ = await event_loop.create_datagram_endpoint(lambda: UDPProxy(server_port, latency, loss, entered, rng), local_addr=("127.0.0.1", proxy_port))
+        udp, _ = await event_loop.create_datagram_endpoint(lambda: UDPBot(on_snapshot), remote_addr=("127.0.0.1", proxy_port))
+        keys_history = deque(maxlen=INPUT_REDUNDANCY)
+
+        async def send_inputs():
+            for seq in itertools.count(1):
+                keys_history.appendleft(0)
+                udp.sendto(encode_input_packet(snapshot.id_to_bytes(player_id), udp_token, seq, decoder.last_tick, keys_history))
+                await asyncio.sleep(1 / 60)
+    else:
+        async def receive_snapshots():
+            while True:
+                on_snapshot(await receive_message_async(reader))
+
+        asyncio.create_task(receive_snapshots())
+
+        async def send_inputs():
+            key_changes = KeyChanges()
+            while True:
+                message = key_changes.message(0, decoder.last_tick, event_loop.time())
+                if message is not None:
+                    writer.write(message)
+                    await writer.drain()
+                await asyncio.sleep(1 / 60)
+
+    sender = asyncio.create_task(send_inputs())
+
+    # Sample how old the newest snapshot the client has is, at 60 Hz
+    ages = []
+    end = event_loop.time() + duration
+    while event_loop.time() < end:
+        await asyncio.sleep(1 / 60)
+        if decoder.last_tick in entered:
+            ages.append(event_loop.time() - entered[decoder.last_tick])
+
+    sender.cancel()
+    writer.close()
+    proxy.close()
+    if transport == "udp":
+        udp.close()
+        udp_proxy.close()
+    return sorted(ages)
+
+
+def bench_transport(args):
+    server = start_server(args.port, "--udp")
+    try:
+        print(f"TCP loss is modelled, a lost snapshot is delayed by {TCP_MIN_RTO * 1000:.0f} ms with everything behind it. UDP loss is real.")
+        print(f"{'transport':>9} | {'loss %':>6} | {'p50 ms':>6} | {'p95 ms':>6} | {'p99 ms':>6} | {'max ms':>6}")
+        for bot_index, (loss, transport) in enumerate(itertools.product(args.loss, ["tcp", "udp"])):
+            ages = asyncio.run(measure_transport(transport, args.port, args.port + 1, args.latency / 1000, loss / 100, args.duration, bot_index))
+            percentile = lambda p: ages[min(len(ages) - 1, int(p / 100 * len(ages)))] * 1000
+            label = "tcp model" if transport == "tcp" else transport
+            print(f"{label:>9} | {loss:>6} | {percentile(50):>6.1f} | {percentile(95):>6.1f} | {percentile(99):>6.1f} | {ages[-1] * 1000:>6.1f}")
+    finally:
+        server.kill()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DojoBall benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    snapshot_parser = subparsers.add_parser("snapshot", help="Snapshot size and encode/decode time, pickle vs keyframes and deltas.")
+    snapshot_parser.add_argument("--players", type=int, nargs="+", default=[2, 8, 20, 60])
+    snapshot_parser.add_argument("-n", "--number", type=int, default=1000)
+    snapshot_parser.set_defaults(run=bench_snapshot)
+
+    input_parser = subparsers.add_parser("input", help="Input bytes per second and decode time, pickled every frame vs key messages sent on change.")
+    input_parser.add_argument("--seconds", type=float, default=60, help="Seconds of random keys sent.")
+    input_parser.add_argument("-n", "--number", type=int, default=100000)
+    input_parser.set_defaults(run=bench_input)
+
+    hotpath_parser = subparsers.add_parser("hotpath", help="Server hot path: time of every phase of a tick, snapshot size and serialization, and per client send cost.")
+    hotpath_parser.add_argument("--players", type=int, nargs="+", default=HOTPATH_PLAYERS)
+    hotpath_parser.add_argument("-n", "--number", type=int, default=HOTPATH_NUMBER)
+    hotpath_parser.add_argument("--clients", type=int, default=HOTPATH_CLIENTS, help="Clients the send cost is measured with.")
+    hotpath_parser.add_argument("-o", "--output", help="Write the results to this JSON file.")
+    hotpath_parser.add_argument("-b", "--baseline", help="Compare with the results in this JSON file, exit with an error if any is worse.")
+    hotpath_parser.add_argument("--threshold", type=float, default=HOTPATH_THRESHOLD, help=f"How much worse than the baseline counts as a regression (default: {HOTPATH_THRESHOLD}, {HOTPATH_THRESHOLD * 100:.0f}%%).")
+    hotpath_parser.set_defaults(run=bench_hotpath)
+
+    render_parser = subparsers.add_parser("render", help="Client frame time, drawing a match to a headless window.")
+    render_parser.add_argument("--players", type=int, nargs="+", default=[2, 20])
+    render_parser.add_argument("--frames", type=int, default=600)
+    render_parser.add_argument("--width", type=int, default=SCREEN_WIDTH)
+    render_parser.add_argument("--height", type=int, default=SCREEN_HEIGHT)
+    render_parser.set_defaults(run=bench_render)
+
+    connections_parser = subparsers.add_parser("connections", help="Server tick rate and CPU as the number of connected clients grows, threaded vs asyncio.")
+    connections_parser.add_argument("--clients", type=int, nargs="+", default=[1, 10, 30, 60])
+    connections_parser.add_argument("--modes", nargs="+", choices=["threaded", "asyncio"], default=["threaded", "asyncio"])
+    connections_parser.add_argument("-p", "--port", type=int, default=12399)
+    connections_parser.add_argument("--warmup", type=float, default=2)
+    connections_parser.add_argument("--duration", type=float, default=5)
+    connections_parser.set_defaults(run=bench_connections)
+
+    transport_parser = subparsers.add_parser("transport", help="Snapshot age through a lossy link, TCP with modelled loss vs UDP.")
+    transport_parser.add_argument("--loss", type=float, nargs="+", default=[0, 2, 5], help="Packet loss, in percent.")
+    transport_parser.add_argument("--latency", type=float, default=20, help="One way latency, in milliseconds.")
+    transport_parser.add_argument("-p", "--port", type=int, default=12399)
+    transport_parser.add_argument("--duration", type=float, default=10)
+    transport_parser.set_defaults(run=bench_transport)
+
+    rooms_parser = subparsers.add_parser("rooms", help="Time to tick every room once, and how many rooms one core can tick at 60 Hz.")
+    rooms_parser.add_argument("--players", type=int, nargs="+", default=[2, 4, 8])
+    rooms_parser.add_argument("--rooms", type=int, default=16, help="Rooms ticked together in each measurement.")
+    rooms_parser.add_argument("-n", "--number", type=int, default=20)
+    rooms_parser.set_defaults(run=bench_rooms)
+
+    collisions_parser = subparsers.add_parser("collisions", help="Collision detection time, all pairs vs sweep and prune.")
+    collisions_parser.add_argument("--players", type=int, nargs="+", default=[2, 4, 8, 12, 20, 30, 60])
+    collisions_parser.add_argument("-n", "--number", type=int, default=200)
+    collisions_parser.add_argument("--ticks", type=int, default=600, help="Ticks played to compare outcomes.")
+    collisions_parser.set_defaults(run=bench_collisions)
+
+    simulator_parser = subparsers.add_parser("simulator", help="Headless matches of ball chasing bots, as fast as they run.")
+    simulator_parser.add_argument("--matches", type=int, default=200)
+    simulator_parser.add_argument("--team-size", type=int, default=2)
+    simulator_parser.add_argument("--match-duration", type=int, default=30, help="In seconds of game time.")
+    simulator_parser.add_argument("--processes", type=int, default=None, help="Default: one per core.")
+    simulator_parser.set_defaults(run=bench_simulator)
+
+    vector_env_parser = subparsers.add_parser("vector_env", help="Environment steps per second, one State per match vs all matches stepped as one batch.")
+    vector_env_parser.add_argument("--envs", type=int, nargs="+", default=[1, 16, 128, 1024])
+    vector_env_parser.add_argument("--team-size", type=int, default=2)
+    vector_env_parser.add_argument("--ticks", type=int, default=600, help="Ticks stepped by the batch.")
+    vector_env_parser.add_argument("--states-ticks", type=int, default=60, help="Ticks stepped by the separate states.")
+    vector_env_parser.set_defaults(run=bench_vector_env)
+
+    lock_parser = subparsers.add_parser("lock", help="How long each tick holds the room's state lock, with a sender thread per player.")
+    lock_parser.add_argument("--players", type=int, nargs="+", default=[8, 30, 60])
+    lock_parser.add_argument("--ticks", type=int, default=600)
+    lock_parser.set_defaults(run=bench_lock)
+
+    entities_parser = subparsers.add_parser("entities", help="Memory, attribute access and copy cost of the entity classes, __dict__ vs __slots__.")
+    entities_parser.add_argument("-n", "--number", type=int, default=100000)
+    entities_parser.set_defaults(run=bench_entities)
+
+    physics_parser = subparsers.add_parser("physics", help="Python vs NumPy physics backends, time per tick and how far apart their results are.")
+    physics_parser.add_argument("--bodies", type=int, nargs="+", default=[10, 50, 200])
+    physics_parser.add_argument("-n", "--number", type=int, default=50)
+    physics_parser.add_argument("--ticks", type=int, default=300, help="Ticks both backends play side by side, to compare their positions.")
+    physics_parser.set_defaults(run=bench_physics)
+
+    timestep_parser = subparsers.add_parser("timestep", help="Fixed timestep determinism, and game speed and snapshot rate as the server gets slower.")
+    timestep_parser.add_argument("--seconds", type=int, default=30, help="Game time of the determinism check.")
+    timestep_parser.add_argument("--load", type=float, nargs="+", default=[0, 10, 25, 50, 200], help="Extra work per step, in milliseconds.")
+    timestep_parser.add_argument("-t", "--tick-rate", type=int, default=server_loop.TICK_RATE)
+    timestep_parser.add_argument("--duration", type=float, default=3)
+    timestep_parser.set_defaults(run=bench_timestep)
+
+    shards_parser = subparsers.add_parser("shards", help="Tick rate of many busy rooms as the number of worker processes grows.")
+    shards_parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    shards_parser.add_argument("--rooms", type=int, default=16)
+    shards_parser.add_argument("--players", type=int, default=4, help="Players in each room.")
+    shards_parser.add_argument("-p", "--port", type=int, default=12399)
+    shards_parser.add_argument("--warmup", type=float, default=3)
+    shards_parser.add_argument("--duration", type=float, default=5)
+    shards_parser.set_defaults(run=bench_shards)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+import time
+from collections import deque
+from threading import Condition, Lock, Thread
+
+
+# Snapshots waiting to be sent to a client. A slow client only ever gets
+# the newest ones, older snapshots are dropped instead of piling up.
+QUEUE_SIZE = 2
+
+# Snapshots per second sent to spectators
+SPECTATOR_RATE = 20
+
+
+class SnapshotQueue:
+    def __init__(self, size=QUEUE_SIZE):
+        self.snapshots = deque(maxlen=size)
+        self.cond = Condition()
+        self.closed = False
+        self.dropped = 0
+
+    def put(self, snapshot):
+        with self.cond:
+            if len(self.snapshots) == self.snapshots.maxlen:
+                self.dropped += 1
+            self.snapshots.append(snapshot)
+            self.cond.notify()
+
+    def get(self):
+        # Blocks until there is a snapshot, returns None once closed
+        with self.cond:
+            while not self.snapshots and not self.closed:
+                self.cond.wait()
+            if self.closed:
+                return None
+            return self.snapshots.popleft()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class Broadcaster:
+    """Pushes each tick's snapshot to every connection.
+
+    Threaded connections subscribe a SnapshotQueue, asyncio servers register
+    a listener that is called from the game cycle thread on every publish.
+    """
+
+    def __init__(self):
+        self.latest = None
+        self.lock = Lock()
+        self.queues = []
+        self.listeners = []
+
+    def publish(self, snapshot):
+        with self.lock:
+            self.latest = snapshot
+            queues = list(self.queues)
+
+        for queue in queues:
+            queue.put(snapshot)
+        for listener in self.listeners:
+            listener(snapshot)
+
+    def has_subscribers(self):
+        return bool(self.queues or self.listeners)
+
+    def subscribe(self, queue):
+        with self.lock:
+            self.queues.append(queue)
+
+    def unsubscribe(self, queue):
+        with self.lock:
+            if queue in self.queues:
+                self.queues.remove(queue)
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+
+class SpectatorFeed:
+    """The snapshot stream of a room's spectators.
+
+    A single thread takes the room's snapshots at SPECTATOR_RATE, encodes
+    each one once, as a delta against the previous one, and hands the same
+    bytes to every spectator. Spectators are anything with a put() method,
+    called with (baseline tick, snapshot, data). The baseline tick is None
+    for keyframes, and a spectator that missed the baseline sends
+    snapshot.encode() instead, a keyframe that is encoded once as well.
+
+    The thread only runs, and the room only captures snapshots for it,
+    while there are spectators.
+    """
+
+    def __init__(self, broadcaster):
+        self.broadcaster = broadcaster
+        self.lock = Lock()
+        self.spectators = []
+        self.source = None
+
+    def add(self, spectator):
+        with self.lock:
+            self.spectators.append(spectator)
+            if self.source is None:
+                self.source = SnapshotQueue(1)
+                self.broadcaster.subscribe(self.source)
+                Thread(target=self.run, args=(self.source,), daemon=True).start()
+
+    def remove(self, spectator):
+        with self.lock:
+            if spectator in self.spectators:
+                self.spectators.remove(spectator)
+            if not self.spectators and self.source is not None:
+                self.broadcaster.unsubscribe(self.source)
+                self.source.close()
+                self.source = None
+
+    def count(self):
+        return len(self.spectators)
+
+    def run(self, source):
+        baseline = None
+        next_time = time.monotonic()
+        while (last_snapshot := source.get()) is not None:
+            now = time.monotonic()
+            if now < next_time:
+                continue
+            # Keep the rate steady, unless far behind
+            next_time = max(next_time + 1 / SPECTATOR_RATE, now)
+
+            data = last_snapshot.encode(baseline)
+            item = (baseline.tick if baseline is not None else None, last_snapshot, data)
+            with self.lock:
+                spectators = list(self.spectators)
+            for spectator in spectators:
+                spectator.put(item)
+            baseline = last_snapshot
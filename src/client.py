@@ -3,6 +3,9 @@ import pygame
 import socket
 import client_loop as loop
 from client_loop import send_data, receive_data
+from prediction import View
+from server_loop import TICK_RATE
+from transport import BackgroundTransport, SpectatorTransport, TCPTransport, UDPTransport
 from state import Team, SCREEN_WIDTH, SCREEN_HEIGHT
 from hot_reloading import hot_cycle
 
@@ -10,7 +13,7 @@ class TooManyTriesError(Exception):
     """Exceção lançada quando há demasiadas tentativas inválidas de nome/equipa."""
     pass
 
-def initial_configuration(client_socket):
+def initial_configuration(client_socket, room=None):
     # Receive player ID from server
     try:
         player_id = receive_data(client_socket)
@@ -18,19 +21,39 @@ def initial_configuration(client_socket):
         print("Error receiving player ID from server.")
         return None
 
-    # Receber equipas e jogadores do servidor
+    # Receber as salas, com as equipas e jogadores de cada uma
     try:
         initial_info = receive_data(client_socket)
     except (ConnectionResetError, ConnectionAbortedError):
         print("Error receiving initial information from server.")
         return
 
+    print("Current rooms:")
+    for room_name, teams in initial_info["rooms"].items():
+        print(f"  {room_name} ({len(teams['blue']) + len(teams['red'])} players)")
+
+    # Escolher a sala, ou deixar o servidor escolher uma com espaço
+    if room is None:
+        room = input("Room (leave empty to join any): ").strip() or None
+    send_data(client_socket, room)
+
+    try:
+        room_info = receive_data(client_socket)
+    except (ConnectionResetError, ConnectionAbortedError):
+        print("Error receiving initial information from server.")
+        return
+
+    if room_info.get("error", False):
+        print(room_info["error"])
+        raise TooManyTriesError()
+
+    print(f"Joined room {room_info['room']}")
     print("Current teams:")
     print("  Blue team:")
-    for player in initial_info["teams"]["blue"]:
+    for player in room_info["teams"]["blue"]:
         print(f"    - {player}")
     print("  Red team:")
-    for player in initial_info["teams"]["red"]:
+    for player in room_info["teams"]["red"]:
         print(f"    - {player}")
 
     is_name_valid = False
@@ -93,7 +116,27 @@ def initial_configuration(client_socket):
         if not is_team_valid:
             print("This team can't be choosen. Please type another one.")
 
-    return player_id, name
+    # Só dado por servidores com UDP, para provar que os pacotes são nossos
+    return player_id, name, room_info.get("udp_token")
+
+
+def spectator_configuration(client_socket, room=None):
+    # Espectadores só escolhem a sala, sem nome nem equipa
+    receive_data(client_socket)
+    initial_info = receive_data(client_socket)
+
+    print("Current rooms:")
+    for room_name, teams in initial_info["rooms"].items():
+        print(f"  {room_name} ({len(teams['blue']) + len(teams['red'])} players)")
+
+    send_data(client_socket, {"spectate": room})
+    room_info = receive_data(client_socket)
+    if room_info.get("error", False):
+        print(room_info["error"])
+        return False
+
+    print(f"Watching room {room_info['room']}")
+    return True
 
 
 def main():
@@ -114,20 +157,61 @@ def main():
     parser.add_argument(
         "-p", "--port", type=int, default=12345, help="Server port (default: 12345)"
     )
+    parser.add_argument(
+        "--udp",
+        action="store_true",
+        help="Receive snapshots and send inputs over UDP (the server must be started with --udp).",
+    )
+    parser.add_argument(
+        "-r",
+        "--room",
+        type=str,
+        default=None,
+        help="Room to join, created if it doesn't exist (default: ask)",
+    )
+    parser.add_argument(
+        "-s",
+        "--spectate",
+        action="store_true",
+        help="Watch a room without playing, the busiest one unless --room is given.",
+    )
+    parser.add_argument(
+        "-t",
+        "--tick-rate",
+        type=int,
+        default=TICK_RATE,
+        help=f"The server's ticks per second, to predict movement at the same rate (default: {TICK_RATE})",
+    )
     args = parser.parse_args()
 
+    if args.spectate and args.udp:
+        parser.error("--spectate can't be combined with --udp")
+
     debug: bool = args.debug
     host: str = args.host
     port: int = args.port
 
     # Criar socket TCP
     client_socket = socket.create_connection((host, port))
+    # Sem o algoritmo de Nagle: o input só é enviado quando muda, não pode
+    # ficar à espera do ack do anterior
+    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
     try:
-        # Ver equipas e jogadores, escolher o nome e equipa
-        player_id, name = initial_configuration(client_socket)
-        if player_id is None:
-            return
+        if args.spectate:
+            if not spectator_configuration(client_socket, args.room):
+                client_socket.close()
+                return
+            player_id, name = None, None
+        else:
+            # Ver equipas e jogadores, escolher o nome e equipa
+            player_id, name, udp_token = initial_configuration(client_socket, args.room)
+            if player_id is None:
+                return
+            if args.udp and udp_token is None:
+                print("The server doesn't accept UDP, start it with --udp.")
+                client_socket.close()
+                return
 
         # Iniciar pygame
         pygame.init()
@@ -135,15 +219,28 @@ def main():
         # Pygame setup
         screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
         name_font = pygame.font.SysFont("arial", 30)
-        transparent_surface = pygame.Surface((SCREEN_WIDTH, SCREEN_HEIGHT), pygame.SRCALPHA)
+
+        if args.spectate:
+            transport = SpectatorTransport(client_socket)
+        elif args.udp:
+            transport = UDPTransport(client_socket, player_id, udp_token)
+        else:
+            transport = TCPTransport(client_socket)
+
+        # A rede corre noutras threads, o ciclo de desenho nunca espera por ela
+        transport = BackgroundTransport(transport)
+
+        # Snapshots recebidos e previsão do jogador local, entre frames
+        view = View(player_id, args.tick_rate)
+        clock = pygame.time.Clock()
 
         if debug:
             # Debug mode
             print("Debug mode enabled. Hot reloading is active.")
-            hot_cycle(loop.step, client_socket, screen, transparent_surface, name_font, player_id, name)
+            hot_cycle(loop.step, transport, view, clock, screen, name_font, player_id, name)
         else:
             # Normal mode
-            while loop.step(client_socket, screen, transparent_surface, name_font, player_id, name):
+            while loop.step(transport, view, clock, screen, name_font, player_id, name):
                 pass
 
         client_socket.close()
@@ -1,8 +1,10 @@
 import pygame
 import pygame.gfxdraw
 import pickle
-from input import Input
-from state import Team
+import time
+from functools import lru_cache
+from input import KEY_DOWN, KEY_INPUTS, KEY_KICK, KEY_LEFT, KEY_RIGHT, KEY_UP
+from state import State, Team, SCREEN_WIDTH, SCREEN_HEIGHT
 
 
 COLOR_FIELD = pygame.Color("#729861")
@@ -13,24 +15,35 @@ COLOR_BORDER_KICK = pygame.Color("white")
 COLOR_KICK_RANGE = pygame.Color(200, 200, 200, 100)
 
 
-def step(client_socket, screen, transparent_surface, name_font, player_id, name):
+# Frames desenhados por segundo, independentemente dos snapshots recebidos
+FRAME_RATE = 60
+
+
+def step(transport, view, clock, screen, name_font, player_id, name):
     # Boilerplate para eventos
     for event in pygame.event.get():
         if event.type == pygame.QUIT:
             return False
 
     # Ler input
-    inputs = get_input(pygame.key.get_pressed())
+    keys = get_input(pygame.key.get_pressed())
 
-    # Enviar input para o servidor
-    send_data(client_socket, inputs)
+    # Enviar input para o servidor, pela thread da rede
+    transport.send_input(keys)
 
-    # Receber estado atualizado do servidor
-    state = receive_data(client_socket)
+    # Guardar os snapshots que já chegaram, sem esperar por nenhum
+    view.receive(transport.receive_snapshots())
+    if transport.closed:
+        print(transport.close_reason)
+        return False
 
-    # Desenhar o estado
-    render(state, screen, transparent_surface, name_font, player_id)
+    # Estado interpolado, com o jogador local previsto
+    state = view.state(KEY_INPUTS[keys], time.perf_counter())
+    if state is not None:
+        # Desenhar o estado
+        render(state, screen, name_font, player_id)
 
+    clock.tick(FRAME_RATE)
     return True
 
 
@@ -41,54 +54,150 @@ def send_data(client_socket, data):
 
 
 def receive_data(client_socket):
-    size = int.from_bytes(client_socket.recv(4), "big")
+    return pickle.loads(receive_bytes(client_socket))
+
+
+def receive_bytes(client_socket):
+    size = int.from_bytes(receive_exactly(client_socket, 4), "big")
+    return receive_exactly(client_socket, size)
+
+
+def receive_exactly(client_socket, size):
     data = bytearray()
     while len(data) < size:
         chunk = client_socket.recv(size - len(data))
+        if not chunk:
+            raise ConnectionResetError("Server closed the connection")
         data.extend(chunk)
-    return pickle.loads(data)
+    return data
 
 
 def get_input(keys):
-    return Input(
-        keys[pygame.K_w],
-        keys[pygame.K_s],
-        keys[pygame.K_a],
-        keys[pygame.K_d],
-        keys[pygame.K_SPACE],
-        pygame.display.get_window_size()[0],
-        pygame.display.get_window_size()[1],
+    # As teclas premidas, num bit cada
+    return (
+        (KEY_UP if keys[pygame.K_w] else 0)
+        | (KEY_DOWN if keys[pygame.K_s] else 0)
+        | (KEY_LEFT if keys[pygame.K_a] else 0)
+        | (KEY_RIGHT if keys[pygame.K_d] else 0)
+        | (KEY_KICK if keys[pygame.K_SPACE] else 0)
     )
 
 
-def render(state, screen, transparent_surface, name_font, player_id):
-    # Desenhar fundo
-    transparent_surface.fill((0, 0, 0, 0))
-    screen.fill(COLOR_FIELD)
+# Zonas do ecrã desenhadas no último frame, a apagar no seguinte
+dirty_rects = []
+# Fundo e HUD que estão agora no ecrã
+drawn_background = None
+drawn_hud = None
 
-    draw_field(screen, state.field_coords)
+
+def render(state, screen, name_font, player_id):
+    global dirty_rects, drawn_background, drawn_hud
+
+    # Ajustar o estado ao tamanho da janela
+    window_width, window_height = pygame.display.get_window_size()
+    check_sprite_scale(window_scale(window_width, window_height))
+    state = scale_and_offset_state(state, window_width, window_height)
+
+    # O campo e os postes não mudam, ficam numa camada de fundo
+    background = field_background(window_width, window_height)
+    if background is not drawn_background:
+        # Primeiro frame, ou a janela mudou de tamanho: desenhar tudo
+        screen.blit(background, (0, 0))
+        erased = [screen.get_rect()]
+        drawn_background = background
+        drawn_hud = None
+    else:
+        # Apagar só o que foi desenhado no frame anterior
+        erased = dirty_rects
+        for rect in erased:
+            screen.blit(background, rect, rect)
+
+    rects = []
 
     # Desenhar a bola
-    draw_ball(state.ball, screen)
+    rects.append(draw_ball(state.ball, screen))
 
     # Desenhar o jogador local
-    if player_id in state.players:
-        draw_myself(state.players.pop(player_id), screen, transparent_surface)
+    myself = state.players.pop(player_id, None)
+    if myself is not None:
+        rects.append(draw_player(myself, screen))
 
     # Desenhar os outros jogadores
     for player in state.players.values():
-        draw_player(player, screen)
-        draw_name(player, screen, name_font)
+        rects.append(draw_player(player, screen))
+        rects.append(draw_name(player, screen, name_font))
+
+    # O HUD só é desenhado quando muda ou quando algo lhe passou por cima
+    hud, hud_rect = hud_layer(state, window_width, window_height)
+    updated = erased + rects
+    if hud is not drawn_hud or hud_rect.collidelist(updated) != -1:
+        screen.blit(hud, hud_rect)
+        updated.append(hud_rect)
+        drawn_hud = hud
+
+    # O indicador de pontapé fica por cima de tudo
+    if myself is not None:
+        rect = draw_kick_range(myself, screen)
+        rects.append(rect)
+        updated.append(rect)
+
+    # Atualizar só as zonas do ecra que mudaram
+    pygame.display.update(updated)
+    dirty_rects = rects
+
+
+def window_scale(window_width, window_height):
+    return min(window_height / SCREEN_HEIGHT, window_width / SCREEN_WIDTH)
+
+
+def scale_and_offset_state(default_size_state, window_width, window_height):
+    scale_ratio = window_scale(window_width, window_height)
+
+    field_x1 = default_size_state.field_coords[0] * scale_ratio
+    field_y1 = default_size_state.field_coords[1] * scale_ratio
+    field_x2 = default_size_state.field_coords[2] * scale_ratio
+    field_y2 = default_size_state.field_coords[3] * scale_ratio
+
+    field_width = field_x2 - field_x1
+    field_height = field_y2 - field_y1
+
+    offset_x = (window_width - field_width) / 2 - field_x1
+    offset_y = (window_height - field_height) / 2 - field_y1
+
+    # Adjust players, ball, and posts coordinates and radii
+    for player in default_size_state.players.values():
+        scale_and_offset_circle(player, scale_ratio, offset_x, offset_y)
+    scale_and_offset_circle(default_size_state.ball, scale_ratio, offset_x, offset_y)
+    for post in default_size_state.posts.values():
+        scale_and_offset_circle(post, scale_ratio, offset_x, offset_y)
+
+    # Adjust field coordinates
+    default_size_state.field_coords = (
+        round(field_x1 + offset_x),
+        round(field_y1 + offset_y),
+        round(field_x2 + offset_x),
+        round(field_y2 + offset_y),
+    )
 
-    # Desenhar postes
-    for post in state.posts.values():
-        draw_post(screen, post)
+    return default_size_state
+
+
+def scale_and_offset_circle(circle, scale_ratio, offset_x, offset_y):
+    circle.x = round(circle.x * scale_ratio + offset_x)
+    circle.y = round(circle.y * scale_ratio + offset_y)
+    circle.radius = round(circle.radius * scale_ratio)
 
-    draw_hud(screen, state)
 
-    # Atualizar o ecra
-    screen.blit(transparent_surface, (0, 0))
-    pygame.display.flip()
+@lru_cache(maxsize=1)
+def field_background(window_width, window_height):
+    state = scale_and_offset_state(State(), window_width, window_height)
+
+    background = pygame.Surface((window_width, window_height))
+    background.fill(COLOR_FIELD)
+    draw_field(background, state.field_coords)
+    for post in state.posts.values():
+        draw_post(background, post)
+    return background
 
 
 def draw_field(screen, field_coords):
@@ -97,86 +206,138 @@ def draw_field(screen, field_coords):
     pygame.draw.rect(screen, pygame.Color("#c6e7bd"), (x1, y1, x2-x1, y2-y1), width=7)
 
 
-def draw_ball(ball, screen):
-    x = int(ball.x)
-    y = int(ball.y)
+# Os círculos são desenhados uma vez para cada raio, equipa e estado do
+# pontapé, e depois só copiados para o ecrã. Os raios dependem da escala da
+# janela, por isso as caches são esvaziadas quando ela muda.
+sprite_scale = None
+
+
+def check_sprite_scale(scale):
+    global sprite_scale
+    if scale != sprite_scale:
+        sprite_scale = scale
+        for cache in [ball_sprite, player_sprite, post_sprite, kick_range_sprite, name_label]:
+            cache.cache_clear()
+
+
+def circle_sprite(border_radius, border_color, inner_radius, inner_color):
+    # Margem para o anti-aliasing, que pode passar um pixel do raio
+    center = border_radius + 2
+    return layered_sprite(2 * center + 1, [
+        # Desenhar borda
+        lambda layer: pygame.gfxdraw.filled_circle(layer, center, center, border_radius, border_color),
+        lambda layer: pygame.gfxdraw.aacircle(layer, center, center, border_radius, border_color),
+        # Desenhar circulo interior
+        lambda layer: pygame.gfxdraw.filled_circle(layer, center, center, inner_radius, inner_color),
+        lambda layer: pygame.gfxdraw.aacircle(layer, center, center, inner_radius, inner_color),
+    ])
 
-    border_radius = round(ball.radius)
-    inner_radius = int(ball.radius * 0.84)
 
-    # Desenhar borda
-    pygame.gfxdraw.filled_circle(screen, x, y, border_radius, pygame.Color("black"))
-    pygame.gfxdraw.aacircle(screen, x, y, border_radius, pygame.Color("black"))
+def layered_sprite(size, draws):
+    # Numa superfície transparente o gfxdraw substitui os pixels em vez de se
+    # misturar com eles, e o anti-aliasing abria buracos na borda. Cada
+    # desenho vai para uma camada própria, misturada com as anteriores como
+    # se fosse no ecrã.
+    sprite = pygame.Surface((size, size), pygame.SRCALPHA)
+    for draw in draws:
+        layer = pygame.Surface((size, size), pygame.SRCALPHA)
+        draw(layer)
+        sprite.blit(layer, (0, 0))
+    return sprite
 
-    # Desenhar circulo interior
-    pygame.gfxdraw.filled_circle(screen, x, y, inner_radius, pygame.Color("white"))
-    pygame.gfxdraw.aacircle(screen, x, y, inner_radius, pygame.Color("white"))
 
+def blit_centered(screen, sprite, x, y):
+    return screen.blit(sprite, (int(x) - sprite.get_width() // 2, int(y) - sprite.get_height() // 2))
 
-def draw_myself(player, screen, transparent_surface):
-    draw_player(player, screen)
 
-    # Obter a posição do jogador
-    pos = x, y = int(player.x), int(player.y)
+@lru_cache(maxsize=None)
+def ball_sprite(radius):
+    return circle_sprite(round(radius), pygame.Color("black"), int(radius * 0.84), pygame.Color("white"))
 
+
+@lru_cache(maxsize=None)
+def player_sprite(radius, team, kick):
+    border_color = COLOR_BORDER_KICK if kick else COLOR_BORDER
+    inner_color = COLOR_TEAM_BLUE if team == Team.BLUE else COLOR_TEAM_RED
+    return circle_sprite(radius, border_color, round(0.9 * radius), inner_color)
+
+
+@lru_cache(maxsize=None)
+def post_sprite(radius, team):
+    inner_color = COLOR_TEAM_BLUE if team == Team.BLUE else COLOR_TEAM_RED
+    return circle_sprite(int(radius), COLOR_BORDER, round(0.75 * radius), inner_color)
+
+
+@lru_cache(maxsize=None)
+def kick_range_sprite(radius):
     # Calcular dimensões do indicador de pontapé
-    inner_radius = round(1.44 * player.radius)
-    outer_radius = round(1.56 * player.radius)
+    inner_radius = round(1.44 * radius)
+    outer_radius = round(1.56 * radius)
     thickness = outer_radius - inner_radius
 
-    # Desenhar indicador do alcance de pontapé
-    pygame.draw.circle(
-        transparent_surface, COLOR_KICK_RANGE, pos, outer_radius, thickness
-    )
-    pygame.gfxdraw.aacircle(screen, x, y, inner_radius, COLOR_KICK_RANGE)
-    pygame.gfxdraw.aacircle(screen, x, y, outer_radius, COLOR_KICK_RANGE)
+    center = outer_radius + 2
+    return layered_sprite(2 * center + 1, [
+        # Desenhar indicador do alcance de pontapé
+        lambda layer: pygame.draw.circle(layer, COLOR_KICK_RANGE, (center, center), outer_radius, thickness),
+        lambda layer: pygame.gfxdraw.aacircle(layer, center, center, inner_radius, COLOR_KICK_RANGE),
+        lambda layer: pygame.gfxdraw.aacircle(layer, center, center, outer_radius, COLOR_KICK_RANGE),
+    ])
 
 
-def draw_player(player, screen):
-    border_color = COLOR_BORDER_KICK if player.kick else COLOR_BORDER
-    inner_color = COLOR_TEAM_BLUE if player.team == Team.BLUE else COLOR_TEAM_RED
+@lru_cache(maxsize=256)
+def name_label(name, name_font):
+    return name_font.render(name, True, (255, 255, 255))
+
 
-    # Obter a posição do jogador
-    x = int(player.x)
-    y = int(player.y)
+def draw_ball(ball, screen):
+    return blit_centered(screen, ball_sprite(ball.radius), ball.x, ball.y)
 
-    border_radius = player.radius
-    inner_radius = round(0.9 * player.radius)
 
-    # Desenhar borda
-    pygame.gfxdraw.filled_circle(screen, x, y, border_radius, border_color)
-    pygame.gfxdraw.aacircle(screen, x, y, border_radius, border_color)
+def draw_player(player, screen):
+    return blit_centered(screen, player_sprite(player.radius, player.team, player.kick), player.x, player.y)
+
 
-    # Desenhar circulo interior
-    pygame.gfxdraw.filled_circle(screen, x, y, inner_radius, inner_color)
-    pygame.gfxdraw.aacircle(screen, x, y, inner_radius, inner_color)
+def draw_kick_range(player, screen):
+    return blit_centered(screen, kick_range_sprite(player.radius), player.x, player.y)
 
 
 def draw_name(player, screen, name_font):
-    playerName = name_font.render(player.name, True, (255, 255, 255))
-    screen.blit(playerName, (player.x - playerName.get_rect().width / 2, player.y + 50))
+    playerName = name_label(player.name, name_font)
+    return screen.blit(playerName, (player.x - playerName.get_rect().width / 2, player.y + 50))
 
 
 def draw_post(screen, post):
-    inner_color = COLOR_TEAM_BLUE if post.team == Team.BLUE else COLOR_TEAM_RED
+    return blit_centered(screen, post_sprite(post.radius, post.team), post.x, post.y)
 
-    x = int(post.x)
-    y = int(post.y)
 
-    border_radius = int(post.radius)
-    inner_radius = round(0.75 * post.radius)
+HUD_WIDTH = 443
+HUD_HEIGHT = 35
 
-    # Desenhar borda
-    pygame.gfxdraw.filled_circle(screen, x, y, border_radius, COLOR_BORDER)
-    pygame.gfxdraw.aacircle(screen, x, y, border_radius, COLOR_BORDER)
 
-    # Desenhar circulo interior
-    pygame.gfxdraw.filled_circle(screen, x, y, inner_radius, inner_color)
-    pygame.gfxdraw.aacircle(screen, x, y, inner_radius, inner_color)
+@lru_cache(maxsize=None)
+def hud_font():
+    # Procurar a fonte no sistema é lento, fazê-lo só uma vez
+    return pygame.font.SysFont(["Arial Black", "Arial Bold", "Gadget", "sans-serif"], 33, bold=False)
 
 
-def draw_hud(screen, state):
-    font = pygame.font.SysFont(["Arial Black", "Arial Bold", "Gadget", "sans-serif"], 33, bold=False)
+def hud_layer(state, window_width, window_height):
+    minutes = int(state.match_manager.time_remaining) // 60
+    seconds = int(state.match_manager.time_remaining) % 60
+    match_state_text = f"{state.match_manager.state.name.capitalize()}: {minutes:02d}:{seconds:02d}"
+
+    hud_pos_x = round((window_width - HUD_WIDTH) / 2)
+    hud = draw_hud(window_width, window_height, hud_pos_x, state.score_red, state.score_blue, state.clock, match_state_text)
+    return hud, pygame.Rect(hud_pos_x, 0, HUD_WIDTH, HUD_HEIGHT)
+
+
+@lru_cache(maxsize=4)
+def draw_hud(window_width, window_height, hud_pos_x, score_red, score_blue, clock, match_state_text):
+    # O texto só muda com o resultado, o relógio ou o estado da partida. O
+    # HUD é desenhado sobre uma cópia do fundo, para poder ser copiado para o
+    # ecrã por cima do que lá estiver.
+    font = hud_font()
+    hud = pygame.Surface((HUD_WIDTH, HUD_HEIGHT))
+    hud.blit(field_background(window_width, window_height), (0, 0), (hud_pos_x, 0, HUD_WIDTH, HUD_HEIGHT))
 
     # Cores
     font_color = pygame.Color("#fefeff")
@@ -188,13 +349,13 @@ def draw_hud(screen, state):
     score_width = 35
     hyphen_width = 7
     colon_width = 7
-    hud_height = 35
-    hud_width = 443
+    hud_height = HUD_HEIGHT
+    hud_width = HUD_WIDTH
     hud_padding = 5
     clock_digit_width = 15
 
-    # Posições de ancoragem
-    hud_pos_x = round((screen.get_width() - hud_width) / 2)
+    # Posições de ancoragem, dentro do HUD
+    hud_pos_x = 0
     hud_pos_y = 0
     team_rect_pos_y = round((hud_height - team_rect_size) / 2)
     font_pos_y = round((hud_height - font.get_height()) / 2) + 2
@@ -202,62 +363,59 @@ def draw_hud(screen, state):
 
     # Desenhar fundo do HUD
     hud_background = pygame.Rect(hud_pos_x, hud_pos_y, hud_width, hud_height)
-    pygame.draw.rect(screen, hud_background_color, hud_background, border_bottom_left_radius=border_radius, border_bottom_right_radius=border_radius)
+    pygame.draw.rect(hud, hud_background_color, hud_background, border_bottom_left_radius=border_radius, border_bottom_right_radius=border_radius)
 
     # Desenhar retângulo da equipa vermelha
     red_rect_pos = hud_pos_x + hud_padding
     red_rect = pygame.Rect(red_rect_pos, team_rect_pos_y, team_rect_size, team_rect_size)
-    pygame.draw.rect(screen, COLOR_TEAM_RED, red_rect, border_radius=border_radius)
+    pygame.draw.rect(hud, COLOR_TEAM_RED, red_rect, border_radius=border_radius)
 
     # Desenhar pontuação da equipa vermelha
-    score_red = font.render(f"{state.score_red}", True, font_color)
+    score_red_text = font.render(f"{score_red}", True, font_color)
     score_red_pos = red_rect_pos + team_rect_size
-    screen.blit(score_red, (score_red_pos + round((score_width - score_red.get_width()) / 2), font_pos_y))
+    hud.blit(score_red_text, (score_red_pos + round((score_width - score_red_text.get_width()) / 2), font_pos_y))
 
     # Desenhar hífen entre pontuações
     score_hyphen = font.render("-", True, font_color)
     score_hyphen_pos = score_red_pos + score_width + round((hyphen_width - score_hyphen.get_width()) / 2)
-    screen.blit(score_hyphen, (score_hyphen_pos, font_pos_y))
+    hud.blit(score_hyphen, (score_hyphen_pos, font_pos_y))
 
     # Desenhar pontuação da equipa azul
-    score_blue = font.render(f"{state.score_blue}", True, font_color)
+    score_blue_text = font.render(f"{score_blue}", True, font_color)
     score_blue_pos = score_red_pos + score_width + hyphen_width
-    screen.blit(score_blue, (score_blue_pos + round((score_width - score_blue.get_width()) / 2), font_pos_y))
+    hud.blit(score_blue_text, (score_blue_pos + round((score_width - score_blue_text.get_width()) / 2), font_pos_y))
 
     # Desenhar retângulo da equipa azul
     blue_rect_pos = score_blue_pos + score_width
     blue_rect = pygame.Rect(blue_rect_pos, team_rect_pos_y, team_rect_size, team_rect_size)
-    pygame.draw.rect(screen, COLOR_TEAM_BLUE, blue_rect, border_radius=border_radius)
+    pygame.draw.rect(hud, COLOR_TEAM_BLUE, blue_rect, border_radius=border_radius)
 
     # Desenhar unidade dos segundos do relógio
-    clock_sec_ones = font.render(f"{state.clock % 60 % 10}", True, font_color)
+    clock_sec_ones = font.render(f"{clock % 60 % 10}", True, font_color)
     clock_sec_ones_pos = clock_end - clock_digit_width
-    screen.blit(clock_sec_ones, (clock_sec_ones_pos + round((clock_digit_width - clock_sec_ones.get_width()) / 2), font_pos_y))
+    hud.blit(clock_sec_ones, (clock_sec_ones_pos + round((clock_digit_width - clock_sec_ones.get_width()) / 2), font_pos_y))
 
     # Desenhar dezenas dos segundos do relógio
-    clock_sec_tens = font.render(f"{state.clock % 60 // 10}", True, font_color)
+    clock_sec_tens = font.render(f"{clock % 60 // 10}", True, font_color)
     clock_sec_tens_pos = clock_sec_ones_pos - clock_digit_width
-    screen.blit(clock_sec_tens, (clock_sec_tens_pos + round((clock_digit_width - clock_sec_tens.get_width()) / 2), font_pos_y))
+    hud.blit(clock_sec_tens, (clock_sec_tens_pos + round((clock_digit_width - clock_sec_tens.get_width()) / 2), font_pos_y))
 
     # Desenhar dois pontos do relógio
     clock_colon = font.render(":", True, font_color)
     clock_colon_pos = clock_sec_tens_pos - colon_width
-    screen.blit(clock_colon, (clock_colon_pos + round((colon_width - clock_colon.get_width()) / 2), font_pos_y))
+    hud.blit(clock_colon, (clock_colon_pos + round((colon_width - clock_colon.get_width()) / 2), font_pos_y))
 
     # Desenhar unidade dos minutos do relógio
-    clock_min_ones = font.render(f"{state.clock // 60 % 10}", True, font_color)
+    clock_min_ones = font.render(f"{clock // 60 % 10}", True, font_color)
     clock_min_ones_pos = clock_colon_pos - clock_digit_width
-    screen.blit(clock_min_ones, (clock_min_ones_pos + round((clock_digit_width - clock_min_ones.get_width()) / 2), font_pos_y))
+    hud.blit(clock_min_ones, (clock_min_ones_pos + round((clock_digit_width - clock_min_ones.get_width()) / 2), font_pos_y))
 
     # Desenhar dezenas dos minutos do relógio
-    clock_min_tens = font.render(f"{state.clock // 600}", True, font_color)
+    clock_min_tens = font.render(f"{clock // 600}", True, font_color)
     clock_min_tens_pos = clock_min_ones_pos - clock_digit_width
-    screen.blit(clock_min_tens, (clock_min_tens_pos + round((clock_digit_width - clock_min_tens.get_width()) / 2), font_pos_y))
+    hud.blit(clock_min_tens, (clock_min_tens_pos + round((clock_digit_width - clock_min_tens.get_width()) / 2), font_pos_y))
 
     # Desenhar estado da partida
-    minutes = int(state.match_manager.time_remaining) // 60
-    seconds = int(state.match_manager.time_remaining) % 60
-    match_state_text = f"{state.match_manager.state.name.capitalize()}: {minutes:02d}:{seconds:02d}"
     match_state_surface = font.render(match_state_text, True, font_color)
 
     # Calcular a posição central do HUD
@@ -268,4 +426,6 @@ def draw_hud(screen, state):
     text_pos_x = hud_center_x - text_width / 2
     text_pos_y = font_pos_y
 
-    screen.blit(match_state_surface, (text_pos_x, text_pos_y))
+    hud.blit(match_state_surface, (text_pos_x, text_pos_y))
+
+    return hud
@@ -1,9 +1,129 @@
+import struct
+
+
 class Input:
-    def __init__(self, up: bool = False, down: bool = False, left: bool = False, right: bool = False, kick: bool = False, window_width: int = 1920, window_height: int = 1080) -> None:
+    def __init__(self, up: bool = False, down: bool = False, left: bool = False, right: bool = False, kick: bool = False) -> None:
         self.up: bool = up
         self.down: bool = down
         self.left: bool = left
         self.right: bool = right
         self.kick: bool = kick
-        self.window_width: int = window_width
-        self.window_height: int = window_height
+
+
+# UDP input packets: version, player id, the player's token, input sequence
+# number, tick of the last snapshot received, then the keys of the last few
+# inputs, newest first, so that losing a packet doesn't lose the input it
+# carried. Player ids are in every snapshot, the token is only given to the
+# player in the handshake and is what proves a packet comes from them.
+INPUT_PACKET_VERSION = 2
+INPUT_REDUNDANCY = 4
+INPUT_TOKEN_SIZE = 16
+INPUT_HEADER = struct.Struct("<B16s16sIIB")
+
+KEY_UP = 1
+KEY_DOWN = 2
+KEY_LEFT = 4
+KEY_RIGHT = 8
+KEY_KICK = 16
+
+
+def input_to_keys(input: Input) -> int:
+    return (
+        (KEY_UP if input.up else 0)
+        | (KEY_DOWN if input.down else 0)
+        | (KEY_LEFT if input.left else 0)
+        | (KEY_RIGHT if input.right else 0)
+        | (KEY_KICK if input.kick else 0)
+    )
+
+
+def keys_to_input(keys: int) -> Input:
+    # Bits above the keys, from a malformed packet, are ignored
+    return KEY_INPUTS[keys & KEYS_MASK]
+
+
+# The Input of every combination of keys, shared by everyone who has them
+# pressed, so decoding an input creates none. Nobody may modify them.
+KEY_INPUTS = tuple(
+    Input(
+        bool(keys & KEY_UP),
+        bool(keys & KEY_DOWN),
+        bool(keys & KEY_LEFT),
+        bool(keys & KEY_RIGHT),
+        bool(keys & KEY_KICK),
+    )
+    for keys in range(32)
+)
+
+
+def encode_input_packet(player_id: bytes, token: bytes, seq: int, ack: int, keys_history) -> bytes:
+    return INPUT_HEADER.pack(INPUT_PACKET_VERSION, player_id, token, seq, ack, len(keys_history)) + bytes(keys_history)
+
+
+def decode_input_packet(data: bytes):
+    version, player_id, token, seq, ack, count = INPUT_HEADER.unpack_from(data)
+    if version != INPUT_PACKET_VERSION:
+        raise ValueError(f"Unsupported input packet version {version}")
+    keys_history = data[INPUT_HEADER.size:INPUT_HEADER.size + count]
+    return player_id, token, seq, ack, keys_history
+
+
+# TCP input messages, after the handshake. They have a fixed size, so the
+# server reads them into one reused buffer with no framing: the message type
+# and keys in the first byte, the sequence number of the change and the tick
+# of the last snapshot received. Type 0 is invalid, which rejects the length
+# prefix of a pickled message from an old client.
+MESSAGE_KEYS = 1
+MESSAGE_TYPE_SHIFT = 5
+KEYS_MASK = (1 << MESSAGE_TYPE_SHIFT) - 1
+KEYS_MESSAGE = struct.Struct("<BHI")
+INPUT_MESSAGE_SIZE = KEYS_MESSAGE.size
+
+# Keys are only sent when they change, and again after this many seconds
+# without a change, which keeps acking snapshots for the delta baselines
+INPUT_KEEPALIVE = 0.1
+
+
+def encode_keys_message(keys: int, seq: int, ack: int) -> bytes:
+    return KEYS_MESSAGE.pack(MESSAGE_KEYS << MESSAGE_TYPE_SHIFT | keys, seq & 0xFFFF, ack)
+
+
+class KeyChanges:
+    """The keys messages a client sends: one when the keys change, numbered
+    by the change, and keepalives repeating it while they don't."""
+
+    def __init__(self):
+        self.keys = None
+        self.seq = 0
+        self.sent_at = float("-inf")
+
+    def message(self, keys: int, ack: int, now: float):
+        # The message to send now for these keys, or None
+        if keys == self.keys and now - self.sent_at < INPUT_KEEPALIVE:
+            return None
+        if keys != self.keys:
+            self.seq = (self.seq + 1) & 0xFFFF
+            self.keys = keys
+        self.sent_at = now
+        return encode_keys_message(keys, self.seq, ack)
+
+
+class InputDecoder:
+    """The input of one connection, updated by each message it sends.
+
+    Messages are decoded in place, from whatever buffer the caller read them
+    into, and keys map to the shared KEY_INPUTS: no message allocates
+    anything but the ints unpacked from it.
+    """
+
+    def __init__(self):
+        self.input = KEY_INPUTS[0]
+        self.seq = 0
+        self.ack = 0
+
+    def decode(self, message):
+        message_type = message[0] >> MESSAGE_TYPE_SHIFT
+        if message_type != MESSAGE_KEYS:
+            raise ValueError(f"Unknown input message type {message_type}")
+        _, self.seq, self.ack = KEYS_MESSAGE.unpack_from(message)
+        self.input = KEY_INPUTS[message[0] & KEYS_MASK]
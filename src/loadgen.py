@@ -0,0 +1,318 @@
+import argparse
+import asyncio
+import csv
+import itertools
+import math
+import pickle
+import random
+import server_loop
+import snapshot
+from input import Input, KeyChanges, input_to_keys
+from room import DEFAULT_ROOM
+from state import Team
+
+
+async def send_message_async(writer, data):
+    data = pickle.dumps(data)
+    writer.write(len(data).to_bytes(4, "big") + data)
+    await writer.drain()
+
+
+async def receive_message_async(reader):
+    size = int.from_bytes(await reader.readexactly(4), "big")
+    return await reader.readexactly(size)
+
+
+async def receive_reply(reader, writer):
+    # A reply of the handshake, the server ends it with an error instead
+    reply = pickle.loads(await receive_message_async(reader))
+    if reply.get("error", False):
+        writer.close()
+        raise ConnectionError(reply["error"])
+    return reply
+
+
+async def join_as_bot(port, index, room=DEFAULT_ROOM, host="127.0.0.1"):
+    """Connects and goes through the whole handshake of client.py without
+    asking anything: joins the room (any with space if None) under a
+    generated name, on the team with fewer players. Returns the streams,
+    the player id and the UDP token, None if the server has no UDP. Raises
+    ConnectionError with the server's message if it turns the bot away."""
+    reader, writer = await asyncio.open_connection(host, port)
+    player_id = pickle.loads(await receive_message_async(reader))
+    await receive_message_async(reader)
+
+    await send_message_async(writer, room)
+    room_info = await receive_reply(reader, writer)
+
+    # Until the server takes one or gives up after too many tries
+    for attempt in itertools.count():
+        await send_message_async(writer, f"bot{index}" if attempt == 0 else f"bot{index}-{attempt}")
+        if (await receive_reply(reader, writer))["validity"]:
+            break
+
+    # Teams fill up unevenly when bots join concurrently, so try both
+    teams = room_info["teams"]
+    red_first = len(teams["red"]) < len(teams["blue"]) or (len(teams["red"]) == len(teams["blue"]) and index % 2 == 0)
+    for team in itertools.cycle([Team.RED, Team.BLUE] if red_first else [Team.BLUE, Team.RED]):
+        await send_message_async(writer, team)
+        if (await receive_reply(reader, writer))["validity"]:
+            break
+
+    return reader, writer, player_id, room_info.get("udp_token")
+
+
+async def join_as_spectator(port, room=None, host="127.0.0.1"):
+    # Watches the room, or the busiest one, without taking a player slot
+    reader, writer = await asyncio.open_connection(host, port)
+    await receive_message_async(reader)
+    await receive_message_async(reader)
+
+    await send_message_async(writer, {"spectate": room})
+    await receive_reply(reader, writer)
+    return reader, writer
+
+
+# Scripted inputs, by name: generators of the inputs a bot sends, given its
+# own random generator
+def idle_inputs(rng):
+    while True:
+        yield Input()
+
+
+def circle_inputs(rng):
+    # A full turn every 8 seconds at 60 inputs per second
+    for n in itertools.count(rng.randrange(480)):
+        direction = n // 60 % 8
+        yield Input(
+            up=direction in (7, 0, 1),
+            right=direction in (1, 2, 3),
+            down=direction in (3, 4, 5),
+            left=direction in (5, 6, 7),
+            kick=n % 30 == 0,
+        )
+
+
+def random_inputs(rng):
+    # A new random set of keys about twice a second
+    while True:
+        keys = [rng.random() < 0.5 for _ in range(4)]
+        for _ in range(30):
+            yield Input(*keys, kick=rng.random() < 0.05)
+
+
+SCRIPTS = {"idle": idle_inputs, "circle": circle_inputs, "random": random_inputs}
+
+
+class BotStats:
+    def __init__(self, index, spectator=False):
+        self.index = index
+        self.spectator = spectator
+        self.connect_time = None
+        self.snapshots = 0
+        self.bytes_received = 0
+        # Arrival time minus the time the server should have sent the
+        # snapshot, by its tick. The server clock is unknown, so only the
+        # difference to the smallest one (the best case) is meaningful.
+        self.delays = []
+        self.error = None
+        self.disconnected = False
+        self.last_tick = 0
+
+    def latencies(self):
+        if not self.delays:
+            return []
+        best = min(self.delays)
+        return [delay - best for delay in self.delays]
+
+    def jitter(self):
+        # Mean variation of the delay between consecutive snapshots, as in
+        # RFC 3550 but without smoothing
+        if len(self.delays) < 2:
+            return 0
+        return sum(abs(b - a) for a, b in zip(self.delays, self.delays[1:])) / (len(self.delays) - 1)
+
+
+async def run_bot(args, index, stop, stats):
+    event_loop = asyncio.get_running_loop()
+    inputs = SCRIPTS[args.script](random.Random(index))
+
+    start = event_loop.time()
+    try:
+        reader, writer, _, _ = await join_as_bot(args.port, index, args.room, args.host)
+    except (OSError, asyncio.IncompleteReadError) as e:
+        stats.error = str(e) or type(e).__name__
+        return
+    stats.connect_time = event_loop.time() - start
+
+    async def send_inputs():
+        # Like the client, the keys are read at the input rate but only sent
+        # when they change, or as keepalives
+        key_changes = KeyChanges()
+        for input in inputs:
+            message = key_changes.message(input_to_keys(input), stats.last_tick, event_loop.time())
+            if message is not None:
+                writer.write(message)
+                await writer.drain()
+            await asyncio.sleep(1 / args.input_rate)
+
+    sender = asyncio.create_task(send_inputs())
+    try:
+        await receive_snapshots(args, reader, stop, stats)
+    finally:
+        sender.cancel()
+        writer.close()
+
+
+async def run_spectator(args, stop, stats):
+    event_loop = asyncio.get_running_loop()
+    start = event_loop.time()
+    try:
+        reader, writer = await join_as_spectator(args.port, args.room, args.host)
+    except (OSError, asyncio.IncompleteReadError) as e:
+        stats.error = str(e) or type(e).__name__
+        return
+    stats.connect_time = event_loop.time() - start
+
+    try:
+        await receive_snapshots(args, reader, stop, stats)
+    finally:
+        writer.close()
+
+
+async def receive_snapshots(args, reader, stop, stats):
+    event_loop = asyncio.get_running_loop()
+    try:
+        # Only the header is read, decoding every snapshot of hundreds of
+        # connections would make the load generator the bottleneck
+        while not stop.is_set():
+            data = await receive_message_async(reader)
+
+            _, tick, _, _ = snapshot.HEADER.unpack_from(data)
+            stats.snapshots += 1
+            stats.bytes_received += 4 + len(data)
+            stats.delays.append(event_loop.time() - tick / args.tick_rate)
+            stats.last_tick = tick
+    except (OSError, asyncio.IncompleteReadError) as e:
+        stats.error = str(e) or type(e).__name__
+        stats.disconnected = True
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(p / 100 * len(values)))] if values else math.nan
+
+
+async def generate_load(args):
+    stop = asyncio.Event()
+    stats = [BotStats(i) for i in range(args.connections)]
+    spectator_stats = [BotStats(i, spectator=True) for i in range(args.spectators)]
+    bots = []
+
+    # Ramp up, joining at most this many per second so the listen backlog
+    # doesn't overflow
+    for i in range(args.connections):
+        bots.append(asyncio.create_task(run_bot(args, i, stop, stats[i])))
+        await asyncio.sleep(1 / args.ramp_rate)
+    for i in range(args.spectators):
+        bots.append(asyncio.create_task(run_spectator(args, stop, spectator_stats[i])))
+        await asyncio.sleep(1 / args.ramp_rate)
+    print(f"{args.connections + args.spectators} connections opened, measuring for {args.duration} s")
+
+    # Only what arrives after the ramp counts
+    await asyncio.sleep(args.warmup)
+    for bot_stats in stats + spectator_stats:
+        bot_stats.snapshots = 0
+        bot_stats.bytes_received = 0
+        bot_stats.delays.clear()
+    await asyncio.sleep(args.duration)
+
+    stop.set()
+    await asyncio.wait(bots, timeout=1)
+    for bot in bots:
+        bot.cancel()
+    return stats, spectator_stats
+
+
+def report(stats, duration):
+    connected = [s for s in stats if s.connect_time is not None]
+    failed = [s for s in stats if s.connect_time is None]
+    disconnected = [s for s in connected if s.disconnected]
+    latencies = sorted(latency for s in connected for latency in s.latencies())
+    jitters = sorted(s.jitter() for s in connected)
+    rates = sorted(s.snapshots / duration for s in connected)
+    connect_times = sorted(s.connect_time for s in connected)
+    total_bytes = sum(s.bytes_received for s in connected)
+
+    print(f"Connected: {len(connected)}, failed: {len(failed)}, disconnected: {len(disconnected)}")
+    for error in sorted({s.error for s in failed + disconnected}):
+        print(f"  {error}: {sum(s.error == error for s in failed + disconnected)}")
+    print(f"Handshake ms:     p50 {percentile(connect_times, 50) * 1000:.1f}, p95 {percentile(connect_times, 95) * 1000:.1f}, max {percentile(connect_times, 100) * 1000:.1f}")
+    print(f"Snapshots/s:      p50 {percentile(rates, 50):.1f}, min {percentile(rates, 0):.1f}")
+    print(f"Latency ms:       p50 {percentile(latencies, 50) * 1000:.1f}, p95 {percentile(latencies, 95) * 1000:.1f}, p99 {percentile(latencies, 99) * 1000:.1f}, max {percentile(latencies, 100) * 1000:.1f}")
+    print(f"Jitter ms:        p50 {percentile(jitters, 50) * 1000:.1f}, p95 {percentile(jitters, 95) * 1000:.1f}")
+    print(f"Received:         {total_bytes / duration / 1024:.1f} KiB/s, {total_bytes / duration / max(1, len(connected)):.0f} B/s per connection")
+
+
+def write_csv(stats, duration, path):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["bot", "spectator", "handshake_ms", "snapshots_per_s", "bytes_per_s", "latency_p50_ms", "latency_p99_ms", "jitter_ms", "disconnected", "error"])
+        for s in stats:
+            latencies = sorted(s.latencies())
+            writer.writerow([
+                s.index,
+                s.spectator,
+                round(s.connect_time * 1000, 1) if s.connect_time is not None else "",
+                round(s.snapshots / duration, 1),
+                round(s.bytes_received / duration),
+                round(percentile(latencies, 50) * 1000, 1),
+                round(percentile(latencies, 99) * 1000, 1),
+                round(s.jitter() * 1000, 1),
+                s.disconnected,
+                s.error or "",
+            ])
+
+
+def raise_file_limit(files):
+    # One file descriptor per connection. Windows has no such limit, nor the
+    # resource module.
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < files:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard, files), hard))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DojoBall load generator: many headless bots connected to one server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("-p", "--port", type=int, default=12345)
+    parser.add_argument("-c", "--connections", type=int, default=100)
+    parser.add_argument("-s", "--spectators", type=int, default=0, help="Spectator connections opened after the players")
+    parser.add_argument("-r", "--room", default=None, help="Room every bot joins (default: any room with space)")
+    parser.add_argument("--script", choices=SCRIPTS, default="random", help="Inputs sent by every bot (default: random)")
+    parser.add_argument("--input-rate", type=float, default=60, help="Times per second every bot reads its keys, sent when they change (default: 60)")
+    parser.add_argument("--ramp-rate", type=float, default=50, help="Connections opened per second (default: 50)")
+    parser.add_argument("--tick-rate", type=int, default=server_loop.TICK_RATE, help="Server tick rate, to tell how late snapshots are (default: %(default)s)")
+    parser.add_argument("--warmup", type=float, default=2)
+    parser.add_argument("-d", "--duration", type=float, default=10)
+    parser.add_argument("-o", "--output", help="Write per connection results to this CSV file")
+    args = parser.parse_args()
+
+    raise_file_limit(args.connections + args.spectators + 64)
+
+    stats, spectator_stats = asyncio.run(generate_load(args))
+    if stats:
+        print("Players")
+        report(stats, args.duration)
+    if spectator_stats:
+        print("Spectators")
+        report(spectator_stats, args.duration)
+    if args.output:
+        write_csv(stats + spectator_stats, args.duration, args.output)
+
+
+if __name__ == "__main__":
+    main()
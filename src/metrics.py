@@ -0,0 +1,134 @@
+from array import array
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+
+
+# Samples kept by every histogram, the most recent ones
+HISTOGRAM_SIZE = 4096
+
+QUANTILES = [0.5, 0.9, 0.99]
+
+
+class Histogram:
+    """The last HISTOGRAM_SIZE samples of a value, in a ring buffer.
+
+    Recording is a couple of assignments, cheap enough for every tick and
+    every send. Samples recorded by two threads at the same time may
+    overwrite each other, which is fine for statistics. Quantiles are only
+    computed when somebody asks for them.
+    """
+
+    def __init__(self, name, unit, help):
+        self.name = name
+        self.unit = unit
+        self.help = help
+        self.samples = array("d", bytes(8 * HISTOGRAM_SIZE))
+        self.count = 0
+        self.sum = 0.0
+
+    def record(self, value):
+        self.samples[self.count % HISTOGRAM_SIZE] = value
+        self.count += 1
+        self.sum += value
+
+    def recent(self):
+        return sorted(self.samples[:min(self.count, HISTOGRAM_SIZE)])
+
+    def quantile(self, q, recent=None):
+        recent = self.recent() if recent is None else recent
+        if not recent:
+            return 0.0
+        return recent[min(len(recent) - 1, int(q * len(recent)))]
+
+
+histograms = {}
+
+
+def histogram(name, unit, help):
+    if name not in histograms:
+        histograms[name] = Histogram(name, unit, help)
+    return histograms[name]
+
+
+# Every tick of a room, phase by phase
+lock_wait = histogram("tick_lock_wait", "seconds", "Time waiting for the room's state lock")
+match_update = histogram("tick_match_update", "seconds", "Match timer and state changes")
+inputs = histogram("tick_inputs", "seconds", "Applying the players' inputs")
+physics = histogram("tick_physics", "seconds", "Movement, collisions, kicks and goals")
+capture = histogram("tick_snapshot", "seconds", "Capturing the snapshot sent to clients")
+notify = histogram("tick_notify", "seconds", "Handing the snapshot to the connections")
+tick = histogram("tick_total", "seconds", "Whole tick of a room, lock wait included")
+
+# Every snapshot sent to a client
+send_time = histogram("send_time", "seconds", "Encoding and writing a snapshot to a client")
+send_bytes = histogram("send_size", "bytes", "Size of the snapshots sent to clients")
+
+
+# Values read when reported, name -> (help, function returning the value)
+gauges = {}
+
+
+def gauge(name, help, read):
+    gauges[name] = (help, read)
+
+
+def report():
+    # For the interpreter
+    lines = [f"{'metric':<26} | {'count':>9} | {'p50':>9} | {'p90':>9} | {'p99':>9} | {'max':>9}"]
+    for h in histograms.values():
+        recent = h.recent()
+        if h.unit == "seconds":
+            values = [h.quantile(q, recent) * 1e6 for q in QUANTILES] + [recent[-1] * 1e6 if recent else 0]
+            name = f"{h.name} (us)"
+        else:
+            values = [h.quantile(q, recent) for q in QUANTILES] + [recent[-1] if recent else 0]
+            name = f"{h.name} ({h.unit})"
+        lines.append(f"{name:<26} | {h.count:>9} | " + " | ".join(f"{value:>9.1f}" for value in values))
+    for name, (_, read) in gauges.items():
+        lines.append(f"{name:<26} | {read():>9}")
+    return "\n".join(lines)
+
+
+def render():
+    # Prometheus text format: every histogram as a summary of its recent
+    # samples, plus the count and sum of all of them
+    lines = []
+    for h in histograms.values():
+        name = f"dojoball_{h.name}_{h.unit}"
+        recent = h.recent()
+        lines.append(f"# HELP {name} {h.help}")
+        lines.append(f"# TYPE {name} summary")
+        for q in QUANTILES:
+            lines.append(f'{name}{{quantile="{q}"}} {h.quantile(q, recent)!r}')
+        lines.append(f"{name}_sum {h.sum!r}")
+        lines.append(f"{name}_count {h.count}")
+    for name, (help, read) in gauges.items():
+        lines.append(f"# HELP dojoball_{name} {help}")
+        lines.append(f"# TYPE dojoball_{name} gauge")
+        lines.append(f"dojoball_{name} {read()}")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port):
+    # Local only, for a scraper running on the same machine
+    server = ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
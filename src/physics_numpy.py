@@ -0,0 +1,298 @@
+import math
+import numpy as np
+import weakref
+from server_loop import BROADPHASE_MIN_CIRCLES, BROADPHASE_REACH, DELTA_KICK_FORCE, KICK_REACH, MIN_KICK_FORCE, MIN_SPEED_SQR, MOVE_SPEED, moving_circles
+
+
+# Below this many bodies every pair is checked at once, with the reach
+# filter applied to all of them, instead of sorting for the sweep: the pair
+# indices are built once and it takes fewer NumPy calls
+ALL_PAIRS_MAX_BODIES = 128
+
+# The bodies of every state moved with this backend, kept between ticks
+_bodies = weakref.WeakKeyDictionary()
+
+
+class Bodies:
+    """Every moving circle of a state as a structure of arrays.
+
+    The ball is always the last body. Kept from one tick to the next with
+    everything that only changes when players join or leave: the circles,
+    their radius, mass and drag, the pairs to check and the bounds. Only the
+    motion is gathered from the state's circles at the start of a tick and
+    written back at the end, so the rest of the server keeps working with
+    Player and Ball objects.
+    """
+
+    def __init__(self, circles, state):
+        self.circles = circles
+        self.players = circles[:-1]
+        count = len(circles)
+
+        constants = np.array([(c.radius, c.mass, c.drag_coefficient) for c in circles], dtype=np.float64)
+        self.radius = constants[:, 0].copy()
+        self.mass = constants[:, 1].copy()
+        self.drag = constants[:, 2].copy()
+        self.scaled_drag = {}
+
+        self.pairs = np.triu_indices(count, 1) if count <= ALL_PAIRS_MAX_BODIES else None
+
+        # Same comparisons as server_loop.bounce_off_edges
+        x0, y0, x1, y1 = state.player_area_coords
+        self.min_x = self.radius + x0
+        self.min_y = self.radius + y0
+        self.edge_x = x1 - self.radius
+        self.edge_y = y1 - self.radius
+        self.max_x = x1 - 1 - self.radius
+        self.max_y = y1 - 1 - self.radius
+
+        posts = list(state.posts.values())
+        self.post_x = np.array([p.x for p in posts], dtype=np.float64)
+        self.post_y = np.array([p.y for p in posts], dtype=np.float64)
+        self.post_reach = self.radius[:, None] + np.array([p.radius for p in posts], dtype=np.float64)
+
+    def gather(self):
+        motion = np.array([v for c in self.circles for v in (c.x, c.y, c.vx, c.vy)], dtype=np.float64)
+        motion = motion.reshape(-1, 4).T.copy()
+        self.x, self.y, self.vx, self.vy = motion
+        self.kick = [p.kick and not p.kick_locked for p in self.players]
+
+    def write_back(self):
+        for c, x, y, vx, vy in zip(self.circles, self.x.tolist(), self.y.tolist(), self.vx.tolist(), self.vy.tolist()):
+            c.x = x
+            c.y = y
+            c.vx = vx
+            c.vy = vy
+
+
+def bodies_of(state):
+    circles = list(moving_circles(state))
+    bodies = _bodies.get(state)
+    if bodies is None or bodies.circles != circles:
+        bodies = Bodies(circles, state)
+        _bodies[state] = bodies
+    bodies.gather()
+    return bodies
+
+
+def move(state, scale):
+    # Same steps, in the same order, as server_loop.move
+    bodies = bodies_of(state)
+
+    update_positions(bodies, scale)
+    handle_collisions(state, bodies)
+    handle_kicks(state, bodies)
+
+    bodies.write_back()
+
+
+def update_positions(b, scale):
+    b.x += b.vx * MOVE_SPEED * scale
+    b.y += b.vy * MOVE_SPEED * scale
+
+    drag = b.scaled_drag.get(scale)
+    if drag is None:
+        drag = b.scaled_drag[scale] = b.drag ** scale
+    b.vx *= drag
+    b.vy *= drag
+
+    stopped = b.vx**2 + b.vy**2 < MIN_SPEED_SQR
+    if stopped.any():
+        b.vx[stopped] = 0
+        b.vy[stopped] = 0
+
+
+def handle_collisions(state, b):
+    if len(b.x) < BROADPHASE_MIN_CIRCLES:
+        resolve_pairs(b, *b.pairs)
+    else:
+        resolve_candidate_pairs(b)
+
+    # Ball against the field boundaries, outside the goals
+    ball = len(b.x) - 1
+    x0, y0, x1, y1 = state.field_coords
+    r = b.radius[ball]
+    if b.x[ball] < r + x0 and (b.y[ball] < state.posts["tl"].y or b.y[ball] > state.posts["bl"].y):
+        b.x[ball] = r + x0
+        b.vx[ball] *= -1
+    if b.x[ball] >= x1 - r and (b.y[ball] < state.posts["tr"].y or b.y[ball] > state.posts["br"].y):
+        b.x[ball] = x1 - 1 - r
+        b.vx[ball] *= -1
+    if b.y[ball] < r + y0:
+        b.y[ball] = r + y0
+        b.vy[ball] *= -1
+    if b.y[ball] >= y1 - r:
+        b.y[ball] = y1 - 1 - r
+        b.vy[ball] *= -1
+
+    # Everything against the player area boundaries
+    reflect(b.x, b.vx, b.x < b.min_x, b.min_x)
+    reflect(b.x, b.vx, b.x >= b.edge_x, b.max_x)
+    reflect(b.y, b.vy, b.y < b.min_y, b.min_y)
+    reflect(b.y, b.vy, b.y >= b.edge_y, b.max_y)
+
+    # Posts are far enough apart that a circle touches at most one, so every
+    # circle can be resolved against every post at once
+    dx = b.post_x - b.x[:, None]
+    dy = b.post_y - b.y[:, None]
+    distance_sqr = dx**2 + dy**2
+    hit = distance_sqr < b.post_reach**2
+    if not hit.any():
+        return
+
+    circles, posts = np.nonzero(hit)
+    distance = np.sqrt(distance_sqr[circles, posts])
+    distance[distance == 0] = 1e-6
+    nx = dx[circles, posts] / distance
+    ny = dy[circles, posts] / distance
+    overlap = b.post_reach[circles, posts] - distance
+    b.x[circles] -= overlap * nx
+    b.y[circles] -= overlap * ny
+
+    dp = 2 * (nx * b.vx[circles] + ny * b.vy[circles])
+    b.vx[circles] -= dp * nx
+    b.vy[circles] -= dp * ny
+
+
+def reflect(position, velocity, outside, limit):
+    if outside.any():
+        position[outside] = limit[outside]
+        velocity[outside] *= -1
+
+
+def resolve_candidate_pairs(b):
+    # Resolved again with a wider reach when the pushes went further than it
+    # leaves room for, as server_loop.resolve_candidate_pairs
+    start = b.x.copy(), b.y.copy(), b.vx.copy(), b.vy.copy()
+    diameter = 2 * b.radius.max()
+    reach = BROADPHASE_REACH
+    while True:
+        furthest = resolve_pairs(b, *candidate_pairs(b, reach))
+        if diameter + 2 * furthest <= reach:
+            return
+
+        b.x[:], b.y[:], b.vx[:], b.vy[:] = start
+        reach = max(2 * reach, diameter + 2 * furthest)
+
+
+def candidate_pairs(b, reach=BROADPHASE_REACH):
+    # The same pairs, in the same order, as server_loop.candidate_pairs
+    count = len(b.x)
+    if b.pairs is not None:
+        # The pairs the sweep would find: closer than the reach on both axes
+        i, j = b.pairs
+        near = (np.abs(b.x[j] - b.x[i]) < reach) & (np.abs(b.y[j] - b.y[i]) < reach)
+        return i[near], j[near]
+
+    # Sweep and prune: sorted by x, each body is only paired with the
+    # following ones, then pairs out of reach on either axis are dropped
+    # with the same comparisons as candidate_pairs
+    order = np.argsort(b.x, kind="stable")
+    sorted_x = b.x[order]
+    ends = np.searchsorted(sorted_x, sorted_x + reach, side="right")
+    counts = ends - np.arange(1, count + 1)
+    first = np.repeat(np.arange(count), counts)
+    second = first + 1 + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    first = order[first]
+    second = order[second]
+    dy = b.y[second] - b.y[first]
+    near = (b.x[second] - b.x[first] < reach) & (-reach < dy) & (dy < reach)
+    i = np.minimum(first[near], second[near])
+    j = np.maximum(first[near], second[near])
+    pair_order = np.lexsort((j, i))
+    return i[pair_order], j[pair_order]
+
+
+def resolve_pairs(b, i, j):
+    # One pair after the other, each seeing the positions left by the ones
+    # before it, exactly as server_loop does. Resolving them all at once
+    # drifts apart in crowds. Returns how far the most pushed body was
+    # pushed in total.
+    #
+    # Only pairs that touch, or that share a body with one that does, can
+    # move anything. The rest are found at once: a pair whose bodies are
+    # never pushed keeps the distance it had at the start of the tick.
+    dx = b.x[j] - b.x[i]
+    dy = b.y[j] - b.y[i]
+    radius_sum = b.radius[i] + b.radius[j]
+    active = dx**2 + dy**2 < radius_sum**2
+    if not active.any():
+        return 0.0
+
+    moved = np.zeros(len(b.x), dtype=bool)
+    while True:
+        moved[i[active]] = True
+        moved[j[active]] = True
+        reached = moved[i] | moved[j]
+        if np.count_nonzero(reached) == np.count_nonzero(active):
+            break
+        active = reached
+
+    # Plain floats are faster than NumPy scalars for this loop
+    x, y, vx, vy = b.x.tolist(), b.y.tolist(), b.vx.tolist(), b.vy.tolist()
+    radius, mass = b.radius.tolist(), b.mass.tolist()
+    pushed = [0.0] * len(x)
+    for i, j in zip(i[active].tolist(), j[active].tolist()):
+        dx = x[j] - x[i]
+        dy = y[j] - y[i]
+        distance_sqr = dx**2 + dy**2
+        radius_sum = radius[i] + radius[j]
+        if distance_sqr >= radius_sum**2:
+            continue
+
+        distance = math.sqrt(distance_sqr)
+        # Prevent division by zero in case of exact overlap
+        if distance == 0:
+            distance = 1e-6
+        nx = dx / distance
+        ny = dy / distance
+        overlap = 0.5 * (radius_sum - distance)
+        x[i] -= overlap * nx
+        y[i] -= overlap * ny
+        x[j] += overlap * nx
+        y[j] += overlap * ny
+        pushed[i] += overlap
+        pushed[j] += overlap
+
+        kx = vx[i] - vx[j]
+        ky = vy[i] - vy[j]
+        p = 2 * (nx * kx + ny * ky) / (mass[i] + mass[j])
+        vx[i] -= p * mass[j] * nx
+        vy[i] -= p * mass[j] * ny
+        vx[j] += p * mass[i] * nx
+        vy[j] += p * mass[i] * ny
+
+    b.x[:] = x
+    b.y[:] = y
+    b.vx[:] = vx
+    b.vy[:] = vy
+    return max(pushed)
+
+
+def handle_kicks(state, b):
+    if not any(b.kick):
+        return
+
+    ball = len(b.x) - 1
+    dx = b.x[ball] - b.x[:ball]
+    dy = b.y[ball] - b.y[:ball]
+    dist_sqr = dx**2 + dy**2
+    reach = b.radius[:ball] + b.radius[ball] + KICK_REACH
+    kicking = np.array(b.kick) & (dist_sqr < reach**2)
+    if not kicking.any():
+        return
+
+    # The closer it is, the stronger the kick
+    distance = np.sqrt(dist_sqr[kicking])
+    proximity = distance - b.radius[:ball][kicking] - b.radius[ball]
+    kick_force = MIN_KICK_FORCE + DELTA_KICK_FORCE * (1 - proximity / KICK_REACH)
+    impulse_x = (kick_force * dx[kicking] / distance).tolist()
+    impulse_y = (kick_force * dy[kicking] / distance).tolist()
+
+    # Added one by one, in player order, like server_loop.handle_kicks
+    for ix, iy in zip(impulse_x, impulse_y):
+        b.vx[ball] += ix
+        b.vy[ball] += iy
+
+    for i in np.flatnonzero(kicking).tolist():
+        b.players[i].kick_locked = True
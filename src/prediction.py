@@ -0,0 +1,229 @@
+import math
+import server_loop as loop
+from collections import deque
+from snapshot import TEAMS, Snapshot, decode_name, id_to_bytes, to_state
+from state import MatchState, Player, PLAYER_AREA_TL_X, PLAYER_AREA_TL_Y, PLAYER_AREA_BR_X, PLAYER_AREA_BR_Y
+
+
+# Atraso com que a bola e os outros jogadores são desenhados, em segundos.
+# Chega para ter sempre dois snapshots entre os quais interpolar, mesmo com
+# algum jitter na rede.
+INTERPOLATION_DELAY = 0.1
+
+# Snapshots usados para estimar o relógio do servidor, 2 s a 60 por segundo
+CLOCK_SAMPLES = 120
+
+# Movimentos maiores do que isto entre dois snapshots (golos, reinícios) não
+# são interpolados nem suavizados, salta-se logo para a nova posição
+SNAP_DISTANCE = 100
+
+# Fração do erro de previsão corrigida em cada tick
+CORRECTION_RATE = 0.2
+
+# Ticks que se prevêem no máximo à frente do último snapshot
+MAX_PREDICTED_TICKS = 30
+
+PLAYER_AREA_COORDS = (PLAYER_AREA_TL_X, PLAYER_AREA_TL_Y, PLAYER_AREA_BR_X, PLAYER_AREA_BR_Y)
+PLAYING = (MatchState.PLAYING.value, MatchState.OVERTIME.value)
+
+
+class SnapshotBuffer:
+    """Buffer de jitter: guarda os snapshots recebidos e dá o estado
+    interpolado um pouco no passado, para o movimento ser suave mesmo que os
+    snapshots cheguem a intervalos irregulares."""
+
+    def __init__(self, tick_rate):
+        self.dt = 1 / tick_rate
+        self.snapshots = deque()
+        # Hora de chegada menos a hora a que o servidor gerou o snapshot. O
+        # relógio do servidor não é conhecido, por isso usa-se o menor valor
+        # recente, o do snapshot que chegou mais depressa.
+        self.offsets = deque(maxlen=CLOCK_SAMPLES)
+        self.offset = 0.0
+        # Ticks entre snapshots, 3 para espectadores a 20 por segundo
+        self.interval = 1.0
+
+    def add(self, snapshot, now):
+        if self.snapshots:
+            if snapshot.tick <= self.snapshots[-1].tick:
+                return
+            self.interval += 0.1 * (snapshot.tick - self.snapshots[-1].tick - self.interval)
+        self.snapshots.append(snapshot)
+        self.offsets.append(now - snapshot.tick * self.dt)
+        self.offset = min(self.offsets)
+
+    def latest(self):
+        return self.snapshots[-1] if self.snapshots else None
+
+    def server_tick(self, now):
+        # Tick mais recente do servidor que já podia ter chegado
+        return (now - self.offset) / self.dt
+
+    def interpolated(self, now):
+        if not self.snapshots:
+            return None
+
+        delay = max(INTERPOLATION_DELAY / self.dt, 2 * self.interval)
+        render_tick = self.server_tick(now) - delay
+
+        # Os snapshots anteriores ao par que rodeia o tick desenhado já não
+        # são precisos
+        while len(self.snapshots) > 2 and self.snapshots[1].tick <= render_tick:
+            self.snapshots.popleft()
+
+        older = self.snapshots[0]
+        if len(self.snapshots) == 1 or render_tick <= older.tick:
+            return older
+        newer = self.snapshots[1]
+        if render_tick >= newer.tick:
+            # Sem snapshots novos, manter o último em vez de adivinhar
+            return newer
+        return interpolate(older, newer, (render_tick - older.tick) / (newer.tick - older.tick))
+
+
+def interpolate(older, newer, t):
+    players = {}
+    for slot, player in newer.players.items():
+        old = older.players.get(slot)
+        if old is not None:
+            x, y = lerp_position(old[4], old[5], player[4], player[5], t)
+            player = player[:4] + (x, y) + player[6:]
+        players[slot] = player
+
+    ball = newer.ball
+    x, y = lerp_position(older.ball[0], older.ball[1], ball[0], ball[1], t)
+    return Snapshot(newer.tick, newer.match, (x, y) + ball[2:], players)
+
+
+def lerp_position(x0, y0, x1, y1, t):
+    if math.hypot(x1 - x0, y1 - y0) > SNAP_DISTANCE:
+        return x1, y1
+    return x0 + (x1 - x0) * t, y0 + (y1 - y0) * t
+
+
+class Predictor:
+    """Prevê o movimento do jogador local com as mesmas regras do servidor
+    (apply_input e update_position), sem esperar pela resposta dele.
+
+    Cada input é guardado com o tick do servidor em que se espera que seja
+    aplicado. Quando chega um snapshot, o jogador volta à posição do servidor
+    e os inputs que o servidor ainda não tinha aplicado são repetidos. A
+    diferença para a previsão anterior é desfeita aos poucos, para o jogador
+    não saltar no ecrã.
+    """
+
+    def __init__(self, player_id, tick_rate):
+        self.id_bytes = id_to_bytes(player_id)
+        self.scale = loop.BASE_TICK_RATE / tick_rate
+        self.player = None
+        # Tick do servidor do último input previsto
+        self.tick = 0
+        self.history = deque()
+        # Ticks entre o servidor gerar um snapshot e aplicar o input enviado
+        # quando o recebemos, ou seja o RTT em ticks
+        self.lead = None
+        self.last_baseline = 0
+        self.error_x = 0.0
+        self.error_y = 0.0
+
+    def measure(self, snapshot):
+        # O primeiro snapshot codificado contra um baseline novo foi gerado
+        # logo depois de o servidor receber o input que confirmou esse
+        # baseline, e esse input foi enviado quando o baseline chegou
+        baseline_tick = snapshot.baseline_tick
+        if baseline_tick is None or baseline_tick <= self.last_baseline:
+            return
+        self.last_baseline = baseline_tick
+        sample = snapshot.tick - baseline_tick
+        self.lead = sample if self.lead is None else self.lead + 0.1 * (sample - self.lead)
+
+    def reconcile(self, snapshot):
+        authoritative = None
+        for player in snapshot.players.values():
+            if player[0] == self.id_bytes:
+                authoritative = player
+                break
+
+        if authoritative is None or snapshot.match[0] not in PLAYING or self.lead is None:
+            # Sem previsão: fora de jogo o servidor ignora os inputs
+            self.player = None
+            self.history.clear()
+            return
+
+        _, team, name, _, x, y, vx, vy = authoritative
+        player = Player(decode_name(name), TEAMS[team], x, y, vx, vy)
+        if self.player is None or self.tick <= snapshot.tick:
+            # Primeira previsão, ou o servidor já vai à frente
+            self.player = player
+            self.tick = snapshot.tick
+            self.history.clear()
+            self.error_x = self.error_y = 0.0
+            return
+
+        player.kick_locked = self.player.kick_locked
+        while self.history and self.history[0][0] <= snapshot.tick:
+            self.history.popleft()
+        for _, input in self.history:
+            self.advance(player, input)
+
+        error_x = self.player.x + self.error_x - player.x
+        error_y = self.player.y + self.error_y - player.y
+        if math.hypot(error_x, error_y) > SNAP_DISTANCE:
+            error_x = error_y = 0.0
+        self.error_x = error_x
+        self.error_y = error_y
+        self.player = player
+
+    def predict(self, input, server_tick):
+        if self.player is None:
+            return None
+
+        # Os inputs enviados agora só chegam ao servidor daqui a um RTT
+        target = int(server_tick + self.lead)
+        self.tick = max(self.tick, target - MAX_PREDICTED_TICKS)
+        while self.tick < target:
+            self.tick += 1
+            self.history.append((self.tick, input))
+            self.advance(self.player, input)
+            self.error_x *= 1 - CORRECTION_RATE
+            self.error_y *= 1 - CORRECTION_RATE
+
+        player = Player(self.player.name, self.player.team, self.player.x + self.error_x, self.player.y + self.error_y, self.player.vx, self.player.vy)
+        player.kick = self.player.kick
+        return player
+
+    def advance(self, player, input):
+        loop.apply_input(player, input, self.scale)
+        loop.update_position(player, self.scale)
+        loop.bounce_off_edges(player, PLAYER_AREA_COORDS)
+
+
+class View:
+    """O que o cliente desenha em cada frame: o estado interpolado, com o
+    jogador local previsto."""
+
+    def __init__(self, player_id, tick_rate):
+        self.player_id = player_id
+        self.buffer = SnapshotBuffer(tick_rate)
+        self.predictor = Predictor(player_id, tick_rate) if player_id is not None else None
+
+    def receive(self, received):
+        # Snapshots com a hora a que chegaram
+        for arrival, snapshot in received:
+            self.buffer.add(snapshot, arrival)
+            if self.predictor is not None:
+                self.predictor.measure(snapshot)
+        if received and self.predictor is not None:
+            self.predictor.reconcile(self.buffer.latest())
+
+    def state(self, input, now):
+        snapshot = self.buffer.interpolated(now)
+        if snapshot is None:
+            return None
+        state = to_state(snapshot)
+
+        if self.predictor is not None:
+            player = self.predictor.predict(input, self.buffer.server_tick(now))
+            if player is not None and self.player_id in state.players:
+                state.players[self.player_id] = player
+        return state
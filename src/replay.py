@@ -0,0 +1,445 @@
+import argparse
+import contextlib
+import itertools
+import mmap
+import os
+import re
+import struct
+import time
+import server_loop as loop
+import snapshot
+from input import input_to_keys, keys_to_input
+from state import MatchState, Player, State, Team
+
+
+# Replays are a log of records, all little-endian:
+#
+#   header:   magic, version, tick rate, physics backend
+#   keyframe: the whole dynamic state before a tick, in full precision
+#   step:     the number of ticks of a server step and the inputs applied
+#             on all of them, as (slot, keys) pairs
+#   repeat:   a number of steps the same as the last one
+#
+# The simulation is deterministic, so any tick is rebuilt by restoring the
+# keyframe before it and simulating forward. Keyframes are written every
+# KEYFRAME_INTERVAL ticks and whenever the state changed outside the
+# simulation, when players join or leave or the match is started, paused or
+# changed from the interpreter. Players are referred to by slot numbers
+# given out in the keyframes.
+#
+# Every keyframe is also appended to an index, a separate file of (tick,
+# offset) pairs, so a reader finds the keyframe before any tick with a
+# binary search over the memory mapped index.
+MAGIC = b"DJBR"
+REPLAY_VERSION = 1
+
+HEADER = struct.Struct("<4sBHB")
+RECORD_TYPE = struct.Struct("<B")
+KEYFRAME_HEADER = struct.Struct("<IB")
+KEYFRAME_MATCH = struct.Struct("<BBddddiiiH")
+KEYFRAME_BALL = struct.Struct("<4d")
+KEYFRAME_PLAYER = struct.Struct("<H16sBB4dB")
+STEP_HEADER = struct.Struct("<BB")
+STEP_INPUT = struct.Struct("<HB")
+REPEAT_COUNT = struct.Struct("<H")
+INDEX_ENTRY = struct.Struct("<IQ")
+
+RECORD_KEYFRAME = 1
+RECORD_STEP = 2
+RECORD_REPEAT = 3
+
+FLAG_FORCED = 1
+
+PLAYER_KICK = 1
+PLAYER_KICK_LOCKED = 2
+
+# Ten seconds at 60 Hz: seeking never simulates more than this many ticks
+KEYFRAME_INTERVAL = 600
+
+PHYSICS = ["python", "numpy"]
+TEAMS = {team.value: team for team in Team}
+MATCH_STATES = {match_state.value: match_state for match_state in MatchState}
+
+
+class ReplayError(Exception):
+    pass
+
+
+def signature(state):
+    # What may change between ticks without going through simulate()
+    match_manager = state.match_manager
+    return (
+        tuple(state.players),
+        match_manager.state,
+        match_manager.state_before_pause,
+        match_manager.time_remaining,
+        match_manager.match_duration,
+        match_manager.break_duration,
+        state.score_red,
+        state.score_blue,
+    )
+
+
+class Recorder:
+    """Writes the replay of one room, as its steps are simulated.
+
+    server_loop.tick calls step() instead of simulating the room itself,
+    under the room's state lock.
+    """
+
+    def __init__(self, path, tick_rate, physics="python"):
+        # Never over an existing replay, creating the file claims the name
+        # for its index too
+        self.file = open(path, "xb")
+        self.index = open(path + ".idx", "wb")
+        self.file.write(HEADER.pack(MAGIC, REPLAY_VERSION, tick_rate, PHYSICS.index(physics)))
+
+        self.slots = {}
+        self.last_keyframe = None
+        # The last step encoded, and how many steps repeated it
+        self.last_step = None
+        self.repeats = 0
+        # Signature of the state after the last tick
+        self.expected = None
+
+    def step(self, state, inputs, dt, ticks, timings=None):
+        changed = self.expected is not None and signature(state) != self.expected
+        if changed or self.last_keyframe is None or state.tick - self.last_keyframe >= KEYFRAME_INTERVAL:
+            self.write_keyframe(state, changed)
+        self.write_step(state, inputs, ticks)
+
+        for _ in range(ticks):
+            loop.simulate(state, inputs, dt, timings)
+        self.expected = signature(state)
+
+    def write_keyframe(self, state, forced):
+        self.flush_repeats()
+        self.last_step = None
+        self.last_keyframe = state.tick
+
+        match_manager = state.match_manager
+        ball = state.ball
+        parts = [
+            RECORD_TYPE.pack(RECORD_KEYFRAME),
+            KEYFRAME_HEADER.pack(state.tick, FLAG_FORCED if forced else 0),
+            KEYFRAME_MATCH.pack(
+                match_manager.state.value,
+                match_manager.state_before_pause.value if match_manager.state_before_pause else 0,
+                match_manager.match_duration,
+                match_manager.break_duration,
+                match_manager.overtime_duration,
+                match_manager.time_remaining,
+                state.score_red,
+                state.score_blue,
+                state.clock,
+                len(state.players),
+            ),
+            KEYFRAME_BALL.pack(ball.x, ball.y, ball.vx, ball.vy),
+        ]
+        for player_id, player in state.players.items():
+            if player_id not in self.slots:
+                self.slots[player_id] = len(self.slots) & 0xFFFF
+            name = player.name.encode()[:255]
+            flags = (PLAYER_KICK if player.kick else 0) | (PLAYER_KICK_LOCKED if player.kick_locked else 0)
+            parts.append(KEYFRAME_PLAYER.pack(self.slots[player_id], snapshot.id_to_bytes(player_id), player.team.value, flags, player.x, player.y, player.vx, player.vy, len(name)))
+            parts.append(name)
+
+        offset = self.file.tell()
+        self.file.write(b"".join(parts))
+        # The index only ever points to data that is on disk
+        self.file.flush()
+        self.index.write(INDEX_ENTRY.pack(state.tick, offset))
+        self.index.flush()
+
+    def write_step(self, state, inputs, ticks):
+        encoded = [
+            STEP_INPUT.pack(self.slots[player_id], input_to_keys(input))
+            for player_id, input in inputs.items()
+            if player_id in state.players
+        ]
+        encoded = STEP_HEADER.pack(ticks, len(encoded)) + b"".join(encoded)
+        if encoded == self.last_step and self.repeats < 0xFFFF:
+            self.repeats += 1
+            return
+
+        self.flush_repeats()
+        self.file.write(RECORD_TYPE.pack(RECORD_STEP) + encoded)
+        self.last_step = encoded
+
+    def flush_repeats(self):
+        if self.repeats:
+            self.file.write(RECORD_TYPE.pack(RECORD_REPEAT) + REPEAT_COUNT.pack(self.repeats))
+            self.repeats = 0
+
+    def close(self):
+        self.flush_repeats()
+        self.file.close()
+        self.index.close()
+
+
+def replay_path(directory, room_name, attempt=0):
+    # Room names come from the clients
+    safe_name = re.sub(r"[^\w-]", "_", room_name)
+    suffix = f"-{attempt}" if attempt else ""
+    return os.path.join(directory, f"{safe_name}-{time.strftime('%Y%m%d-%H%M%S')}{suffix}.replay")
+
+
+def create_recorder(directory, room_name, tick_rate, physics="python"):
+    # A room recreated within the same second, or by another worker, gets
+    # the next free name instead of overwriting the earlier replay
+    for attempt in itertools.count():
+        try:
+            return Recorder(replay_path(directory, room_name, attempt), tick_rate, physics)
+        except FileExistsError:
+            continue
+
+
+def read_keyframe(data, offset):
+    tick, flags = KEYFRAME_HEADER.unpack_from(data, offset)
+    offset += KEYFRAME_HEADER.size
+
+    state = State()
+    state.tick = tick
+    match_manager = state.match_manager
+    (
+        match_state,
+        before_pause,
+        match_manager.match_duration,
+        match_manager.break_duration,
+        match_manager.overtime_duration,
+        match_manager.time_remaining,
+        state.score_red,
+        state.score_blue,
+        state.clock,
+        player_count,
+    ) = KEYFRAME_MATCH.unpack_from(data, offset)
+    offset += KEYFRAME_MATCH.size
+    match_manager.state = MATCH_STATES[match_state]
+    match_manager.state_before_pause = MATCH_STATES.get(before_pause)
+
+    ball = state.ball
+    ball.x, ball.y, ball.vx, ball.vy = KEYFRAME_BALL.unpack_from(data, offset)
+    offset += KEYFRAME_BALL.size
+
+    slots = {}
+    for _ in range(player_count):
+        slot, id_bytes, team, player_flags, x, y, vx, vy, name_length = KEYFRAME_PLAYER.unpack_from(data, offset)
+        offset += KEYFRAME_PLAYER.size
+        name = bytes(data[offset:offset + name_length]).decode(errors="replace")
+        offset += name_length
+
+        player = Player(name, TEAMS[team], x, y, vx, vy)
+        player.kick = bool(player_flags & PLAYER_KICK)
+        player.kick_locked = bool(player_flags & PLAYER_KICK_LOCKED)
+        player_id = snapshot.bytes_to_id(id_bytes)
+        state.players[player_id] = player
+        slots[slot] = player_id
+
+    return state, slots, bool(flags & FLAG_FORCED), offset
+
+
+def same_state(a, b):
+    # Everything the simulation depends on, the clock aside
+    def motion(state):
+        circles = [(c.x, c.y, c.vx, c.vy) for c in loop.moving_circles(state)]
+        kicks = [(p.kick, p.kick_locked) for p in state.players.values()]
+        return circles, kicks, state.score_red, state.score_blue, state.match_manager.state, state.match_manager.time_remaining
+
+    return list(a.players) == list(b.players) and motion(a) == motion(b)
+
+
+class Replay:
+    """Reads a replay written by Recorder, memory mapped.
+
+    Ticks are rebuilt with server_loop.simulate, so loop.physics has to be
+    the backend the replay was recorded with (see the physics attribute).
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.data) < HEADER.size:
+            raise ReplayError(f"{path} is not a replay")
+        magic, version, self.tick_rate, physics = HEADER.unpack_from(self.data)
+        if magic != MAGIC:
+            raise ReplayError(f"{path} is not a replay")
+        if version != REPLAY_VERSION:
+            raise ReplayError(f"Unsupported replay version {version}")
+        self.physics = PHYSICS[physics]
+
+        # The index may be missing or end in a partial entry if the server
+        # didn't shut down cleanly, then it is rebuilt from the log
+        try:
+            with open(path + ".idx", "rb") as f:
+                self.index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            self.index = build_index(self.data)
+        self.keyframe_count = len(self.index) // INDEX_ENTRY.size
+
+        # Ticks where a keyframe didn't match the simulation, see play()
+        self.mismatches = []
+
+    def keyframe(self, i):
+        return INDEX_ENTRY.unpack_from(self.index, i * INDEX_ENTRY.size)
+
+    def keyframe_before(self, tick):
+        # Offset of the last keyframe at or before the tick
+        low, high = 0, self.keyframe_count
+        while low < high:
+            middle = (low + high) // 2
+            if self.keyframe(middle)[0] <= tick:
+                low = middle + 1
+            else:
+                high = middle
+        return self.keyframe(max(0, low - 1))[1]
+
+    @property
+    def first_tick(self):
+        return self.keyframe(0)[0]
+
+    def records(self, offset):
+        # Parsed records from the offset on, stopping at a truncated one
+        data = self.data
+        try:
+            while offset < len(data):
+                (kind,) = RECORD_TYPE.unpack_from(data, offset)
+                offset += RECORD_TYPE.size
+                if kind == RECORD_KEYFRAME:
+                    state, slots, forced, offset = read_keyframe(data, offset)
+                    yield kind, (state, slots, forced)
+                elif kind == RECORD_STEP:
+                    ticks, count = STEP_HEADER.unpack_from(data, offset)
+                    offset += STEP_HEADER.size
+                    if offset + count * STEP_INPUT.size > len(data):
+                        return
+                    inputs = [STEP_INPUT.unpack_from(data, offset + i * STEP_INPUT.size) for i in range(count)]
+                    offset += count * STEP_INPUT.size
+                    yield kind, (ticks, inputs)
+                elif kind == RECORD_REPEAT:
+                    (count,) = REPEAT_COUNT.unpack_from(data, offset)
+                    offset += REPEAT_COUNT.size
+                    yield kind, count
+                else:
+                    raise ReplayError(f"Unknown record type {kind} at offset {offset - 1}")
+        except struct.error:
+            return
+
+    def play(self, start=None, verify=False):
+        """Yields the state at every tick from start (the first tick by
+        default) to the end. The same State is updated between ticks.
+
+        With verify, every periodic keyframe met on the way is compared with
+        the simulated state, and the ticks where they differ are added to
+        mismatches.
+        """
+        start = self.first_tick if start is None else start
+        dt = 1 / self.tick_rate
+        state = None
+        slots = {}
+        ticks = 0
+        inputs = {}
+
+        with open(os.devnull, "w") as devnull:
+            for kind, value in self.records(self.keyframe_before(start)):
+                if kind == RECORD_KEYFRAME:
+                    keyframe_state, keyframe_slots, forced = value
+                    if verify and state is not None and not forced and not same_state(state, keyframe_state):
+                        self.mismatches.append(keyframe_state.tick)
+                    state = keyframe_state
+                    slots.update(keyframe_slots)
+                    continue
+
+                if kind == RECORD_STEP:
+                    ticks, step_inputs = value
+                    inputs = {slots[slot]: keys_to_input(keys) for slot, keys in step_inputs}
+                    steps = 1
+                else:
+                    steps = value
+
+                for _ in range(steps):
+                    for _ in range(ticks):
+                        if state.tick >= start:
+                            yield state
+                        # The match manager announces its state changes
+                        with contextlib.redirect_stdout(devnull):
+                            loop.simulate(state, inputs, dt)
+                    # Like server_loop.tick, once the step's snapshot is out
+                    loop.clear_kicks(state)
+
+        if state is not None and state.tick >= start:
+            yield state
+
+    def seek(self, tick):
+        for state in self.play(tick):
+            return state
+        raise IndexError(f"Tick {tick} is past the end of the replay")
+
+
+def build_index(data):
+    entries = []
+    offset = HEADER.size
+    try:
+        while offset < len(data):
+            (kind,) = RECORD_TYPE.unpack_from(data, offset)
+            if kind == RECORD_KEYFRAME:
+                (tick, _) = KEYFRAME_HEADER.unpack_from(data, offset + RECORD_TYPE.size)
+                entries.append(INDEX_ENTRY.pack(tick, offset))
+                _, _, _, offset = read_keyframe(data, offset + RECORD_TYPE.size)
+            elif kind == RECORD_STEP:
+                _, count = STEP_HEADER.unpack_from(data, offset + RECORD_TYPE.size)
+                offset += RECORD_TYPE.size + STEP_HEADER.size + count * STEP_INPUT.size
+            elif kind == RECORD_REPEAT:
+                offset += RECORD_TYPE.size + REPEAT_COUNT.size
+            else:
+                break
+    except struct.error:
+        pass
+    if not entries:
+        raise ReplayError("The replay has no keyframe")
+    return b"".join(entries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Plays a DojoBall replay headless, as fast as possible")
+    parser.add_argument("replay")
+    parser.add_argument("-s", "--start", type=int, help="Tick to start from (default: the first)")
+    parser.add_argument("-e", "--end", type=int, help="Tick to stop at (default: the last)")
+    parser.add_argument("--every", type=int, default=0, help="Print the state every this many ticks")
+    parser.add_argument("--verify", action="store_true", help="Check the simulation against every keyframe on the way")
+    args = parser.parse_args()
+
+    replay = Replay(args.replay)
+    if replay.physics == "numpy":
+        import physics_numpy
+        loop.physics = physics_numpy.move
+
+    start_time = time.perf_counter()
+    first = None
+    score = None
+    for state in replay.play(args.start, args.verify):
+        if args.end is not None and state.tick > args.end:
+            break
+        if first is None:
+            first = state.tick
+            print(f"Tick {state.tick}: {len(state.players)} players, {state.match_manager.state.name.lower()}")
+        if (state.score_red, state.score_blue) != score:
+            if score is not None:
+                print(f"Tick {state.tick}: red {state.score_red} - {state.score_blue} blue")
+            score = (state.score_red, state.score_blue)
+        if args.every and state.tick % args.every == 0:
+            print(f"Tick {state.tick}: {state.match_manager.state.name.lower()}, {state.match_manager.time_remaining:.1f} s left, ball at ({state.ball.x:.0f}, {state.ball.y:.0f})")
+        last = state.tick
+    elapsed = time.perf_counter() - start_time
+
+    if first is None:
+        print("Nothing to play")
+        return
+    ticks = last - first
+    print(f"Played ticks {first} to {last} in {elapsed:.2f} s, {ticks / replay.tick_rate / max(elapsed, 1e-9):.0f}x real time")
+    print(f"{os.path.getsize(args.replay) / max(1, ticks):.1f} bytes per tick, {replay.keyframe_count} keyframes")
+    if args.verify:
+        print(f"Keyframes not matching the simulation: {replay.mismatches or 'none'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+import snapshot
+from broadcast import Broadcaster, SpectatorFeed
+from state import Player, State, SCREEN_WIDTH, SCREEN_HEIGHT, PLAYER_AREA_HEIGHT, PLAYER_AREA_TL_Y, PLAYER_AREA_BR_X, PLAYER_AREA_TL_X, Team
+from threading import Lock
+
+
+DEFAULT_ROOM = "main"
+
+# Rooms are filled up to this many players before new players are sent to
+# another room, when they don't pick one themselves
+MAX_PLAYERS_PER_ROOM = 8
+MAX_ROOMS = 64
+
+
+class Room:
+    """One independent match: its state, the last input of each player and
+    subscribers."""
+
+    def __init__(self, name):
+        self.name = name
+        self.state = State()
+        self.state.ball.x = SCREEN_WIDTH / 2
+        self.state.ball.y = SCREEN_HEIGHT / 2
+        self.inputs = {}
+        self.state_lock = Lock()
+        self.broadcaster = Broadcaster()
+        self.spectators = SpectatorFeed(self.broadcaster)
+        # replay.Recorder writing this room's ticks, if any
+        self.recorder = None
+        # Connections given this room by RoomManager and not released yet
+        self.members = 0
+
+    def player_count(self):
+        return len(self.state.players)
+
+    def teams(self):
+        with self.state_lock:
+            players_blue = [p.name for p in self.state.players.values() if p.team == Team.BLUE]
+            players_red = [p.name for p in self.state.players.values() if p.team == Team.RED]
+        return {"blue": players_blue, "red": players_red}
+
+    def is_name_valid(self, name):
+        with self.state_lock:
+            return name not in [p.name for p in self.state.players.values()]
+
+    def is_team_valid(self, team):
+        with self.state_lock:
+            number_players_blue = len([p.name for p in self.state.players.values() if p.team == Team.BLUE])
+            number_players_red = len([p.name for p in self.state.players.values() if p.team == Team.RED])
+        # Allow joining if the difference in team sizes would not exceed 1
+        return abs((number_players_blue + (1 if team == Team.BLUE else 0)) - (number_players_red + (1 if team == Team.RED else 0))) <= 1
+
+    def join(self, player_id, name, team):
+        print(f"{name} joined on team {team} in room {self.name}")
+
+        with self.state_lock:
+            # Initialize position for new player
+            if player_id not in self.state.players:
+                if team == Team.RED:
+                    self.state.players[player_id] = Player(name, team, PLAYER_AREA_TL_X + 45, PLAYER_AREA_TL_Y + PLAYER_AREA_HEIGHT / 2)
+                else:
+                    self.state.players[player_id] = Player(name, team, PLAYER_AREA_BR_X - 45, PLAYER_AREA_TL_Y + PLAYER_AREA_HEIGHT / 2)
+
+    def leave(self, player_id):
+        with self.state_lock:
+            if player_id in self.state.players:
+                print(f"{self.state.players[player_id].name} left room {self.name}")
+                # Remove client data on disconnect
+                del self.state.players[player_id]
+                snapshot.release_slot(player_id)
+            if player_id in self.inputs:
+                del self.inputs[player_id]
+
+
+class RoomManager:
+    """Every room of a server. Rooms are created when a player asks for one
+    and removed, except the default room, once nobody is in them.
+
+    A room is held from the moment a connection is given it until release(),
+    handshake included, so it can't be removed under a player still picking
+    a name.
+    """
+
+    def __init__(self, default_room=DEFAULT_ROOM):
+        self.rooms = {}
+        self.default_room = default_room
+        self.lock = Lock()
+        self.room_listeners = []
+        if default_room:
+            self.create(default_room)
+
+    def create(self, name):
+        with self.lock:
+            room, created = self.get_or_create(name)
+        if created:
+            self.notify_created(room)
+        return room
+
+    def get_or_create(self, name):
+        # With the lock held, returns the room and whether it is new
+        if name in self.rooms:
+            return self.rooms[name], False
+        if len(self.rooms) >= MAX_ROOMS:
+            return None, False
+        room = self.rooms[name] = Room(name)
+        return room, True
+
+    def add_room_listener(self, listener, removed=None):
+        # listener is called with every room, existing or created later, and
+        # removed with every room removed after that
+        self.room_listeners.append((listener, removed))
+        for room in self.all():
+            listener(room)
+
+    def notify_created(self, room):
+        for listener, _ in self.room_listeners:
+            listener(room)
+
+    def get(self, name):
+        return self.rooms.get(name)
+
+    def all(self):
+        with self.lock:
+            return list(self.rooms.values())
+
+    def assign(self, name=None):
+        # Join the room asked for, creating it if needed, or else the
+        # fullest room that still has space. Held until release().
+        created = False
+        with self.lock:
+            room = None
+            if name:
+                room, created = self.get_or_create(name)
+
+            if room is None:
+                rooms = [room for room in self.rooms.values() if room.player_count() < MAX_PLAYERS_PER_ROOM]
+                if rooms:
+                    room = max(rooms, key=Room.player_count)
+                else:
+                    number = len(self.rooms) + 1
+                    while f"room-{number}" in self.rooms:
+                        number += 1
+                    room, created = self.get_or_create(f"room-{number}")
+
+            if room is None:
+                return None
+            room.members += 1
+
+        if created:
+            self.notify_created(room)
+        return room
+
+    def watch(self, name=None):
+        # The room a spectator asked for, or the busiest one, held until
+        # release()
+        with self.lock:
+            if name:
+                room = self.rooms.get(name)
+            else:
+                room = max(self.rooms.values(), key=Room.player_count, default=None)
+            if room is not None:
+                room.members += 1
+        return room
+
+    def release(self, room):
+        # A player or spectator given the room left, remove it if it was the last
+        with self.lock:
+            room.members -= 1
+            if room.members > 0 or room.name == self.default_room or self.rooms.get(room.name) is not room:
+                return
+            del self.rooms[room.name]
+
+        print(f"Room {room.name} closed")
+        for _, removed in self.room_listeners:
+            if removed is not None:
+                removed(room)
+
+    def summary(self):
+        return {room.name: room.teams() for room in self.all()}
@@ -1,24 +1,37 @@
 import argparse
-import copy
+import asyncio
+import atexit
+import broadcast
+import math
+import metrics
+import multiprocessing
+import os
+import socket
 import socketserver
 import pygame
 import pickle
 import readline
+import secrets
 import server_loop as loop
+import snapshot
+import time
 import uuid
-from state import Player, State, SCREEN_WIDTH, SCREEN_HEIGHT, PLAYER_AREA_HEIGHT, PLAYER_AREA_TL_Y, PLAYER_AREA_BR_X, PLAYER_AREA_TL_X, Team, MatchManager
-from threading import Condition, Lock, Thread
+from broadcast import SnapshotQueue, QUEUE_SIZE
+from input import INPUT_MESSAGE_SIZE, INPUT_TOKEN_SIZE, InputDecoder
+from replay import create_recorder
+from room import DEFAULT_ROOM, MAX_PLAYERS_PER_ROOM, RoomManager
+from udp_server import UDPServer
+from threading import Lock, Thread
 from hot_reloading import hot_cycle
 
 
-state_lock = Lock()
-send_cond = Condition()
+rooms = RoomManager()
+udp_server = None
 
 clients = []
-inputs = {}
-last_state = [None]
 
-state = State()
+# Default room, kept at hand for the interpreter
+state = rooms.get(DEFAULT_ROOM).state
 
 
 def main():
@@ -32,246 +45,899 @@ def main():
     parser.add_argument(
         "-p", "--port", type=int, default=12345, help="Server port (default: 12345)"
     )
+    parser.add_argument(
+        "--asyncio",
+        action="store_true",
+        help="Serve connections from an asyncio event loop instead of one thread per client.",
+    )
+    parser.add_argument(
+        "--udp",
+        action="store_true",
+        help="Also accept inputs and send snapshots over UDP, on the same port.",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=0,
+        help="Tick rooms in this many worker processes, one per core, behind a single port.",
+    )
+    parser.add_argument(
+        "-t",
+        "--tick-rate",
+        type=int,
+        default=loop.TICK_RATE,
+        help=f"Simulation ticks per second (default: {loop.TICK_RATE})",
+    )
+    parser.add_argument(
+        "--physics",
+        choices=["python", "numpy"],
+        default="python",
+        help="Physics backend, both give the same results. numpy only pays off from about 40 players in a room, python is faster below that (default: python)",
+    )
+    parser.add_argument(
+        "-m",
+        "--metrics-port",
+        type=int,
+        help="Serve tick and send timings in plain text at http://127.0.0.1:PORT/metrics. With --workers, worker N serves them on PORT + N.",
+    )
+    parser.add_argument(
+        "-r",
+        "--record",
+        metavar="DIRECTORY",
+        help="Record a replay of every room in this directory, play them with replay.py.",
+    )
+    parser.add_argument(
+        "-s",
+        "--spectator-rate",
+        type=float,
+        default=broadcast.SPECTATOR_RATE,
+        help=f"Snapshots per second sent to spectators (default: {broadcast.SPECTATOR_RATE})",
+    )
     args = parser.parse_args()
 
     debug: bool = args.debug
     port: int = args.port
 
-    pygame.init()
+    broadcast.SPECTATOR_RATE = args.spectator_rate
+
+    if args.physics == "numpy":
+        try:
+            import physics_numpy
+        except ImportError:
+            parser.error("--physics numpy needs NumPy, install it with pip install numpy")
+        loop.physics = physics_numpy.move
 
-    clock = pygame.time.Clock()
+    if args.workers:
+        if args.debug or args.asyncio or args.udp:
+            parser.error("--workers can't be combined with --debug, --asyncio or --udp")
+        serve_sharded(port, args.workers, args.tick_rate, args.metrics_port, args.record)
+        return
+
+    pygame.init()
 
-    state.ball.x = SCREEN_WIDTH / 2
-    state.ball.y = SCREEN_HEIGHT / 2
+    timestep = loop.Timestep(args.tick_rate)
+    start_metrics(args.metrics_port, timestep)
+    if args.record:
+        start_recording(rooms, args.record, args.tick_rate)
 
     game_cycle_thread = Thread(
         target=game_cycle,
-        args=(debug, state, clock, inputs, state_lock, send_cond, last_state),
+        args=(debug, rooms, timestep),
         daemon=True,
     )
     game_cycle_thread.start()
 
-    interpreter_thread = Thread(target=interpreter, args=(state,), daemon=True)
+    interpreter_thread = Thread(target=interpreter, args=(run_command, rooms), daemon=True)
     interpreter_thread.start()
 
-    with socketserver.ThreadingTCPServer(("0.0.0.0", port), GameTCPHandler) as server:
-        print("Server started, waiting for messages...")
-        server.serve_forever()
+    if args.udp:
+        global udp_server
+        udp_server = UDPServer(port, rooms)
+        udp_server.start()
+
+    if args.asyncio:
+        asyncio.run(serve_async(port))
+    else:
+        with GameTCPServer(("0.0.0.0", port), GameTCPHandler) as server:
+            print("Server started, waiting for messages...")
+            server.serve_forever()
 
     game_cycle_thread.join()
     interpreter_thread.join()
 
 
-def game_cycle(debug, state, clock, inputs, state_lock, send_cond, last_state):
+def start_metrics(port, timestep):
+    metrics.gauge("dropped_ticks", "Ticks skipped because the server fell behind", lambda: timestep.dropped)
+    metrics.gauge("rooms", "Rooms open", lambda: len(rooms.all()))
+    metrics.gauge("players", "Players in every room", lambda: sum(room.player_count() for room in rooms.all()))
+    if port is not None:
+        metrics.serve(port)
+
+
+def start_recording(rooms, directory, tick_rate):
+    os.makedirs(directory, exist_ok=True)
+    physics = "python" if loop.physics is loop.move else "numpy"
+
+    def record(room):
+        room.recorder = create_recorder(directory, room.name, tick_rate, physics)
+
+    # Rooms removed when empty stop recording then
+    rooms.add_room_listener(record, stop_room_recording)
+    atexit.register(stop_recording, rooms)
+
+
+def stop_recording(rooms):
+    for room in rooms.all():
+        stop_room_recording(room)
+
+
+def stop_room_recording(room):
+    with room.state_lock:
+        if room.recorder is not None:
+            room.recorder.close()
+            room.recorder = None
+
+
+def game_cycle(debug, rooms, timestep):
     if debug:
         # Debug mode
         print("Debug mode enabled. Hot reloading is active.")
-        hot_cycle(
-            loop.step, state, clock, inputs, state_lock, send_cond, last_state
-        )
+        hot_cycle(loop.step, rooms, timestep)
     else:
         # Normal mode
-        while loop.step(state, clock, inputs, state_lock, send_cond, last_state):
+        while loop.step(rooms, timestep):
             pass
 
 
-def interpreter(state):
+# Match commands and how many arguments they take before the room name
+ROOM_COMMANDS = {
+    "start_match": 1,
+    "pause_match": 1,
+    "resume_match": 1,
+    "set_match_time": 2,
+    "set_break_time": 2,
+}
+
+
+def interpreter(run, target):
     while True:
-        line = input(">>> ")
-        if line.startswith("start_match"):
-            state.match_manager.start_match()
-        elif line.startswith("pause_match"):
-            state.match_manager.pause_match()
-            print("Match paused")
-        elif line.startswith("resume_match"):
-            state.match_manager.resume_match()
-            print("Match resumed")
-        elif line.startswith("set_match_time"):
-            _, seconds = line.split()
-            state.match_manager.set_match_time(int(seconds))
-            print(f"Match time set to {seconds} seconds")
-        elif line.startswith("set_break_time"):
-            _, seconds = line.split()
-            state.match_manager.set_break_time(int(seconds))
-            print(f"Break time set to {seconds} seconds")
-        else:
-            exec(line)
+        run(target, input(">>> "))
+
+
+def command_room(args):
+    # Match commands apply to the default room, or to the room named
+    # after their arguments
+    if args and args[0] in ROOM_COMMANDS and len(args) > ROOM_COMMANDS[args[0]]:
+        return args[-1]
+    return DEFAULT_ROOM
+
+
+def run_command(rooms, line):
+    args = line.split()
+    room = rooms.get(command_room(args))
+    if room is None and args and args[0] in ROOM_COMMANDS:
+        print(f"Room {command_room(args)} doesn't exist")
+        return
+    state = room.state if room else None
+
+    if line.startswith("start_match"):
+        state.match_manager.start_match()
+    elif line.startswith("pause_match"):
+        state.match_manager.pause_match()
+        print("Match paused")
+    elif line.startswith("resume_match"):
+        state.match_manager.resume_match()
+        print("Match resumed")
+    elif line.startswith("set_match_time"):
+        seconds = args[1]
+        state.match_manager.set_match_time(int(seconds))
+        print(f"Match time set to {seconds} seconds")
+    elif line.startswith("set_break_time"):
+        seconds = args[1]
+        state.match_manager.set_break_time(int(seconds))
+        print(f"Break time set to {seconds} seconds")
+    elif line.startswith("rooms"):
+        for room in rooms.all():
+            print(f"{room.name}: {room.player_count()} players, {room.spectators.count()} spectators, {room.state.match_manager.state.name.lower()}")
+    elif line.startswith("metrics"):
+        print(metrics.report())
+    else:
+        exec(line)
 
 
 MAX_NAME_ATTEMPTS = 3
 MAX_TEAM_ATTEMPTS = 3
 
 
+def leave(room, player_id):
+    if room:
+        room.leave(player_id)
+        rooms.release(room)
+    if udp_server:
+        udp_server.remove(player_id)
+
+
+def uses_udp(player_id):
+    return udp_server is not None and udp_server.uses_udp(player_id)
+
+
+def spectated_room(choice):
+    # Spectators ask for {"spectate": room name, or None for the busiest}
+    # instead of naming the room they want to play in
+    if isinstance(choice, dict) and "spectate" in choice:
+        return choice["spectate"] or ""
+    return None
+
+
+def frame(data):
+    return len(data).to_bytes(4, "big") + data
+
+
+def send_message(sock, data):
+    sock.sendall(frame(pickle.dumps(data)))
+
+
+def receive_message(sock):
+    header = receive_exactly(sock, 4)
+    if header is None:
+        return None
+    return receive_exactly(sock, int.from_bytes(header, "big"))
+
+
+def receive_exactly_into(sock, buffer):
+    # Fills the buffer, returns False if the connection closed first
+    received = sock.recv_into(buffer)
+    if 0 < received < len(buffer):
+        view = memoryview(buffer)
+        while received < len(buffer):
+            chunk = sock.recv_into(view[received:])
+            if not chunk:
+                return False
+            received += chunk
+    return received == len(buffer)
+
+
+def receive_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data.extend(chunk)
+    return data
+
+
+class GameTCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    # Many players join at once at events, the default backlog is only 5
+    request_queue_size = 128
+
+
+def set_nodelay(sock):
+    # Inputs only go out when keys change and snapshots are pushed, so acks
+    # rarely ride on data: with Nagle's algorithm a snapshot would wait for
+    # the delayed ack of the previous one
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
 class GameTCPHandler(socketserver.BaseRequestHandler):
     def setup(self):
+        set_nodelay(self.request)
+        self.joined = False
+        self.spectating = False
+        self.room = None
+
+    def handshake(self):
+        # Part of handle(), so that finish() releases the room even if the
+        # client goes away halfway through
+
         # Assing player a unique ID
         self.player_id = str(uuid.uuid4())
-        data_bytes = pickle.dumps(self.player_id)
-        self.request.sendall(len(data_bytes).to_bytes(4, "big"))
-        self.request.sendall(data_bytes)
+        send_message(self.request, self.player_id)
+
+        # Send rooms, with their teams and players, to the client
+        send_message(self.request, {"rooms": rooms.summary()})
 
-        # Send teams and players to the client
-        with state_lock:
-            players_blue = [p.name for p in state.players.values() if p.team == Team.BLUE]
-            players_red = [p.name for p in state.players.values() if p.team == Team.RED]
+        try:
+            data = receive_message(self.request)
+        except (ConnectionResetError, ConnectionAbortedError):
+            return
+        if not data:
+            return
 
-        data_to_send = {"teams": {"blue": players_blue, "red": players_red}}
-        data_bytes = pickle.dumps(data_to_send)
-        self.request.sendall(len(data_bytes).to_bytes(4, "big"))
-        self.request.sendall(data_bytes)
+        choice = pickle.loads(data)
+        room_name = spectated_room(choice)
+        if room_name is not None:
+            self.spectate_room(room_name)
+        else:
+            self.join_room(choice)
 
-        is_name_valid = False
+    def spectate_room(self, room_name):
+        # Spectators only watch, they take no name, team or player slot
+        self.room = rooms.watch(room_name)
+        if self.room is None:
+            send_message(self.request, {'error': f"Room {room_name} doesn't exist."})
+            return
+        send_message(self.request, {"room": self.room.name, "teams": self.room.teams()})
+        self.spectating = True
+
+    def join_room(self, room_name):
+        # Place the player in the room they asked for, or any with space
+        self.room = rooms.assign(room_name)
+        if self.room is None:
+            send_message(self.request, {'error': "No room available."})
+            return
+        room_info = {"room": self.room.name, "teams": self.room.teams()}
+        if udp_server:
+            # Player ids are public, UDP input packets must carry this token
+            self.udp_token = secrets.token_bytes(INPUT_TOKEN_SIZE)
+            room_info["udp_token"] = self.udp_token
+        send_message(self.request, room_info)
+
+        name_valid = False
         name_attempts = 0
-        while not is_name_valid and name_attempts < MAX_NAME_ATTEMPTS:
+        while not name_valid and name_attempts < MAX_NAME_ATTEMPTS:
             name_attempts += 1
             try:
-                size = int.from_bytes(self.request.recv(4), "big")
-                data = self.request.recv(size)
+                data = receive_message(self.request)
             except (ConnectionResetError, ConnectionAbortedError):
                 return
             if not data:
                 return
 
+            # Verifies submited name
             name = pickle.loads(data)
+            name_valid = self.room.is_name_valid(name)
+            send_message(self.request, {'validity': name_valid})
 
-            # Verifies submited name
-            with state_lock:
-                players_blue = [p.name for p in state.players.values() if p.team == Team.BLUE]
-                players_red = [p.name for p in state.players.values() if p.team == Team.RED]
-                all_players = players_blue + players_red
-                is_name_valid = name not in all_players
-
-            data_to_send = {'validity': is_name_valid}
-            data_bytes = pickle.dumps(data_to_send)
-            self.request.sendall(len(data_bytes).to_bytes(4, 'big'))
-            self.request.sendall(data_bytes)
-
-        if not is_name_valid:
-            data_to_send = {'error': "Too many name input tries."}
-            data_bytes = pickle.dumps(data_to_send)
-            self.request.sendall(len(data_bytes).to_bytes(4, 'big'))
-            self.request.sendall(data_bytes)
+        if not name_valid:
+            send_message(self.request, {'error': "Too many name input tries."})
             return
 
-        is_team_valid = False
+        team_valid = False
         team_attempts = 0
-        while not is_team_valid and team_attempts < MAX_TEAM_ATTEMPTS:
+        while not team_valid and team_attempts < MAX_TEAM_ATTEMPTS:
             team_attempts += 1
             try:
-                size = int.from_bytes(self.request.recv(4), "big")
-                data = self.request.recv(size)
+                data = receive_message(self.request)
             except (ConnectionResetError, ConnectionAbortedError):
                 return
             if not data:
                 return
 
+            # Verifies submited team
             team = pickle.loads(data)
+            team_valid = self.room.is_team_valid(team)
+            send_message(self.request, {'validity': team_valid})
 
-            # Verifies submited team
-            with state_lock:
-                number_players_blue = len([p.name for p in state.players.values() if p.team == Team.BLUE])
-                number_players_red = len([p.name for p in state.players.values() if p.team == Team.RED])
-                # Allow joining if the difference in team sizes would not exceed 1
-                is_team_valid = abs((number_players_blue + (1 if team == Team.BLUE else 0)) - (number_players_red + (1 if team == Team.RED else 0))) <= 1
-
-            data_to_send = {'validity': is_team_valid}
-            data_bytes = pickle.dumps(data_to_send)
-            self.request.sendall(len(data_bytes).to_bytes(4, 'big'))
-            self.request.sendall(data_bytes)
-
-        if not is_team_valid:
-            data_to_send = {'error': "Too many team input tries."}
-            data_bytes = pickle.dumps(data_to_send)
-            self.request.sendall(len(data_bytes).to_bytes(4, 'big'))
-            self.request.sendall(data_bytes)
+        if not team_valid:
+            send_message(self.request, {'error': "Too many team input tries."})
             return
 
-        print(f"{name} joined on team {team}")
-
-        with state_lock:
-            # Initialize position for new player
-            if self.player_id not in state.players:
-                if team == Team.RED:
-                    state.players[self.player_id] = Player(name, team, PLAYER_AREA_TL_X + 45, PLAYER_AREA_TL_Y + PLAYER_AREA_HEIGHT / 2)
-                else:
-                    state.players[self.player_id] = Player(name, team, PLAYER_AREA_BR_X - 45, PLAYER_AREA_TL_Y + PLAYER_AREA_HEIGHT / 2)
+        self.room.join(self.player_id, name, team)
+        if udp_server:
+            udp_server.register(self.player_id, self.room, self.udp_token)
+        clients.append(self.request)
+        self.joined = True
 
-            clients.append(self.request)
+        self.delta_encoder = snapshot.DeltaEncoder()
+        self.input_decoder = InputDecoder()
 
     def handle(self):
-        while True:
-            # Receive player's input
+        self.handshake()
+        if self.spectating:
+            self.send_spectator_snapshots()
+            return
+        if not self.joined:
+            return
+
+        # Snapshots are pushed by their own thread, so reading input never
+        # waits for a tick and a slow socket never stalls the reads
+        queue = SnapshotQueue()
+        self.room.broadcaster.subscribe(queue)
+        sender = Thread(target=self.send_snapshots, args=(queue,), daemon=True)
+        sender.start()
+
+        # Input messages are read into the same buffer and decoded in place
+        message = bytearray(INPUT_MESSAGE_SIZE)
+        try:
+            while True:
+                # Receive player's input
+                try:
+                    if not receive_exactly_into(self.request, message):
+                        break
+                    self.input_decoder.decode(message)
+                    self.room.inputs[self.player_id] = self.input_decoder.input
+                    self.delta_encoder.ack(self.input_decoder.ack)
+                except (ConnectionResetError, ConnectionAbortedError, ValueError):
+                    break
+        finally:
+            self.room.broadcaster.unsubscribe(queue)
+            queue.close()
+
+    def send_snapshots(self, queue):
+        while (last_snapshot := queue.get()) is not None:
+            if uses_udp(self.player_id):
+                continue
+            start = time.perf_counter()
+            data = self.delta_encoder.encode(last_snapshot)
             try:
-                size = int.from_bytes(self.request.recv(4), "big")
-                data = self.request.recv(size)
-            except (ConnectionResetError, ConnectionAbortedError):
+                self.request.sendall(frame(data))
+            except OSError:
                 break
+            metrics.send_time.record(time.perf_counter() - start)
+            metrics.send_bytes.record(len(data) + 4)
+
+    def send_spectator_snapshots(self):
+        queue = SnapshotQueue()
+        self.room.spectators.add(queue)
+        last_tick = None
+        try:
+            while (item := queue.get()) is not None:
+                baseline_tick, last_snapshot, data = item
+                # Snapshots dropped for a slow spectator break the chain of
+                # deltas, start again from a keyframe
+                if baseline_tick is not None and baseline_tick != last_tick:
+                    data = last_snapshot.encode()
+                try:
+                    self.request.sendall(frame(data))
+                except OSError:
+                    break
+                last_tick = last_snapshot.tick
+        finally:
+            self.room.spectators.remove(queue)
+            queue.close()
 
-            if not data:
-                break
+    def finish(self):
+        if self.request in clients:
+            clients.remove(self.request)
+        leave(self.room, self.player_id)
+
+
+# Sharded mode: the physics hold the GIL, so a single process never uses more
+# than one core. A front door process accepts connections, places each player
+# in a room and hands the socket itself off to the worker process that owns
+# that room. Workers tick their own rooms and talk to their clients directly,
+# only hand offs, commands and load reports go through the pipes.
+
+# How often workers report their rooms and load to the front door, in seconds
+SHARD_REPORT_INTERVAL = 0.25
+
+# A room its worker no longer reports is forgotten by the front door, unless
+# a player was placed in it this many seconds ago or less: the worker may not
+# have created it yet
+ROOM_PLACEMENT_GRACE = 4 * SHARD_REPORT_INTERVAL
+
+
+class Shard:
+    def __init__(self, index, shards, tick_rate, metrics_port, record_directory):
+        self.index = index
+        self.conn, worker_conn = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        # The worker closes its copies of the front door's end of the pipes,
+        # so it notices when the front door goes away
+        inherited = [self.conn] + [shard.conn for shard in shards]
+        self.process = multiprocessing.Process(target=run_worker, args=(index, worker_conn, inherited, tick_rate, metrics_port, record_directory), daemon=True)
+        self.process.start()
+        worker_conn.close()
+
+        # As last reported by the worker
+        self.rooms = {}
+        self.players = 0
+        self.busy = 0.0
+
+    def hand_off(self, sock, player_id, room_name, spectate=False):
+        socket.send_fds(self.conn, [pickle.dumps(("spectate" if spectate else "join", player_id, room_name))], [sock.fileno()])
+
+    def send_command(self, line):
+        self.conn.send(pickle.dumps(("command", line)))
+
+
+class Router:
+    def __init__(self, worker_count, tick_rate, metrics_port, record_directory):
+        self.lock = Lock()
+        self.shards = []
+        for index in range(worker_count):
+            self.shards.append(Shard(index, self.shards, tick_rate, metrics_port, record_directory))
+        # The first worker keeps the default room
+        self.room_owner = {DEFAULT_ROOM: self.shards[0]}
+        self.room_players = {DEFAULT_ROOM: 0}
+        # When a player was last placed in each room
+        self.placed = {}
+
+    def start(self):
+        for shard in self.shards:
+            Thread(target=self.receive_reports, args=(shard,), daemon=True).start()
+
+    def receive_reports(self, shard):
+        while data := shard.conn.recv(1 << 20):
+            report = pickle.loads(data)
+            with self.lock:
+                shard.rooms = report["rooms"]
+                shard.busy = report["busy"]
+                shard.players = 0
+                for name, teams in shard.rooms.items():
+                    self.room_owner[name] = shard
+                    self.room_players[name] = len(teams["blue"]) + len(teams["red"])
+                    shard.players += self.room_players[name]
+                self.forget_rooms(shard)
+
+    def forget_rooms(self, shard):
+        # With the lock held, drops the rooms the worker removed
+        now = time.monotonic()
+        gone = [name for name, owner in self.room_owner.items() if owner is shard and name not in shard.rooms]
+        for name in gone:
+            if name != DEFAULT_ROOM and now - self.placed.get(name, -math.inf) > ROOM_PLACEMENT_GRACE:
+                del self.room_owner[name]
+                self.room_players.pop(name, None)
+                self.placed.pop(name, None)
+
+    def summary(self):
+        with self.lock:
+            return {name: teams for shard in self.shards for name, teams in shard.rooms.items()}
+
+    def find(self, room_name):
+        # The worker of the room to spectate, the busiest if not given
+        with self.lock:
+            if not room_name and self.room_players:
+                room_name = max(self.room_players, key=self.room_players.get)
+            return self.room_owner.get(room_name), room_name
+
+    def place(self, room_name):
+        # The same rules as RoomManager.assign, across every worker. New rooms
+        # go to the least busy worker
+        with self.lock:
+            if not room_name:
+                rooms = [name for name, count in self.room_players.items() if count < MAX_PLAYERS_PER_ROOM]
+                if rooms:
+                    room_name = max(rooms, key=self.room_players.get)
+                else:
+                    number = len(self.room_owner) + 1
+                    while f"room-{number}" in self.room_owner:
+                        number += 1
+                    room_name = f"room-{number}"
+
+            if room_name not in self.room_owner:
+                self.room_owner[room_name] = min(self.shards, key=lambda shard: (round(shard.busy, 1), shard.players))
+            shard = self.room_owner[room_name]
+
+            # Count the player right away, reports only come a few times per
+            # second and many players may join in between
+            self.room_players[room_name] = self.room_players.get(room_name, 0) + 1
+            self.placed[room_name] = time.monotonic()
+            shard.players += 1
+            return shard, room_name
+
+
+def serve_sharded(port, worker_count, tick_rate, metrics_port=None, record_directory=None):
+    # Workers are forked before any thread or listening socket exists
+    router = Router(worker_count, tick_rate, metrics_port, record_directory)
+    router.start()
+
+    interpreter_thread = Thread(target=interpreter, args=(route_command, router), daemon=True)
+    interpreter_thread.start()
+
+    with FrontDoorServer(("0.0.0.0", port), FrontDoorHandler) as server:
+        server.router = router
+        print(f"Server started with {worker_count} workers, waiting for messages...")
+        server.serve_forever()
+
+
+def route_command(router, line):
+    args = line.split()
+    if line.startswith("rooms"):
+        for shard in router.shards:
+            for name, teams in shard.rooms.items():
+                print(f"{name}: {len(teams['blue']) + len(teams['red'])} players, worker {shard.index} ({shard.busy:.0%} busy)")
+    elif args and args[0] in ROOM_COMMANDS:
+        shard = router.room_owner.get(command_room(args))
+        if shard is None:
+            print(f"Room {command_room(args)} doesn't exist")
+        else:
+            shard.send_command(line)
+    else:
+        for shard in router.shards:
+            shard.send_command(line)
+
+
+class FrontDoorServer(GameTCPServer):
+    router = None
+
+
+class FrontDoorHandler(socketserver.BaseRequestHandler):
+    def setup(self):
+        set_nodelay(self.request)
+
+    def handle(self):
+        player_id = str(uuid.uuid4())
+        send_message(self.request, player_id)
+        send_message(self.request, {"rooms": self.server.router.summary()})
+
+        try:
+            data = receive_message(self.request)
+        except (ConnectionResetError, ConnectionAbortedError):
+            return
+        if not data:
+            return
+
+        choice = pickle.loads(data)
+        room_name = spectated_room(choice)
+        if room_name is not None:
+            shard, room_name = self.server.router.find(room_name)
+            if shard is None:
+                send_message(self.request, {'error': f"Room {room_name} doesn't exist."})
+                return
+            shard.hand_off(self.request, player_id, room_name, spectate=True)
+        else:
+            shard, room_name = self.server.router.place(choice)
+            shard.hand_off(self.request, player_id, room_name)
 
-            input = pickle.loads(data)
-            window_width = input.window_width
-            window_height = input.window_height
-            inputs[self.player_id] = input
+        # The worker has its own copy of the socket now, close ours without
+        # shutting the connection down
+        os.close(self.request.detach())
 
-            with send_cond:
-                send_cond.wait()
-                default_size_state = copy.deepcopy(last_state[0])
-                prepared_state = scale_and_offset_state(default_size_state, window_width, window_height)
-                data = pickle.dumps(prepared_state)
-                state_pickled = len(data).to_bytes(4, "big") + data
-                self.request.sendall(state_pickled)
+
+class HandoffHandler(GameTCPHandler):
+    """A connection handed off by the front door, which already sent the
+    player id and read the room choice."""
+
+    def __init__(self, request, player_id, room_name, spectate=False):
+        self.player_id = player_id
+        self.room_name = room_name
+        self.spectate = spectate
+        super().__init__(request, request.getpeername(), None)
+
+    def handshake(self):
+        if self.spectate:
+            self.spectate_room(self.room_name)
+        else:
+            self.join_room(self.room_name)
 
     def finish(self):
-        with state_lock:
-            if self.player_id in state.players:
-                print(f"{state.players[self.player_id].name} left")
-                # Remove client data on disconnect
-                if self.request in clients:
-                    clients.remove(self.request)
-                if self.player_id in state.players:
-                    del state.players[self.player_id]
-                if self.player_id in inputs:
-                    del inputs[self.player_id]
-
-
-def scale_and_offset_state(default_size_state, window_width, window_height):
-    scale_ratio = min(window_height / SCREEN_HEIGHT, window_width / SCREEN_WIDTH)
-
-    field_x1 = default_size_state.field_coords[0] * scale_ratio
-    field_y1 = default_size_state.field_coords[1] * scale_ratio
-    field_x2 = default_size_state.field_coords[2] * scale_ratio
-    field_y2 = default_size_state.field_coords[3] * scale_ratio
-
-    field_width = field_x2 - field_x1
-    field_height = field_y2 - field_y1
-
-    offset_x = (window_width - field_width) / 2 - field_x1
-    offset_y = (window_height - field_height) / 2 - field_y1
-
-    # Adjust players, ball, and posts coordinates and radii
-    for player in default_size_state.players.values():
-        scale_and_offset_circle(player, scale_ratio, offset_x, offset_y)
-    scale_and_offset_circle(default_size_state.ball, scale_ratio, offset_x, offset_y)
-    for post in default_size_state.posts.values():
-        scale_and_offset_circle(post, scale_ratio, offset_x, offset_y)
-
-    # Adjust field coordinates
-    default_size_state.field_coords = (
-        round(field_x1 + offset_x),
-        round(field_y1 + offset_y),
-        round(field_x2 + offset_x),
-        round(field_y2 + offset_y),
-    )
+        super().finish()
+        self.request.close()
+
+
+def run_worker(index, conn, inherited, tick_rate, metrics_port=None, record_directory=None):
+    global rooms
+    for other in inherited:
+        other.close()
+    rooms = RoomManager(DEFAULT_ROOM if index == 0 else None)
+
+    pygame.init()
+    timestep = loop.Timestep(tick_rate)
+    start_metrics(metrics_port + index if metrics_port is not None else None, timestep)
+    if record_directory:
+        start_recording(rooms, record_directory, tick_rate)
+
+    Thread(target=game_cycle, args=(False, rooms, timestep), daemon=True).start()
+    Thread(target=report_load, args=(conn,), daemon=True).start()
+
+    while True:
+        message, fds, _, _ = socket.recv_fds(conn, 1024, 1)
+        # The front door is gone
+        if not message:
+            break
 
-    return default_size_state
+        match pickle.loads(message):
+            case ("join" | "spectate" as kind, player_id, room_name):
+                client = socket.socket(fileno=fds[0])
+                Thread(target=HandoffHandler, args=(client, player_id, room_name, kind == "spectate"), daemon=True).start()
+            case ("command", line):
+                run_command(rooms, line)
 
+    # Worker processes exit without running atexit handlers
+    stop_recording(rooms)
 
-def scale_and_offset_circle(circle, scale_ratio, offset_x, offset_y):
-    circle.x = round(circle.x * scale_ratio + offset_x)
-    circle.y = round(circle.y * scale_ratio + offset_y)
-    circle.radius = round(circle.radius * scale_ratio)
+
+def report_load(conn):
+    last_time = time.monotonic()
+    last_cpu = time.process_time()
+    while True:
+        time.sleep(SHARD_REPORT_INTERVAL)
+        # Share of one core used by this worker since the last report
+        now, cpu = time.monotonic(), time.process_time()
+        busy = (cpu - last_cpu) / (now - last_time)
+        last_time, last_cpu = now, cpu
+        conn.send(pickle.dumps({"rooms": rooms.summary(), "busy": busy}))
+
+
+# asyncio mode: the same handshake, input reading and snapshot sending as
+# GameTCPHandler, as coroutines on a single event loop. The game cycle keeps
+# its own thread and wakes the event loop once per tick.
+
+async def serve_async(port):
+    event_loop = asyncio.get_running_loop()
+    # By room, rather than name: a room removed and created again under the
+    # same name mustn't get snapshots still on their way from the old one
+    queues = {}
+    spectators = {}
+
+    def fan_out(room, last_snapshot):
+        for queue in queues.get(room, ()):
+            # Drop the oldest snapshot for clients that can't keep up
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(last_snapshot)
+
+    def add_room(room):
+        queues[room] = []
+        room.broadcaster.add_listener(lambda last_snapshot: event_loop.call_soon_threadsafe(fan_out, room, last_snapshot))
+
+    def remove_room(room):
+        queues.pop(room, None)
+        spectators.pop(room, None)
+
+    rooms.add_room_listener(add_room, remove_room)
+
+    async def handle_connection(reader, writer):
+        player_id = str(uuid.uuid4())
+        # Player ids are public, UDP input packets must carry this token
+        udp_token = secrets.token_bytes(INPUT_TOKEN_SIZE) if udp_server else None
+        queue = asyncio.Queue(QUEUE_SIZE)
+        room = None
+        try:
+            room, spectating = await choose_room_async(player_id, reader, writer, udp_token)
+            if room and spectating:
+                room_spectators = spectators.setdefault(room, AsyncSpectators(event_loop))
+                await spectate_async(room, room_spectators, writer)
+            elif room and await join_async(room, player_id, reader, writer, udp_token):
+                delta_encoder = snapshot.DeltaEncoder()
+                queues[room].append(queue)
+                sender = asyncio.create_task(send_snapshots_async(player_id, writer, queue, delta_encoder))
+                try:
+                    await receive_inputs_async(room, player_id, reader, delta_encoder)
+                finally:
+                    sender.cancel()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            if room and queue in queues.get(room, ()):
+                queues[room].remove(queue)
+            leave(room, player_id)
+            writer.close()
+
+    server = await asyncio.start_server(handle_connection, "0.0.0.0", port, backlog=GameTCPServer.request_queue_size)
+    print("Server started (asyncio), waiting for messages...")
+    async with server:
+        await server.serve_forever()
+
+
+class AsyncSpectators:
+    """The spectators of a room connected to the event loop, fed by the
+    room's SpectatorFeed from its own thread."""
+
+    def __init__(self, event_loop):
+        self.event_loop = event_loop
+        self.queues = []
+
+    def put(self, item):
+        self.event_loop.call_soon_threadsafe(self.fan_out, item)
+
+    def fan_out(self, item):
+        for queue in self.queues:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(item)
+
+
+async def spectate_async(room, spectators, writer):
+    queue = asyncio.Queue(QUEUE_SIZE)
+    spectators.queues.append(queue)
+    if len(spectators.queues) == 1:
+        room.spectators.add(spectators)
+
+    last_tick = None
+    try:
+        while True:
+            baseline_tick, last_snapshot, data = await queue.get()
+            # Start again from a keyframe after a dropped snapshot
+            if baseline_tick is not None and baseline_tick != last_tick:
+                data = last_snapshot.encode()
+            writer.write(frame(data))
+            await writer.drain()
+            last_tick = last_snapshot.tick
+    finally:
+        spectators.queues.remove(queue)
+        if not spectators.queues:
+            room.spectators.remove(spectators)
+
+
+async def choose_room_async(player_id, reader, writer, udp_token=None):
+    # Returns the room given, held until leave(), and whether to spectate it
+    await send_message_async(writer, player_id)
+    await send_message_async(writer, {"rooms": rooms.summary()})
+
+    choice = pickle.loads(await receive_message_async(reader))
+    room_name = spectated_room(choice)
+    if room_name is not None:
+        room = rooms.watch(room_name)
+        if room is None:
+            await send_message_async(writer, {'error': f"Room {room_name} doesn't exist."})
+            return None, False
+        await send_message_async(writer, {"room": room.name, "teams": room.teams()})
+        return room, True
+
+    room = rooms.assign(choice)
+    if room is None:
+        await send_message_async(writer, {'error': "No room available."})
+        return None, False
+    room_info = {"room": room.name, "teams": room.teams()}
+    if udp_token is not None:
+        room_info["udp_token"] = udp_token
+    await send_message_async(writer, room_info)
+    return room, False
+
+
+async def join_async(room, player_id, reader, writer, udp_token=None):
+    # Returns whether the player picked a valid name and team and joined
+    name_valid = False
+    name_attempts = 0
+    while not name_valid and name_attempts < MAX_NAME_ATTEMPTS:
+        name_attempts += 1
+        name = pickle.loads(await receive_message_async(reader))
+        name_valid = room.is_name_valid(name)
+        await send_message_async(writer, {'validity': name_valid})
+
+    if not name_valid:
+        await send_message_async(writer, {'error': "Too many name input tries."})
+        return False
+
+    team_valid = False
+    team_attempts = 0
+    while not team_valid and team_attempts < MAX_TEAM_ATTEMPTS:
+        team_attempts += 1
+        team = pickle.loads(await receive_message_async(reader))
+        team_valid = room.is_team_valid(team)
+        await send_message_async(writer, {'validity': team_valid})
+
+    if not team_valid:
+        await send_message_async(writer, {'error': "Too many team input tries."})
+        return False
+
+    room.join(player_id, name, team)
+    if udp_token is not None:
+        udp_server.register(player_id, room, udp_token)
+    return True
+
+
+async def receive_inputs_async(room, player_id, reader, delta_encoder):
+    input_decoder = InputDecoder()
+    while True:
+        message = await reader.readexactly(INPUT_MESSAGE_SIZE)
+        try:
+            input_decoder.decode(message)
+        except ValueError:
+            break
+        room.inputs[player_id] = input_decoder.input
+        delta_encoder.ack(input_decoder.ack)
+
+
+async def send_snapshots_async(player_id, writer, queue, delta_encoder):
+    while True:
+        last_snapshot = await queue.get()
+        if uses_udp(player_id):
+            continue
+        start = time.perf_counter()
+        data = delta_encoder.encode(last_snapshot)
+        writer.write(frame(data))
+        metrics.send_time.record(time.perf_counter() - start)
+        metrics.send_bytes.record(len(data) + 4)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            break
+
+
+async def send_message_async(writer, data):
+    writer.write(frame(pickle.dumps(data)))
+    await writer.drain()
+
+
+async def receive_message_async(reader):
+    size = int.from_bytes(await reader.readexactly(4), "big")
+    return await reader.readexactly(size)
 
 
 if __name__ == "__main__":
@@ -1,9 +1,11 @@
-import copy
 import math
-import pickle
+import metrics
 import pygame
-from itertools import combinations, product
-from state import FIELD_WIDTH, PLAYER_AREA_BR_X, PLAYER_AREA_HEIGHT, PLAYER_AREA_TL_X, PLAYER_AREA_TL_Y, Team, FIELD_TL_X, FIELD_TL_Y, FIELD_HEIGHT, MatchManager, MatchState
+import snapshot
+import time
+from collections import defaultdict
+from itertools import combinations
+from state import FIELD_WIDTH, PLAYER_AREA_BR_X, PLAYER_AREA_HEIGHT, PLAYER_AREA_TL_X, PLAYER_AREA_TL_Y, PLAYER_RADIUS, Team, FIELD_TL_X, FIELD_TL_Y, FIELD_HEIGHT, MatchState, State
 
 
 def moving_circles(state):
@@ -11,48 +13,199 @@ def moving_circles(state):
     yield state.ball
 
 
-def step(state, clock, inputs, state_lock, send_cond, last_state):
-    dt = clock.tick(60) / 1000.0  # Time since last frame
+# The physics constants are tuned for this many ticks per second, other tick
+# rates scale them so the game plays at the same speed
+BASE_TICK_RATE = 60
+TICK_RATE = 60
 
-    with state_lock:
-        prev_state = state.match_manager.state
-        state.match_manager.update(dt, state.score_red, state.score_blue)
-        # Reset scores if match just ended (PLAYING -> BREAK)
-        if prev_state in [MatchState.PLAYING, MatchState.OVERTIME] and state.match_manager.state == MatchState.BREAK:
-            reset_scores(state)
-            reset_ball(state)
-            reset_players(state)
+# Ticks the server catches up on after falling behind. Time beyond that is
+# dropped, slowing the game down rather than falling further behind.
+MAX_CATCH_UP_TICKS = 8
 
-        if state.match_manager.state in [MatchState.PLAYING, MatchState.OVERTIME]:
-            for address, player in state.players.items():
-                if address in inputs:
-                    apply_input(player, inputs[address])
-                    del inputs[address]
 
-            for circle in moving_circles(state):
-                update_position(circle)
+class Timestep:
+    """Turns real time into a whole number of fixed length ticks."""
 
-            handle_collisions(state)
+    def __init__(self, tick_rate=TICK_RATE):
+        self.tick_rate = tick_rate
+        self.dt = 1 / tick_rate
+        self.accumulator = 0.0
+        self.last_time = time.perf_counter()
+        self.dropped = 0
 
-            handle_kicks(state)
+    def wait(self):
+        # Sleep until the next tick is due, then return how many are due
+        delay = self.dt - self.accumulator - (time.perf_counter() - self.last_time)
+        if delay > 0:
+            time.sleep(delay)
 
-            check_goal(state)
+        now = time.perf_counter()
+        self.accumulator += now - self.last_time
+        self.last_time = now
 
-        state.clock = pygame.time.get_ticks() // 1000
+        ticks = int(self.accumulator / self.dt)
+        if ticks > MAX_CATCH_UP_TICKS:
+            self.dropped += ticks - MAX_CATCH_UP_TICKS
+            self.accumulator -= (ticks - MAX_CATCH_UP_TICKS) * self.dt
+            ticks = MAX_CATCH_UP_TICKS
+        self.accumulator -= ticks * self.dt
+        return ticks
 
-        last_state[0] = copy.deepcopy(state)
 
-        with send_cond:
-            send_cond.notify_all()
+def step(rooms, timestep):
+    ticks = timestep.wait()
 
-        clear_kicks(state)
+    # Every room is ticked by this same loop. When behind, rooms run the
+    # missed ticks back to back and only the last one is sent to clients.
+    for room in rooms.all():
+        tick(room, timestep.dt, ticks)
 
     return True
 
 
-def handle_collisions(state):
+def tick(room, dt, ticks=1):
+    state = room.state
+
+    start = time.perf_counter()
+    with room.state_lock:
+        locked = time.perf_counter()
+        metrics.lock_wait.record(locked - start)
+
+        # Clients only send their keys when they change, so the last input
+        # of each player holds until the next one. Copied so that inputs
+        # arriving during the step don't change it halfway.
+        inputs = room.inputs.copy()
+
+        if room.recorder is None:
+            for _ in range(ticks):
+                simulate(state, inputs, dt, metrics)
+        else:
+            room.recorder.step(state, inputs, dt, ticks, metrics)
+
+        state.clock = pygame.time.get_ticks() // 1000
+
+        # Capture the snapshot once, in world coordinates, for every client.
+        # Only the fields that change are copied, into tuples nobody modifies,
+        # so it's safe to hand out after the lock is released.
+        captured = time.perf_counter()
+        last_snapshot = snapshot.capture(state) if room.broadcaster.has_subscribers() else None
+        metrics.capture.record(time.perf_counter() - captured)
+
+        clear_kicks(state)
+
+    # Waking up the connections doesn't need the state
+    if last_snapshot is not None:
+        notified = time.perf_counter()
+        room.broadcaster.publish(last_snapshot)
+        metrics.notify.record(time.perf_counter() - notified)
+
+    metrics.tick.record(time.perf_counter() - start)
+
+
+def simulate(state, inputs, dt, timings=None):
+    # One fixed tick, the same state and inputs always give the same result.
+    # The server's ticks pass the metrics module as timings to record how
+    # long each phase took, simulations and replays pass nothing.
+    scale = dt * BASE_TICK_RATE
+
+    start = time.perf_counter()
+    prev_state = state.match_manager.state
+    state.match_manager.update(dt, state.score_red, state.score_blue)
+    # Reset scores if match just ended (PLAYING -> BREAK)
+    if prev_state in [MatchState.PLAYING, MatchState.OVERTIME] and state.match_manager.state == MatchState.BREAK:
+        reset_scores(state)
+        reset_ball(state)
+        reset_players(state)
+
+    if state.match_manager.state in [MatchState.PLAYING, MatchState.OVERTIME]:
+        updated = time.perf_counter()
+
+        for address, player in state.players.items():
+            if address in inputs:
+                apply_input(player, inputs[address], scale)
+
+        moved = time.perf_counter()
+
+        physics(state, scale)
+
+        check_goal(state)
+        if timings is not None:
+            timings.match_update.record(updated - start)
+            timings.inputs.record(moved - updated)
+            timings.physics.record(time.perf_counter() - moved)
+    elif timings is not None:
+        timings.match_update.record(time.perf_counter() - start)
+
+    state.tick += 1
+
+
+def move(state, scale):
+    for circle in moving_circles(state):
+        update_position(circle, scale)
+
+    handle_collisions(state)
+
+    handle_kicks(state)
+
+
+# Moves the circles and resolves collisions and kicks. The server replaces it
+# with physics_numpy.move when started with --physics numpy.
+physics = move
+
+
+# Distance moved per tick at a velocity of 1
+MOVE_SPEED = 5.5
+
+# Broadphase: circles further apart than this on either axis aren't paired.
+# Pairs are chosen before any collision is resolved, so besides the largest
+# diameter the reach covers circles pushed toward each other by earlier
+# collisions in the same tick. Players move at most MOVE_SPEED per tick, so
+# two of them closing at full speed overlap by up to 2 * MOVE_SPEED, and each
+# is pushed out by half of that. The margin covers one such push on both
+# circles of a pair. Deeper pushes, from a fast ball or a crowd resolved in
+# a chain, make resolve_candidate_pairs resolve the tick again with a wider
+# reach.
+BROADPHASE_REACH = 2 * PLAYER_RADIUS + 2 * MOVE_SPEED
+
+# Below this many circles checking every pair is cheaper than the broadphase
+BROADPHASE_MIN_CIRCLES = 5
+
+# Posts are indexed in a grid of this cell size
+CELL_SIZE = 100
+
+
+def resolve_candidate_pairs(circles):
+    # The broadphase leaves out pairs too far apart to touch, unless the
+    # collisions of this tick push them closer. When the circles were pushed
+    # further than the reach leaves room for, the tick is resolved again
+    # from the start with a reach covering those pushes. Each left out pair
+    # then stays apart, so the result is the same as with all pairs.
+    reach = BROADPHASE_REACH
+    while True:
+        pushed = resolve_pairs(circles, candidate_pairs(circles, reach))
+        if not pushed:
+            return
+        furthest = max(distance for _, _, _, _, distance in pushed.values())
+        diameter = 2 * max(c.radius for c in circles)
+        if diameter + 2 * furthest <= reach:
+            return
+
+        for i, (x, y, vx, vy, _) in pushed.items():
+            c = circles[i]
+            c.x, c.y, c.vx, c.vy = x, y, vx, vy
+        reach = max(2 * reach, diameter + 2 * furthest)
+
+
+def resolve_pairs(circles, pairs):
+    # Resolves the overlapping pairs in order. Returns the circles pushed, by
+    # index, with their motion before the first push and how far they were
+    # pushed in total.
+    pushed = {}
+
     # Could handle collisions between players first and then between players and ball and check if player is kicking
-    for c1, c2 in combinations(moving_circles(state), 2):
+    for i, j in pairs:
+        c1 = circles[i]
+        c2 = circles[j]
         dx = c2.x - c1.x
         dy = c2.y - c1.y
         distance_sqr = dx**2 + dy**2
@@ -68,6 +221,12 @@ def handle_collisions(state):
             nx = dx / distance
             ny = dy / distance
             overlap = 0.5 * (radius_sum - distance)
+            if i not in pushed:
+                pushed[i] = [c1.x, c1.y, c1.vx, c1.vy, 0.0]
+            if j not in pushed:
+                pushed[j] = [c2.x, c2.y, c2.vx, c2.vy, 0.0]
+            pushed[i][4] += overlap
+            pushed[j][4] += overlap
             c1.x -= overlap * nx
             c1.y -= overlap * ny
             c2.x += overlap * nx
@@ -82,6 +241,56 @@ def handle_collisions(state):
             c2.vx += p * c1.mass * nx
             c2.vy += p * c1.mass * ny
 
+    return pushed
+
+
+def cell(circle):
+    return int(circle.x // CELL_SIZE), int(circle.y // CELL_SIZE)
+
+
+def candidate_pairs(circles, reach=BROADPHASE_REACH):
+    # Sweep and prune: sorted by x, each circle is only paired with the
+    # following ones until they are out of reach
+    boxes = sorted((circle.x, circle.y, i) for i, circle in enumerate(circles))
+    count = len(boxes)
+
+    pairs = []
+    for k in range(count):
+        x, y, i = boxes[k]
+        for n in range(k + 1, count):
+            other_x, other_y, j = boxes[n]
+            if other_x - x >= reach:
+                break
+            if -reach < other_y - y < reach:
+                pairs.append((i, j) if i < j else (j, i))
+
+    # Same order as combinations(), so the broadphase doesn't change results
+    pairs.sort()
+    return pairs
+
+
+def index_posts(posts):
+    # Posts never move, so each one is put once in every cell from which a
+    # circle could reach it
+    reach = BROADPHASE_REACH / 2
+    post_cells = defaultdict(list)
+    for name, post in posts.items():
+        for x in range(int((post.x - post.radius - reach) // CELL_SIZE), int((post.x + post.radius + reach) // CELL_SIZE) + 1):
+            for y in range(int((post.y - post.radius - reach) // CELL_SIZE), int((post.y + post.radius + reach) // CELL_SIZE) + 1):
+                post_cells[(x, y)].append(name)
+    return dict(post_cells)
+
+
+POST_CELLS = index_posts(State().posts)
+
+
+def handle_collisions(state):
+    circles = list(moving_circles(state))
+    if len(circles) < BROADPHASE_MIN_CIRCLES:
+        resolve_pairs(circles, combinations(range(len(circles)), 2))
+    else:
+        resolve_candidate_pairs(circles)
+
     # Check for ball collision with field boundaries
     if state.ball.x < state.ball.radius + state.field_coords[0] and (state.ball.y < state.posts["tl"].y or state.ball.y > state.posts["bl"].y):
         state.ball.x = state.ball.radius + state.field_coords[0]
@@ -98,50 +307,58 @@ def handle_collisions(state):
 
     # Check for player collision with player area boundaries
     for c in moving_circles(state): # state.players.values():
-        if c.x < c.radius + state.player_area_coords[0]:
-            c.x = c.radius + state.player_area_coords[0]
-            c.vx *= -1
-        if c.x >= state.player_area_coords[2] - c.radius:
-            c.x = state.player_area_coords[2] - 1 - c.radius
-            c.vx *= -1
-        if c.y < c.radius + state.player_area_coords[1]:
-            c.y = c.radius + state.player_area_coords[1]
-            c.vy *= -1
-        if c.y >= state.player_area_coords[3] - c.radius:
-            c.y = state.player_area_coords[3] - 1 - c.radius
-            c.vy *= -1
+        bounce_off_edges(c, state.player_area_coords)
 
     # Check for collisions with posts
-    for c, p in product(moving_circles(state), state.posts.values()):
-        dx = p.x - c.x
-        dy = p.y - c.y
-        distance_sqr = dx**2 + dy**2
-        radius_sum = c.radius + p.radius
-
-        # Check for overlap
-        if distance_sqr < radius_sum**2:
-            # Resolve overlap
-            distance = math.sqrt(distance_sqr)
-            if distance == 0:
-                distance = 1e-6
-            nx = dx / distance
-            ny = dy / distance
-            overlap = radius_sum - distance
-            c.x -= overlap * nx
-            c.y -= overlap * ny
-
-            # Resolve velocity
-            dp = 2 * (nx * c.vx + ny * c.vy)
-            c.vx -= dp * nx
-            c.vy -= dp * ny
+    for c in circles:
+        for name in POST_CELLS.get(cell(c), ()):
+            p = state.posts[name]
+            dx = p.x - c.x
+            dy = p.y - c.y
+            distance_sqr = dx**2 + dy**2
+            radius_sum = c.radius + p.radius
+
+            # Check for overlap
+            if distance_sqr < radius_sum**2:
+                # Resolve overlap
+                distance = math.sqrt(distance_sqr)
+                if distance == 0:
+                    distance = 1e-6
+                nx = dx / distance
+                ny = dy / distance
+                overlap = radius_sum - distance
+                c.x -= overlap * nx
+                c.y -= overlap * ny
+
+                # Resolve velocity
+                dp = 2 * (nx * c.vx + ny * c.vy)
+                c.vx -= dp * nx
+                c.vy -= dp * ny
+
+
+def bounce_off_edges(c, coords):
+    # Also used by the client to predict its own player
+    if c.x < c.radius + coords[0]:
+        c.x = c.radius + coords[0]
+        c.vx *= -1
+    if c.x >= coords[2] - c.radius:
+        c.x = coords[2] - 1 - c.radius
+        c.vx *= -1
+    if c.y < c.radius + coords[1]:
+        c.y = c.radius + coords[1]
+        c.vy *= -1
+    if c.y >= coords[3] - c.radius:
+        c.y = coords[3] - 1 - c.radius
+        c.vy *= -1
+
+
+MIN_KICK_FORCE = 1
+MAX_KICK_FORCE = 2.5
+DELTA_KICK_FORCE = MAX_KICK_FORCE - MIN_KICK_FORCE
+KICK_REACH = 20
 
 
 def handle_kicks(state):
-    MIN_KICK_FORCE = 1
-    MAX_KICK_FORCE = 2.5
-    DELTA_KICK_FORCE = MAX_KICK_FORCE - MIN_KICK_FORCE
-    KICK_REACH = 20
-
     for player in state.players.values():
         if player.kick and not player.kick_locked:
             dx = state.ball.x - player.x
@@ -166,22 +383,27 @@ def clear_kicks(state):
         player.kick = False
 
 
-def update_position(circle):
+# Below this squared speed circles stop
+MIN_SPEED_SQR = 0.001
+
+
+def update_position(circle, scale=1):
     # Update position
-    circle.x += circle.vx * 5.5
-    circle.y += circle.vy * 5.5
+    circle.x += circle.vx * MOVE_SPEED * scale
+    circle.y += circle.vy * MOVE_SPEED * scale
 
     # Apply drag
-    circle.vx *= circle.drag_coefficient
-    circle.vy *= circle.drag_coefficient
+    drag = circle.drag_coefficient ** scale
+    circle.vx *= drag
+    circle.vy *= drag
 
     # Clamp velocity near zero
-    if circle.vx**2 + circle.vy**2 < 0.001:
+    if circle.vx**2 + circle.vy**2 < MIN_SPEED_SQR:
         circle.vx = 0
         circle.vy = 0
 
 
-def apply_input(player, input) -> None:
+def apply_input(player, input, scale=1) -> None:
     x = (-1 if input.left else 0) + (1 if input.right else 0)
     y = (-1 if input.up else 0) + (1 if input.down else 0)
 
@@ -191,11 +413,11 @@ def apply_input(player, input) -> None:
         my = y / move_magnitude
 
         if input.kick:
-            player.vx += 0.05 * 0.7 * mx
-            player.vy += 0.05 * 0.7 * my
+            player.vx += 0.05 * 0.7 * mx * scale
+            player.vy += 0.05 * 0.7 * my * scale
         else:
-            player.vx += 0.05 * mx
-            player.vy += 0.05 * my
+            player.vx += 0.05 * mx * scale
+            player.vy += 0.05 * my * scale
 
         # Normalize velocity to ensure norm is 1
         magnitude = math.sqrt(player.vx**2 + player.vy**2)
@@ -0,0 +1,121 @@
+import contextlib
+import io
+import math
+import multiprocessing
+import server_loop as loop
+from input import Input
+from state import MatchState, Player, State, Team
+
+
+class MatchResult:
+    def __init__(self, score_red, score_blue, ticks, goals):
+        self.score_red = score_red
+        self.score_blue = score_blue
+        self.ticks = ticks
+        # (tick, team that scored) for every goal
+        self.goals = goals
+
+    @property
+    def winner(self):
+        if self.score_red > self.score_blue:
+            return Team.RED
+        if self.score_blue > self.score_red:
+            return Team.BLUE
+        return None
+
+    def __repr__(self):
+        return f"MatchResult(red={self.score_red}, blue={self.score_blue}, ticks={self.ticks})"
+
+
+def new_match(players, match_duration=None):
+    # A state at kick off, with the match already playing
+    state = State()
+    for name, (team, _) in players.items():
+        state.players[name] = Player(name, team)
+    loop.reset_ball(state)
+    loop.reset_players(state)
+
+    match_manager = state.match_manager
+    if match_duration is not None:
+        match_manager.set_match_time(match_duration)
+    match_manager.start_match()
+    return state
+
+
+def player_input(controller, state, name, tick):
+    # Controllers are either a list of inputs, one per tick, or a function
+    # called every tick with the state, the player's name and the tick
+    if callable(controller):
+        return controller(state, name, tick)
+    if tick < len(controller):
+        return controller[tick]
+    return None
+
+
+def run_match(players, ticks=None, tick_rate=loop.TICK_RATE, match_duration=None):
+    """Plays a match as fast as possible, without network or clock.
+
+    players maps each player's name to its (team, controller). The match
+    ends after the given number of ticks or when its time runs out,
+    overtime included.
+    """
+    state = new_match(players, match_duration)
+    dt = 1 / tick_rate
+    goals = []
+
+    # The match manager announces every state change, which would flood
+    # the output of a batch
+    with contextlib.redirect_stdout(io.StringIO()):
+        tick = 0
+        while ticks is None or tick < ticks:
+            inputs = {}
+            for name, (_, controller) in players.items():
+                input = player_input(controller, state, name, tick)
+                if input is not None:
+                    inputs[name] = input
+
+            score_red, score_blue = state.score_red, state.score_blue
+            loop.simulate(state, inputs, dt)
+            loop.clear_kicks(state)
+            tick += 1
+
+            # Scores are reset as the match ends, so keep the last ones
+            if state.match_manager.state == MatchState.BREAK:
+                return MatchResult(score_red, score_blue, tick, goals)
+
+            if state.score_red > score_red:
+                goals.append((tick, Team.RED))
+            if state.score_blue > score_blue:
+                goals.append((tick, Team.BLUE))
+
+    return MatchResult(state.score_red, state.score_blue, tick, goals)
+
+
+def run_match_arguments(arguments):
+    return run_match(**arguments)
+
+
+def run_batch(matches, processes=None):
+    """Plays many matches, each given as a dict of run_match arguments,
+    spread over processes (one per core by default). Controllers must be
+    picklable, module level functions for example."""
+    if processes == 1:
+        return [run_match(**arguments) for arguments in matches]
+
+    with multiprocessing.Pool(processes) as pool:
+        return pool.map(run_match_arguments, matches, chunksize=max(1, len(matches) // (4 * (processes or multiprocessing.cpu_count()))))
+
+
+def chase_ball(state, name, tick):
+    # Simple bot: runs to the ball and kicks it when close enough
+    player = state.players[name]
+    dx = state.ball.x - player.x
+    dy = state.ball.y - player.y
+    distance = math.hypot(dx, dy)
+    return Input(
+        up=dy < -player.radius / 2,
+        down=dy > player.radius / 2,
+        left=dx < -player.radius / 2,
+        right=dx > player.radius / 2,
+        kick=distance < player.radius + state.ball.radius + loop.KICK_REACH,
+    )
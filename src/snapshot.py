@@ -0,0 +1,358 @@
+import struct
+import uuid
+from collections import deque
+from functools import lru_cache
+from state import Ball, MatchState, Player, State, Team
+from threading import Lock
+
+
+# Wire format of a game state snapshot (all little-endian):
+#
+#   header:  version, tick, baseline tick, sections
+#   match:   match state, time remaining, clock, red score, blue score
+#   ball:    x, y, vx, vy
+#   removed: number of players, player slots
+#   changed: number of players, then for each player its slot, a field
+#            mask and the fields in the mask (identity, flags, motion)
+#
+# A snapshot is encoded as a delta against a baseline the client already
+# has, so only what changed since then is sent. Keyframes are deltas
+# against an empty baseline and carry everything. Static data (field,
+# player area and posts) is never sent, the client rebuilds it from the
+# constants in state.py. Players are referred to by a small slot number,
+# their id is only sent along with their name and team.
+SNAPSHOT_VERSION = 2
+
+HEADER = struct.Struct("<BIIB")
+MATCH = struct.Struct("<BfIHH")
+BALL = struct.Struct("<4f")
+COUNT = struct.Struct("<H")
+PLAYER_SLOT = struct.Struct("<H")
+PLAYER_CHANGE = struct.Struct("<HB")
+PLAYER_IDENTITY = struct.Struct("<16sBB")
+PLAYER_FLAGS = struct.Struct("<B")
+PLAYER_MOTION = struct.Struct("<4f")
+
+SECTION_MATCH = 1
+SECTION_BALL = 2
+SECTION_KEYFRAME = 4
+
+CHANGED_IDENTITY = 1
+CHANGED_FLAGS = 2
+CHANGED_MOTION = 4
+
+FLAG_KICK = 1
+
+# Every client gets a keyframe at least this often, to recover from any
+# baseline mismatch. Keyframes fall on the same ticks for everybody so
+# their encoding is shared.
+KEYFRAME_INTERVAL = 120
+
+# Snapshots kept as possible baselines, per client
+MAX_BASELINES = 64
+
+TEAMS = {team.value: team for team in Team}
+MATCH_STATES = {match_state.value: match_state for match_state in MatchState}
+
+
+class SnapshotVersionError(Exception):
+    pass
+
+
+class Snapshot:
+    def __init__(self, tick, match, ball, players, baseline_tick=None):
+        self.tick = tick
+        # (match state, time remaining, clock, red score, blue score)
+        self.match = match
+        # (x, y, vx, vy)
+        self.ball = ball
+        # slot -> (id bytes, team, name bytes, flags, x, y, vx, vy)
+        self.players = players
+        # Tick of the baseline a received delta was decoded against, None
+        # for keyframes and snapshots captured by the server
+        self.baseline_tick = baseline_tick
+        self._encoded = {}
+
+    def encode(self, baseline=None):
+        # Shared by every client using the same baseline
+        key = baseline.tick if baseline is not None else None
+        data = self._encoded.get(key)
+        if data is None:
+            data = encode(self, baseline)
+            self._encoded[key] = data
+        return data
+
+
+EMPTY = Snapshot(0, None, None, {})
+
+
+def capture(state):
+    ball = state.ball
+    match_manager = state.match_manager
+    return Snapshot(
+        state.tick,
+        (match_manager.state.value, match_manager.time_remaining, state.clock, state.score_red, state.score_blue),
+        (ball.x, ball.y, ball.vx, ball.vy),
+        {
+            player_slot(player_id): (
+                id_to_bytes(player_id),
+                player.team.value,
+                encode_name(player.name),
+                FLAG_KICK if player.kick else 0,
+                player.x,
+                player.y,
+                player.vx,
+                player.vy,
+            )
+            for player_id, player in state.players.items()
+        },
+    )
+
+
+def encode(snapshot, baseline=None):
+    sections = 0
+    if baseline is None:
+        baseline = EMPTY
+        sections |= SECTION_KEYFRAME
+    if snapshot.match != baseline.match:
+        sections |= SECTION_MATCH
+    if snapshot.ball != baseline.ball:
+        sections |= SECTION_BALL
+
+    parts = [HEADER.pack(SNAPSHOT_VERSION, snapshot.tick, baseline.tick, sections)]
+    if sections & SECTION_MATCH:
+        parts.append(MATCH.pack(*snapshot.match))
+    if sections & SECTION_BALL:
+        parts.append(BALL.pack(*snapshot.ball))
+
+    removed = [slot for slot in baseline.players if slot not in snapshot.players]
+    parts.append(COUNT.pack(len(removed)))
+    for slot in removed:
+        parts.append(PLAYER_SLOT.pack(slot))
+
+    changed = []
+    changed_count = 0
+    for slot, player in snapshot.players.items():
+        old = baseline.players.get(slot)
+        if old is None:
+            mask = CHANGED_IDENTITY | CHANGED_FLAGS | CHANGED_MOTION
+        else:
+            mask = 0
+            if player[0] != old[0] or player[1] != old[1] or player[2] != old[2]:
+                mask |= CHANGED_IDENTITY
+            if player[3] != old[3]:
+                mask |= CHANGED_FLAGS
+            if player[4] != old[4] or player[5] != old[5] or player[6] != old[6] or player[7] != old[7]:
+                mask |= CHANGED_MOTION
+            if not mask:
+                continue
+
+        changed_count += 1
+        changed.append(PLAYER_CHANGE.pack(slot, mask))
+        if mask & CHANGED_IDENTITY:
+            changed.append(PLAYER_IDENTITY.pack(player[0], player[1], len(player[2])))
+            changed.append(player[2])
+        if mask & CHANGED_FLAGS:
+            changed.append(PLAYER_FLAGS.pack(player[3]))
+        if mask & CHANGED_MOTION:
+            changed.append(PLAYER_MOTION.pack(player[4], player[5], player[6], player[7]))
+
+    parts.append(COUNT.pack(changed_count))
+    parts.extend(changed)
+    return b"".join(parts)
+
+
+def decode(data, baselines):
+    if data[0] != SNAPSHOT_VERSION:
+        raise SnapshotVersionError(f"Unsupported snapshot version {data[0]}")
+
+    _, tick, baseline_tick, sections = HEADER.unpack_from(data)
+    offset = HEADER.size
+
+    baseline = EMPTY if sections & SECTION_KEYFRAME else baselines[baseline_tick]
+
+    match = baseline.match
+    if sections & SECTION_MATCH:
+        match = MATCH.unpack_from(data, offset)
+        offset += MATCH.size
+
+    ball = baseline.ball
+    if sections & SECTION_BALL:
+        ball = BALL.unpack_from(data, offset)
+        offset += BALL.size
+
+    players = dict(baseline.players)
+
+    (removed_count,) = COUNT.unpack_from(data, offset)
+    offset += COUNT.size
+    for _ in range(removed_count):
+        (slot,) = PLAYER_SLOT.unpack_from(data, offset)
+        offset += PLAYER_SLOT.size
+        players.pop(slot, None)
+
+    (changed_count,) = COUNT.unpack_from(data, offset)
+    offset += COUNT.size
+    for _ in range(changed_count):
+        slot, mask = PLAYER_CHANGE.unpack_from(data, offset)
+        offset += PLAYER_CHANGE.size
+        player_id, team, name, flags, x, y, vx, vy = players.get(slot, (b"", 0, b"", 0, 0, 0, 0, 0))
+
+        if mask & CHANGED_IDENTITY:
+            player_id, team, name_length = PLAYER_IDENTITY.unpack_from(data, offset)
+            offset += PLAYER_IDENTITY.size
+            name = bytes(data[offset:offset + name_length])
+            if len(name) != name_length:
+                raise struct.error("Snapshot ends in the middle of a name")
+            offset += name_length
+        if mask & CHANGED_FLAGS:
+            (flags,) = PLAYER_FLAGS.unpack_from(data, offset)
+            offset += PLAYER_FLAGS.size
+        if mask & CHANGED_MOTION:
+            x, y, vx, vy = PLAYER_MOTION.unpack_from(data, offset)
+            offset += PLAYER_MOTION.size
+
+        players[slot] = (player_id, team, name, flags, x, y, vx, vy)
+
+    return Snapshot(tick, match, ball, players, None if sections & SECTION_KEYFRAME else baseline_tick)
+
+
+def to_state(snapshot):
+    match_state, time_remaining, clock, score_red, score_blue = snapshot.match
+
+    state = State()
+    state.tick = snapshot.tick
+    state.match_manager.state = MATCH_STATES[match_state]
+    state.match_manager.time_remaining = time_remaining
+    state.clock = clock
+    state.score_red = score_red
+    state.score_blue = score_blue
+    state.ball = Ball(*snapshot.ball)
+
+    for player_id, team, name, flags, x, y, vx, vy in snapshot.players.values():
+        player = Player(decode_name(name), TEAMS[team], x, y, vx, vy)
+        player.kick = bool(flags & FLAG_KICK)
+        state.players[bytes_to_id(player_id)] = player
+
+    return state
+
+
+class DeltaEncoder:
+    """Chooses the baseline of every snapshot sent to a client.
+
+    ack() may be called from the thread reading the client's input while
+    encode() runs on the thread sending snapshots, so only encode() touches
+    the snapshots sent.
+    """
+
+    def __init__(self):
+        self.sent = {}
+        self.acked_tick = 0
+        self.last_tick = 0
+
+    def ack(self, tick):
+        self.acked_tick = tick
+
+    def encode(self, snapshot):
+        baseline = self.sent.get(self.acked_tick)
+        if baseline is not None:
+            # Older snapshots will never be used as a baseline again
+            for tick in [t for t in self.sent if t < baseline.tick]:
+                del self.sent[tick]
+
+        # Ticks may be skipped under load, so send the keyframe on the first
+        # snapshot past every interval
+        if baseline is None or snapshot.tick // KEYFRAME_INTERVAL > self.last_tick // KEYFRAME_INTERVAL:
+            data = snapshot.encode()
+        else:
+            data = snapshot.encode(baseline)
+
+        if len(self.sent) >= MAX_BASELINES:
+            del self.sent[min(self.sent)]
+        self.sent[snapshot.tick] = snapshot
+        self.last_tick = snapshot.tick
+        return data
+
+
+class DeltaDecoder:
+    """Keeps the snapshots the server may send deltas against."""
+
+    def __init__(self):
+        self.baselines = {}
+        self.last_tick = 0
+
+    def decode(self, data):
+        snapshot = decode(data, self.baselines)
+        _, _, baseline_tick, sections = HEADER.unpack_from(data)
+
+        # The server never goes back to a baseline older than the last one used
+        if not sections & SECTION_KEYFRAME:
+            for tick in [t for t in self.baselines if t < baseline_tick]:
+                del self.baselines[tick]
+        if len(self.baselines) >= MAX_BASELINES:
+            del self.baselines[min(self.baselines)]
+        self.baselines[snapshot.tick] = snapshot
+        self.last_tick = snapshot.tick
+        return snapshot
+
+
+# Slots of the players in the process, freed when they leave. Fresh slots
+# are handed out first and then the ones freed longest ago, so a slot is
+# only reused after every other one has been. Even then an old baseline
+# can't mix up two players: the identity of the new player differs from
+# the one in the baseline, so it's sent in full with the slot.
+MAX_SLOT = 0xFFFF
+_player_slots = {}
+_free_slots = deque()
+_next_slot = 1
+_slots_lock = Lock()
+
+
+def player_slot(player_id):
+    slot = _player_slots.get(player_id)
+    if slot is not None:
+        return slot
+
+    global _next_slot
+    with _slots_lock:
+        slot = _player_slots.get(player_id)
+        if slot is not None:
+            return slot
+        if _next_slot <= MAX_SLOT:
+            slot = _next_slot
+            _next_slot += 1
+        elif _free_slots:
+            slot = _free_slots.popleft()
+        else:
+            raise OverflowError(f"All {MAX_SLOT} player slots are in use")
+        _player_slots[player_id] = slot
+        return slot
+
+
+def release_slot(player_id):
+    with _slots_lock:
+        slot = _player_slots.pop(player_id, None)
+        if slot is not None:
+            _free_slots.append(slot)
+
+
+# Player ids and names only change when players join or leave, so their
+# conversions are cached instead of being redone every tick
+
+@lru_cache(maxsize=1024)
+def id_to_bytes(player_id):
+    return uuid.UUID(player_id).bytes
+
+
+@lru_cache(maxsize=1024)
+def bytes_to_id(id_bytes):
+    return str(uuid.UUID(bytes=id_bytes))
+
+
+@lru_cache(maxsize=1024)
+def encode_name(name):
+    return name.encode()[:255]
+
+
+@lru_cache(maxsize=1024)
+def decode_name(name_bytes):
+    return name_bytes.decode(errors="replace")
@@ -21,6 +21,8 @@ PLAYER_AREA_TL_Y = round((SCREEN_HEIGHT - PLAYER_AREA_HEIGHT) / 2)
 PLAYER_AREA_BR_X = PLAYER_AREA_TL_X + PLAYER_AREA_WIDTH
 PLAYER_AREA_BR_Y = PLAYER_AREA_TL_Y + PLAYER_AREA_HEIGHT
 
+PLAYER_RADIUS = 45
+
 
 class Team(Enum):
     RED = auto()
@@ -45,10 +47,16 @@ class State:
         self.score_red: int = 0
         self.score_blue: int = 0
         self.clock: int = 0 # in seconds
+        self.tick: int = 0
         self.match_manager = MatchManager()
 
 
 class Circle:
+    # Fixed attributes instead of a __dict__ per instance, for the memory:
+    # 120 bytes per Player and 88 per Ball instead of 216. Reads and writes
+    # take about as long and deepcopy is slower (benchmark.py entities).
+    __slots__ = ("x", "y", "vx", "vy", "radius", "mass", "drag_coefficient")
+
     def __init__(
         self,
         x: float = 0,
@@ -67,6 +75,8 @@ class Circle:
 
 
 class Player(Circle):
+    __slots__ = ("name", "team", "kick", "kick_locked")
+
     def __init__(
         self,
         name: str,
@@ -75,7 +85,7 @@ class Player(Circle):
         y: float = 0,
         vx: float = 0,
         vy: float = 0,
-        radius: float = 45,
+        radius: float = PLAYER_RADIUS,
     ) -> None:
         super().__init__(x, y, vx, vy, radius)
         self.name: str = name
@@ -87,6 +97,8 @@ class Player(Circle):
 
 
 class Ball(Circle):
+    __slots__ = ()
+
     def __init__(
         self,
         x: float = 0,
@@ -101,6 +113,8 @@ class Ball(Circle):
 
 
 class Post(Circle):
+    __slots__ = ("team",)
+
     def __init__(
         self, team: Team, x: float = 0, y: float = 0, radius: float = 15
     ) -> None:
@@ -0,0 +1,163 @@
+import select
+import socket
+import snapshot
+import struct
+import time
+from client_loop import receive_bytes
+from collections import deque
+from input import INPUT_REDUNDANCY, KeyChanges, encode_input_packet
+from threading import Event, Thread
+
+
+# Erros de um snapshot que não se consegue descodificar
+DECODE_ERRORS = (snapshot.SnapshotVersionError, KeyError, IndexError, struct.error)
+
+
+class TCPTransport:
+    def __init__(self, client_socket):
+        self.client_socket = client_socket
+        self.decoder = snapshot.DeltaDecoder()
+        self.key_changes = KeyChanges()
+
+    def send_input(self, keys):
+        # Só quando as teclas mudam, ou de vez em quando para confirmar snapshots
+        message = self.key_changes.message(keys, self.decoder.last_tick, time.perf_counter())
+        if message is not None:
+            self.client_socket.sendall(message)
+
+    def receive(self):
+        # Bloqueia até chegar o próximo snapshot
+        return self.decoder.decode(receive_bytes(self.client_socket))
+
+
+class SpectatorTransport(TCPTransport):
+    # Espectadores não enviam input, só recebem snapshots
+    def send_input(self, keys):
+        pass
+
+
+class UDPTransport:
+    def __init__(self, client_socket, player_id, token):
+        # A ligação TCP fica aberta, o servidor usa-a para saber quando saímos
+        self.client_socket = client_socket
+        self.player_id = snapshot.id_to_bytes(player_id)
+        self.token = token
+        self.decoder = snapshot.DeltaDecoder()
+        self.seq = 0
+        self.keys_history = deque(maxlen=INPUT_REDUNDANCY)
+
+        self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_socket.connect(client_socket.getpeername()[:2])
+
+    def send_input(self, keys):
+        # Em UDP o input vai em todos os frames, um pacote perdido é
+        # compensado pelos seguintes
+        self.seq += 1
+        self.keys_history.appendleft(keys)
+        packet = encode_input_packet(self.player_id, self.token, self.seq, self.decoder.last_tick, self.keys_history)
+        try:
+            self.udp_socket.send(packet)
+        except OSError:
+            pass
+
+    def receive(self):
+        while True:
+            # Em UDP não há fim de ligação, é a ligação TCP que diz quando o
+            # servidor saiu
+            readable, _, _ = select.select([self.udp_socket, self.client_socket], [], [])
+            if self.client_socket in readable:
+                # Até ao primeiro input por UDP os snapshots ainda vêm por TCP,
+                # esses são ignorados
+                if not self.client_socket.recv(65536):
+                    raise ConnectionResetError("Server closed the connection")
+            if self.udp_socket not in readable:
+                continue
+
+            try:
+                data = self.udp_socket.recv(65536)
+            except ConnectionRefusedError:
+                # O servidor ainda não recebeu o primeiro input
+                continue
+            last_snapshot = self.receive_snapshot(data)
+            if last_snapshot is not None:
+                return last_snapshot
+
+    def receive_snapshot(self, data):
+        # Snapshots atrasados ou fora de ordem são descartados
+        try:
+            _, tick, _, _ = snapshot.HEADER.unpack_from(data)
+        except struct.error:
+            # Datagrama cortado
+            return None
+        if tick <= self.decoder.last_tick:
+            return None
+        try:
+            return self.decoder.decode(data)
+        except (KeyError, IndexError, struct.error):
+            # Delta contra um snapshot que não temos, ou cortado, esperar
+            # pelo próximo
+            return None
+
+
+class BackgroundTransport:
+    """Corre um transporte em duas threads, uma que recebe e outra que
+    envia, para o ciclo de desenho nunca esperar pela rede.
+
+    Os snapshots descodificados não mudam depois de criados, por isso passam
+    para o ciclo de desenho só como referências numa deque, sem locks nem
+    cópias. Do input só interessa o mais recente: se a rede estiver lenta, o
+    que ainda não foi enviado é substituído.
+    """
+
+    def __init__(self, transport):
+        self.transport = transport
+        # (hora de chegada, snapshot), por ordem de chegada
+        self.received = deque()
+        self.input = None
+        self.input_ready = Event()
+        self.closed = False
+        # Porque é que a ligação acabou, para mostrar ao jogador
+        self.close_reason = None
+
+        Thread(target=self.receive, daemon=True).start()
+        Thread(target=self.send, daemon=True).start()
+
+    def send_input(self, keys):
+        self.input = keys
+        self.input_ready.set()
+
+    def receive_snapshots(self):
+        # Sem bloquear: os snapshots que chegaram desde a última chamada
+        received = []
+        while self.received:
+            received.append(self.received.popleft())
+        return received
+
+    def receive(self):
+        try:
+            while True:
+                last_snapshot = self.transport.receive()
+                self.received.append((time.perf_counter(), last_snapshot))
+        except OSError:
+            self.close("Server closed the connection")
+        except DECODE_ERRORS as e:
+            self.close(f"Invalid snapshot from the server: {e!r}")
+
+    def send(self):
+        try:
+            while True:
+                self.input_ready.wait()
+                self.input_ready.clear()
+                if self.closed:
+                    break
+                if self.input is not None:
+                    self.transport.send_input(self.input)
+        except OSError:
+            self.close("Server closed the connection")
+
+    def close(self, reason):
+        if not self.closed:
+            self.close_reason = reason
+            self.closed = True
+        # Acordar a thread que envia, para também terminar
+        self.input_ready.set()
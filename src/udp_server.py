@@ -0,0 +1,124 @@
+import hmac
+import metrics
+import socket
+import snapshot
+import struct
+import time
+from broadcast import SnapshotQueue
+from input import KEY_KICK, decode_input_packet, keys_to_input
+from threading import Lock, Thread
+
+
+class UDPClient:
+    def __init__(self, room, token):
+        # Where snapshots go, unknown until the first input packet
+        self.address = None
+        self.room = room
+        self.token = token
+        self.delta_encoder = snapshot.DeltaEncoder()
+        self.last_seq = 0
+
+
+class UDPServer:
+    """Optional UDP transport for snapshots and inputs.
+
+    Players still join through the TCP handshake, which gives them a token,
+    then send input packets tagged with their player id and that token to
+    the same port. Snapshots go back as one
+    datagram per tick, numbered by their tick and never retransmitted: a lost
+    snapshot is simply replaced by the next one.
+    """
+
+    def __init__(self, port, rooms):
+        self.rooms = rooms
+        self.clients = {}
+        # The snapshot queue of each room's sending thread
+        self.room_queues = {}
+        self.lock = Lock()
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("0.0.0.0", port))
+
+    def start(self):
+        Thread(target=self.receive_inputs, daemon=True).start()
+        self.rooms.add_room_listener(self.add_room, self.remove_room)
+
+    def add_room(self, room):
+        queue = self.room_queues[room] = SnapshotQueue(1)
+        room.broadcaster.subscribe(queue)
+        Thread(target=self.send_snapshots, args=(room, queue), daemon=True).start()
+
+    def remove_room(self, room):
+        queue = self.room_queues.pop(room, None)
+        if queue is not None:
+            room.broadcaster.unsubscribe(queue)
+            queue.close()
+
+    def register(self, player_id, room, token):
+        with self.lock:
+            self.clients[player_id] = UDPClient(room, token)
+
+    def uses_udp(self, player_id):
+        # Whether the player has sent an input packet, so gets its snapshots here
+        client = self.clients.get(player_id)
+        return client is not None and client.address is not None
+
+    def remove(self, player_id):
+        with self.lock:
+            self.clients.pop(player_id, None)
+
+    def receive_inputs(self):
+        while True:
+            data, address = self.sock.recvfrom(1024)
+            # This thread reads every player's inputs, a truncated packet or
+            # one of another version is dropped without stopping it
+            try:
+                self.receive_input(data, address)
+            except (struct.error, ValueError):
+                continue
+
+    def receive_input(self, data, address):
+        id_bytes, token, seq, ack, keys_history = decode_input_packet(data)
+        if not keys_history:
+            return
+
+        player_id = snapshot.bytes_to_id(id_bytes)
+
+        # Anyone can read a player's id from the snapshots, only packets with
+        # the token of the player's connection count
+        with self.lock:
+            client = self.clients.get(player_id)
+        if client is None or not hmac.compare_digest(token, client.token):
+            return
+
+        # Follow the client if its address changes (NAT rebinding)
+        client.address = address
+
+        # Old or duplicated packet
+        new_inputs = min(seq - client.last_seq, len(keys_history))
+        if new_inputs <= 0:
+            return
+        client.last_seq = seq
+
+        # Movement follows the newest input, but a kick pressed in any of
+        # the inputs we hadn't seen yet still counts
+        keys = keys_history[0]
+        if any(k & KEY_KICK for k in keys_history[:new_inputs]):
+            keys |= KEY_KICK
+
+        client.room.inputs[player_id] = keys_to_input(keys)
+        client.delta_encoder.ack(ack)
+
+    def send_snapshots(self, room, queue):
+        while (last_snapshot := queue.get()) is not None:
+            with self.lock:
+                clients = [client for client in self.clients.values() if client.room is room and client.address is not None]
+            for client in clients:
+                start = time.perf_counter()
+                data = client.delta_encoder.encode(last_snapshot)
+                try:
+                    self.sock.sendto(data, client.address)
+                except OSError:
+                    continue
+                metrics.send_time.record(time.perf_counter() - start)
+                metrics.send_bytes.record(len(data))
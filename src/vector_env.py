@@ -0,0 +1,285 @@
+import numpy as np
+import server_loop as loop
+from input import KEY_DOWN, KEY_KICK, KEY_LEFT, KEY_RIGHT, KEY_UP
+from state import MatchManager, Player, State, Team
+
+
+class VectorEnv:
+    """Many matches of the same size stepped together as one batch.
+
+    Every match is a row of the state arrays, so each step applies the
+    inputs, moves, collides, kicks and checks goals for all of them at once
+    with NumPy, following the same rules as server_loop.simulate.
+
+    Bodies are numbered red players first, then blue players, then the
+    ball. Actions are the keys (input.KEY_*) of every player of every
+    match, an array of shape (num_envs, players). A match ends when its
+    time runs out, overtime included, and starts again from kick off on the
+    same step.
+
+    Unlike server_loop and physics_numpy, which resolve the collisions of a
+    tick one pair after another, here they are all resolved at once from
+    the positions after moving. Results are the same while every circle
+    touches at most one other, and differ slightly when it touches several
+    in the same tick.
+    """
+
+    def __init__(self, num_envs, team_size=2, match_duration=None, tick_rate=loop.TICK_RATE):
+        self.num_envs = num_envs
+        self.team_size = team_size
+        self.players = 2 * team_size
+        self.dt = 1 / tick_rate
+        self.scale = self.dt * loop.BASE_TICK_RATE
+
+        match_manager = MatchManager()
+        self.match_duration = match_duration if match_duration is not None else match_manager.match_duration
+        self.overtime_duration = match_manager.overtime_duration
+
+        # Kick off positions and the constants of every body, from a state
+        # with the same players
+        state = State()
+        for team in [Team.RED, Team.BLUE]:
+            for i in range(team_size):
+                state.players[f"{team}{i}"] = Player(f"{team}{i}", team)
+        loop.reset_ball(state)
+        loop.reset_players(state)
+        circles = list(loop.moving_circles(state))
+
+        self.teams = [player.team for player in state.players.values()]
+        self.start_x = np.array([c.x for c in circles])
+        self.start_y = np.array([c.y for c in circles])
+        self.radius = np.array([c.radius for c in circles])
+        self.mass = np.array([c.mass for c in circles])
+        self.drag = np.array([c.drag_coefficient for c in circles]) ** self.scale
+
+        self.field_coords = state.field_coords
+        self.player_area_coords = state.player_area_coords
+        self.posts = list(state.posts.values())
+        self.goal_top = state.posts["tl"].y
+        self.goal_bottom = state.posts["bl"].y
+        self.goal_left = state.posts["tl"].x
+        self.goal_right = state.posts["tr"].x
+
+        # Every pair of bodies, as the matrices that add up what a pair's
+        # collision does to its first and second body
+        first, second = np.triu_indices(len(circles), 1)
+        self.first = first
+        self.second = second
+        self.to_first = np.zeros((len(first), len(circles)))
+        self.to_first[np.arange(len(first)), first] = 1
+        self.to_second = np.zeros((len(second), len(circles)))
+        self.to_second[np.arange(len(second)), second] = 1
+        self.radius_sum = self.radius[first] + self.radius[second]
+
+        shape = (num_envs, len(circles))
+        self.x = np.zeros(shape)
+        self.y = np.zeros(shape)
+        self.vx = np.zeros(shape)
+        self.vy = np.zeros(shape)
+        self.kick_locked = np.zeros((num_envs, self.players), dtype=bool)
+        self.score_red = np.zeros(num_envs, dtype=np.int64)
+        self.score_blue = np.zeros(num_envs, dtype=np.int64)
+        self.time_remaining = np.zeros(num_envs)
+        self.overtime = np.zeros(num_envs, dtype=bool)
+        self.ticks = np.zeros(num_envs, dtype=np.int64)
+        self.reset()
+
+    def reset(self, envs=None):
+        # Every match, or only the ones selected by an index or mask
+        if envs is None:
+            envs = slice(None)
+        self.kick_off(envs)
+        self.kick_locked[envs] = False
+        self.score_red[envs] = 0
+        self.score_blue[envs] = 0
+        self.time_remaining[envs] = self.match_duration
+        self.overtime[envs] = False
+        self.ticks[envs] = 0
+        return self.observation()
+
+    def kick_off(self, envs):
+        self.x[envs] = self.start_x
+        self.y[envs] = self.start_y
+        self.vx[envs] = 0
+        self.vy[envs] = 0
+
+    def observation(self):
+        """Position and velocity of every body, shape (num_envs, bodies, 4)."""
+        return np.stack([self.x, self.y, self.vx, self.vy], axis=-1)
+
+    def step(self, actions):
+        """Plays one tick of every match.
+
+        Returns the observations, the rewards (goals scored by red minus
+        goals scored by blue this tick), which matches ended, and the scores
+        before the tick, shape (num_envs, 2), which are the final scores of
+        the matches that ended.
+        """
+        actions = np.asarray(actions)
+
+        # Time runs out: a tie goes to overtime, anything else ends the match
+        self.time_remaining -= self.dt
+        ended = self.time_remaining <= 0
+        tied = ended & ~self.overtime & (self.score_red == self.score_blue)
+        self.overtime |= tied
+        self.time_remaining[tied] = self.overtime_duration
+        done = ended & ~tied
+
+        final_scores = np.stack([self.score_red, self.score_blue], axis=-1)
+
+        self.apply_inputs(actions)
+        self.update_positions()
+        self.handle_collisions()
+        self.handle_kicks()
+        rewards = self.check_goals()
+
+        self.ticks += 1
+
+        if done.any():
+            # Finished matches don't play their last tick, like a room going
+            # to its break
+            rewards[done] = 0
+            self.reset(done)
+
+        return self.observation(), rewards, done, final_scores
+
+    def apply_inputs(self, actions):
+        x = ((actions & KEY_RIGHT) != 0).astype(np.float64) - ((actions & KEY_LEFT) != 0)
+        y = ((actions & KEY_DOWN) != 0).astype(np.float64) - ((actions & KEY_UP) != 0)
+        kick = (actions & KEY_KICK) != 0
+
+        magnitude = np.sqrt(x**2 + y**2)
+        moving = magnitude > 0
+        magnitude[~moving] = 1
+        acceleration = np.where(kick, 0.05 * 0.7, 0.05) * self.scale
+
+        vx = self.vx[:, :self.players]
+        vy = self.vy[:, :self.players]
+        vx += acceleration * x / magnitude
+        vy += acceleration * y / magnitude
+
+        # Normalize velocity to ensure norm is 1
+        speed = np.sqrt(vx**2 + vy**2)
+        too_fast = moving & (speed > 1)
+        vx[too_fast] /= speed[too_fast]
+        vy[too_fast] /= speed[too_fast]
+
+        self.kick_locked &= kick
+        self.kicking = kick & ~self.kick_locked
+
+    def update_positions(self):
+        self.x += self.vx * loop.MOVE_SPEED * self.scale
+        self.y += self.vy * loop.MOVE_SPEED * self.scale
+
+        self.vx *= self.drag
+        self.vy *= self.drag
+
+        stopped = self.vx**2 + self.vy**2 < loop.MIN_SPEED_SQR
+        self.vx[stopped] = 0
+        self.vy[stopped] = 0
+
+    def handle_collisions(self):
+        # Every pair of every match at once, from the positions at the start
+        # of the step
+        dx = self.x[:, self.second] - self.x[:, self.first]
+        dy = self.y[:, self.second] - self.y[:, self.first]
+        distance_sqr = dx**2 + dy**2
+        hit = distance_sqr < self.radius_sum**2
+        if hit.any():
+            distance = np.sqrt(distance_sqr)
+            # Prevent division by zero in case of exact overlap
+            distance[distance == 0] = 1e-6
+            nx = np.where(hit, dx / distance, 0)
+            ny = np.where(hit, dy / distance, 0)
+            overlap = 0.5 * (self.radius_sum - distance)
+
+            kx = self.vx[:, self.first] - self.vx[:, self.second]
+            ky = self.vy[:, self.first] - self.vy[:, self.second]
+            p = 2 * (nx * kx + ny * ky) / (self.mass[self.first] + self.mass[self.second])
+
+            self.x += (overlap * nx) @ (self.to_second - self.to_first)
+            self.y += (overlap * ny) @ (self.to_second - self.to_first)
+            self.vx += (p * self.mass[self.first] * nx) @ self.to_second - (p * self.mass[self.second] * nx) @ self.to_first
+            self.vy += (p * self.mass[self.first] * ny) @ self.to_second - (p * self.mass[self.second] * ny) @ self.to_first
+
+        # Ball against the field boundaries, outside the goals
+        x0, y0, x1, y1 = self.field_coords
+        r = self.radius[-1]
+        ball_x = self.x[:, -1]
+        ball_y = self.y[:, -1]
+        outside_goal = (ball_y < self.goal_top) | (ball_y > self.goal_bottom)
+        reflect(self.x[:, -1], self.vx[:, -1], (ball_x < r + x0) & outside_goal, r + x0)
+        reflect(self.x[:, -1], self.vx[:, -1], (ball_x >= x1 - r) & outside_goal, x1 - 1 - r)
+        reflect(self.y[:, -1], self.vy[:, -1], ball_y < r + y0, r + y0)
+        reflect(self.y[:, -1], self.vy[:, -1], ball_y >= y1 - r, y1 - 1 - r)
+
+        # Everything against the player area boundaries
+        x0, y0, x1, y1 = self.player_area_coords
+        r = self.radius
+        reflect(self.x, self.vx, self.x < r + x0, r + x0)
+        reflect(self.x, self.vx, self.x >= x1 - r, x1 - 1 - r)
+        reflect(self.y, self.vy, self.y < r + y0, r + y0)
+        reflect(self.y, self.vy, self.y >= y1 - r, y1 - 1 - r)
+
+        # Posts are far enough apart that a body touches at most one
+        for post in self.posts:
+            dx = post.x - self.x
+            dy = post.y - self.y
+            distance_sqr = dx**2 + dy**2
+            radius_sum = self.radius + post.radius
+            hit = distance_sqr < radius_sum**2
+            if not hit.any():
+                continue
+
+            distance = np.sqrt(distance_sqr[hit])
+            distance[distance == 0] = 1e-6
+            nx = dx[hit] / distance
+            ny = dy[hit] / distance
+            overlap = np.broadcast_to(radius_sum, hit.shape)[hit] - distance
+            self.x[hit] -= overlap * nx
+            self.y[hit] -= overlap * ny
+
+            dp = 2 * (nx * self.vx[hit] + ny * self.vy[hit])
+            self.vx[hit] -= dp * nx
+            self.vy[hit] -= dp * ny
+
+    def handle_kicks(self):
+        if not self.kicking.any():
+            return
+
+        dx = self.x[:, -1:] - self.x[:, :self.players]
+        dy = self.y[:, -1:] - self.y[:, :self.players]
+        distance_sqr = dx**2 + dy**2
+        reach = self.radius[:self.players] + self.radius[-1] + loop.KICK_REACH
+        kicked = self.kicking & (distance_sqr < reach**2)
+        if not kicked.any():
+            return
+
+        # The closer it is, the stronger the kick
+        distance = np.sqrt(distance_sqr)
+        distance[distance == 0] = 1e-6
+        proximity = distance - self.radius[:self.players] - self.radius[-1]
+        kick_force = np.where(kicked, loop.MIN_KICK_FORCE + loop.DELTA_KICK_FORCE * (1 - proximity / loop.KICK_REACH), 0)
+        self.vx[:, -1] += (kick_force * dx / distance).sum(axis=1)
+        self.vy[:, -1] += (kick_force * dy / distance).sum(axis=1)
+        self.kick_locked |= kicked
+
+    def check_goals(self):
+        ball_x = self.x[:, -1]
+        ball_y = self.y[:, -1]
+        in_goal = (self.goal_bottom > ball_y) & (ball_y > self.goal_top)
+        blue = in_goal & (ball_x < self.goal_left)
+        red = in_goal & (ball_x > self.goal_right) & ~blue
+
+        self.score_blue += blue
+        self.score_red += red
+
+        scored = red | blue
+        if scored.any():
+            self.kick_off(scored)
+        return red.astype(np.int64) - blue
+
+
+def reflect(position, velocity, outside, limit):
+    position[outside] = np.broadcast_to(limit, outside.shape)[outside]
+    velocity[outside] *= -1
@@ -0,0 +1,14 @@
+import os
+import sys
+
+# The game's modules are run from src/, not installed
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from benchmark import HOTPATH_THRESHOLD
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup("benchmarks", "hot path benchmarks, as benchmark.py hotpath")
+    group.addoption("--hotpath-output", help="Write the hot path results to this JSON file.")
+    group.addoption("--hotpath-baseline", help="Fail if any hot path result is worse than in this JSON file.")
+    group.addoption("--hotpath-threshold", type=float, default=HOTPATH_THRESHOLD, help=f"How much worse than the baseline counts as a regression (default: {HOTPATH_THRESHOLD}).")
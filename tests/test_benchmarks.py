@@ -0,0 +1,51 @@
+import pytest
+from benchmark import HOTPATH_PLAYERS, HOTPATH_THRESHOLD, hotpath_changes, load_hotpath, run_hotpath, save_hotpath
+
+
+@pytest.fixture(scope="module")
+def hotpath():
+    # Measured once, with the same settings as benchmark.py hotpath
+    return run_hotpath()
+
+
+def test_hotpath_measures_every_player_count(hotpath):
+    for player_count in HOTPATH_PLAYERS:
+        assert hotpath[f"{player_count}p.tick.total.us"] > 0
+        assert hotpath[f"{player_count}p.send.per_client.us"] > 0
+        assert hotpath[f"{player_count}p.serialize.delta.bytes"] < hotpath[f"{player_count}p.serialize.keyframe.bytes"]
+
+
+def test_hotpath_results_round_trip(hotpath, tmp_path, request):
+    path = request.config.getoption("--hotpath-output") or tmp_path / "hotpath.json"
+    save_hotpath(hotpath, path)
+    saved = load_hotpath(path)
+    assert saved == hotpath
+
+
+def test_hotpath_changes_flag_only_regressions_above_the_threshold(hotpath):
+    # A baseline where one result was twice the threshold faster, another
+    # one within it and a third one missing
+    slower, within, new = list(hotpath)[:3]
+    baseline = dict(hotpath)
+    baseline[slower] = hotpath[slower] / (1 + 2 * HOTPATH_THRESHOLD)
+    baseline[within] = hotpath[within] / (1 + HOTPATH_THRESHOLD / 2)
+    del baseline[new]
+
+    changes = {name: (old, change, regressed) for name, old, _, change, regressed in hotpath_changes(hotpath, baseline)}
+    assert [name for name, (_, _, regressed) in changes.items() if regressed] == [slower]
+    assert changes[slower][1] == pytest.approx(2 * HOTPATH_THRESHOLD)
+    assert changes[within][1] == pytest.approx(HOTPATH_THRESHOLD / 2)
+    assert changes[new] == (None, None, False)
+
+
+def test_hotpath_against_baseline(hotpath, request):
+    baseline = request.config.getoption("--hotpath-baseline")
+    if baseline is None:
+        pytest.skip("no --hotpath-baseline given")
+    threshold = request.config.getoption("--hotpath-threshold")
+    regressions = [
+        f"{name}: {old:.1f} -> {value:.1f} ({change:+.0%})"
+        for name, old, value, change, regressed in hotpath_changes(hotpath, load_hotpath(baseline), threshold)
+        if regressed
+    ]
+    assert not regressions, f"More than {threshold:.0%} worse than the baseline:\n" + "\n".join(regressions)
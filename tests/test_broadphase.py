@@ -0,0 +1,51 @@
+import copy
+import math
+import pytest
+import random
+import server_loop
+from state import Player, State, Team
+
+
+def packed_cluster(player_count, spacing, seed):
+    # Players on a grid closer than their diameter, every one overlapping its
+    # neighbours and moving in a random direction
+    rng = random.Random(seed)
+    state = State()
+    side = math.ceil(math.sqrt(player_count))
+    for i in range(player_count):
+        player = Player(f"player{i}", Team.RED, 400 + i % side * spacing + rng.uniform(-3, 3), 300 + i // side * spacing + rng.uniform(-3, 3))
+        angle = rng.uniform(0, 2 * math.pi)
+        player.vx, player.vy = math.cos(angle), math.sin(angle)
+        state.players[player.name] = player
+    state.ball.x = state.ball.y = 400 + side * spacing / 2
+    return state
+
+
+def motion(state):
+    return [(c.x, c.y, c.vx, c.vy) for c in server_loop.moving_circles(state)]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_broadphase_resolves_packed_cluster_like_all_pairs(monkeypatch, seed):
+    all_pairs = packed_cluster(49, 70, seed)
+    broadphase = copy.deepcopy(all_pairs)
+
+    # The pushes of the chain go past the reach, so some ticks are resolved
+    # again with a wider one
+    reaches = []
+    candidate_pairs = server_loop.candidate_pairs
+
+    def recording_reach(circles, reach):
+        reaches.append(reach)
+        return candidate_pairs(circles, reach)
+
+    monkeypatch.setattr(server_loop, "candidate_pairs", recording_reach)
+
+    for _ in range(30):
+        monkeypatch.setattr(server_loop, "BROADPHASE_MIN_CIRCLES", math.inf)
+        server_loop.move(all_pairs, 1)
+        monkeypatch.setattr(server_loop, "BROADPHASE_MIN_CIRCLES", 0)
+        server_loop.move(broadphase, 1)
+        assert motion(broadphase) == motion(all_pairs)
+
+    assert max(reaches) > server_loop.BROADPHASE_REACH
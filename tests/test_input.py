@@ -0,0 +1,110 @@
+import pickle
+import pytest
+import struct
+from input import (
+    INPUT_KEEPALIVE,
+    INPUT_MESSAGE_SIZE,
+    KEY_INPUTS,
+    KEY_KICK,
+    KEY_RIGHT,
+    KEY_UP,
+    MESSAGE_TYPE_SHIFT,
+    Input,
+    InputDecoder,
+    KeyChanges,
+    decode_input_packet,
+    encode_input_packet,
+    encode_keys_message,
+    input_to_keys,
+    keys_to_input,
+)
+
+
+def test_every_combination_of_keys_round_trips():
+    for keys in range(len(KEY_INPUTS)):
+        assert input_to_keys(keys_to_input(keys)) == keys
+
+
+def test_keys_message():
+    decoder = InputDecoder()
+    message = encode_keys_message(KEY_UP | KEY_KICK, 7, 1234)
+    assert len(message) == INPUT_MESSAGE_SIZE
+
+    decoder.decode(message)
+    assert decoder.input is KEY_INPUTS[KEY_UP | KEY_KICK]
+    assert (decoder.seq, decoder.ack) == (7, 1234)
+
+
+def test_decodes_in_place_from_a_reused_buffer():
+    decoder = InputDecoder()
+    buffer = bytearray(INPUT_MESSAGE_SIZE)
+    for keys, ack in [(KEY_RIGHT, 10), (0, 11)]:
+        buffer[:] = encode_keys_message(keys, 1, ack)
+        decoder.decode(buffer)
+        assert decoder.input is KEY_INPUTS[keys]
+        assert decoder.ack == ack
+
+
+@pytest.mark.parametrize("message_type", [0, 2, 7])
+def test_unknown_message_types_are_rejected(message_type):
+    decoder = InputDecoder()
+    decoder.decode(encode_keys_message(KEY_RIGHT, 1, 5))
+
+    message = bytearray(encode_keys_message(KEY_UP, 2, 6))
+    message[0] = message_type << MESSAGE_TYPE_SHIFT | KEY_UP
+    with pytest.raises(ValueError):
+        decoder.decode(message)
+    assert decoder.input is KEY_INPUTS[KEY_RIGHT]
+    assert (decoder.seq, decoder.ack) == (1, 5)
+
+
+def test_pickled_input_from_an_old_client_is_rejected():
+    # Old clients sent a length prefix, then the pickled Input
+    data = pickle.dumps(Input(right=True))
+    message = len(data).to_bytes(4, "big") + data
+    with pytest.raises(ValueError):
+        InputDecoder().decode(message[:INPUT_MESSAGE_SIZE])
+
+
+def test_truncated_message_is_rejected():
+    message = encode_keys_message(KEY_UP, 1, 5)
+    for length in range(1, INPUT_MESSAGE_SIZE):
+        with pytest.raises(struct.error):
+            InputDecoder().decode(message[:length])
+
+
+def test_keys_are_sent_on_change_and_as_keepalive():
+    key_changes = KeyChanges()
+    first = key_changes.message(KEY_RIGHT, 1, 0.0)
+    assert first is not None
+    assert key_changes.message(KEY_RIGHT, 2, INPUT_KEEPALIVE / 2) is None
+
+    # Same change, repeated to ack newer snapshots
+    keepalive = key_changes.message(KEY_RIGHT, 3, INPUT_KEEPALIVE)
+    decoder = InputDecoder()
+    decoder.decode(first)
+    seq = decoder.seq
+    decoder.decode(keepalive)
+    assert (decoder.seq, decoder.ack) == (seq, 3)
+
+    decoder.decode(key_changes.message(0, 4, INPUT_KEEPALIVE))
+    assert decoder.seq == seq + 1
+    assert decoder.input is KEY_INPUTS[0]
+
+
+def test_input_packet_round_trips():
+    player_id, token = bytes(range(16)), bytes(range(16, 32))
+    packet = encode_input_packet(player_id, token, 9, 300, [KEY_UP, KEY_RIGHT])
+    assert decode_input_packet(packet) == (player_id, token, 9, 300, bytes([KEY_UP, KEY_RIGHT]))
+
+
+def test_malformed_input_packets():
+    packet = bytearray(encode_input_packet(bytes(16), bytes(16), 1, 1, [0xFF]))
+    # Bits above the keys are ignored
+    assert keys_to_input(decode_input_packet(packet)[4][0]) is KEY_INPUTS[len(KEY_INPUTS) - 1]
+
+    with pytest.raises(struct.error):
+        decode_input_packet(packet[:10])
+    packet[0] += 1
+    with pytest.raises(ValueError):
+        decode_input_packet(packet)
@@ -0,0 +1,16 @@
+import pytest
+
+pytest.importorskip("numpy")
+
+from benchmark import physics_difference
+
+# Both backends resolve collisions in the same order, only rounding may set
+# them apart
+TOLERANCE = 1e-6
+
+
+# 3 bodies checks every pair, the others go through the broadphase
+@pytest.mark.parametrize("body_count", [3, 10, 50, 200])
+@pytest.mark.parametrize("scale", [1, 0.5])
+def test_numpy_backend_matches_python(body_count, scale):
+    assert physics_difference(body_count, 300, scale) < TOLERANCE
@@ -0,0 +1,241 @@
+import pytest
+import snapshot
+import struct
+import uuid
+from collections import deque
+from state import Player, State, Team
+
+
+def new_player_id():
+    return str(uuid.uuid4())
+
+
+@pytest.fixture
+def slots(monkeypatch):
+    # A slot table of 3 slots, put back as it was afterwards
+    monkeypatch.setattr(snapshot, "MAX_SLOT", 3)
+    monkeypatch.setattr(snapshot, "_player_slots", {})
+    monkeypatch.setattr(snapshot, "_free_slots", deque())
+    monkeypatch.setattr(snapshot, "_next_slot", 1)
+
+
+def test_player_keeps_its_slot(slots):
+    player_id = new_player_id()
+    assert snapshot.player_slot(player_id) == snapshot.player_slot(player_id)
+
+
+def test_freed_slots_are_reused_oldest_first_once_fresh_ones_run_out(slots):
+    first, second, third = new_player_id(), new_player_id(), new_player_id()
+    assert [snapshot.player_slot(p) for p in (first, second, third)] == [1, 2, 3]
+
+    snapshot.release_slot(second)
+    snapshot.release_slot(first)
+    assert snapshot.player_slot(new_player_id()) == 2
+    assert snapshot.player_slot(new_player_id()) == 1
+
+
+def test_running_out_of_slots_raises(slots):
+    for _ in range(3):
+        snapshot.player_slot(new_player_id())
+    with pytest.raises(OverflowError):
+        snapshot.player_slot(new_player_id())
+
+
+def test_reused_slot_against_old_baseline(slots):
+    state = State()
+    leaving = new_player_id()
+    state.players[leaving] = Player("leaving", Team.RED, 100, 200)
+    for _ in range(2):
+        state.players[new_player_id()] = Player("other", Team.BLUE, 300, 200)
+    baseline = snapshot.capture(state)
+
+    # The only free slot goes to the next player, in the same place
+    del state.players[leaving]
+    snapshot.release_slot(leaving)
+    joining = new_player_id()
+    state.players[joining] = Player("joining", Team.BLUE, 100, 200)
+    state.tick = 1
+    current = snapshot.capture(state)
+    assert current.players.keys() == baseline.players.keys()
+
+    baselines = {0: snapshot.decode(baseline.encode(), {})}
+    decoded = snapshot.to_state(snapshot.decode(current.encode(baseline), baselines))
+    assert leaving not in decoded.players
+    assert decoded.players[joining].name == "joining"
+    assert decoded.players[joining].team == Team.BLUE
+
+
+def match_state(player_count=2):
+    # Positions exact in 32 bits, so decoded snapshots compare equal
+    state = State()
+    state.tick = 1
+    state.ball.x, state.ball.y = 640.5, 360.25
+    for i in range(player_count):
+        player_id = str(uuid.UUID(int=i + 1))
+        state.players[player_id] = Player(f"player{i}", Team.RED if i % 2 else Team.BLUE, 100.0 + 50 * i, 200.0)
+    return state
+
+
+def assert_same(decoded, captured):
+    assert decoded.tick == captured.tick
+    assert decoded.match == captured.match
+    assert decoded.ball == captured.ball
+    assert decoded.players == captured.players
+
+
+def is_keyframe(data):
+    return bool(snapshot.HEADER.unpack_from(data)[3] & snapshot.SECTION_KEYFRAME)
+
+
+def baseline_tick(data):
+    return snapshot.HEADER.unpack_from(data)[2]
+
+
+def test_first_snapshot_is_keyframe():
+    state = match_state()
+    encoder, decoder = snapshot.DeltaEncoder(), snapshot.DeltaDecoder()
+    captured = snapshot.capture(state)
+
+    data = encoder.encode(captured)
+    assert is_keyframe(data)
+    assert_same(decoder.decode(data), captured)
+    assert decoder.last_tick == 1
+
+
+def test_snapshots_without_ack_are_keyframes():
+    state = match_state()
+    encoder = snapshot.DeltaEncoder()
+    for tick in range(1, 5):
+        state.tick = tick
+        assert is_keyframe(encoder.encode(snapshot.capture(state)))
+
+
+def test_delta_against_acked_baseline():
+    state = match_state()
+    encoder, decoder = snapshot.DeltaEncoder(), snapshot.DeltaDecoder()
+    keyframe = encoder.encode(snapshot.capture(state))
+    decoder.decode(keyframe)
+    encoder.ack(decoder.last_tick)
+
+    state.tick = 2
+    next(iter(state.players.values())).x += 10
+    captured = snapshot.capture(state)
+    data = encoder.encode(captured)
+    assert not is_keyframe(data)
+    assert baseline_tick(data) == 1
+    assert len(data) < len(keyframe)
+    decoded = decoder.decode(data)
+    assert_same(decoded, captured)
+    assert decoded.baseline_tick == 1
+
+
+def test_unchanged_state_sends_only_header_and_counts():
+    state = match_state()
+    encoder, decoder = snapshot.DeltaEncoder(), snapshot.DeltaDecoder()
+    decoder.decode(encoder.encode(snapshot.capture(state)))
+    encoder.ack(1)
+
+    state.tick = 2
+    data = encoder.encode(snapshot.capture(state))
+    assert len(data) == snapshot.HEADER.size + 2 * snapshot.COUNT.size
+    assert_same(decoder.decode(data), snapshot.capture(state))
+
+
+def test_expired_baseline_sends_keyframe():
+    state = match_state()
+    encoder = snapshot.DeltaEncoder()
+    encoder.encode(snapshot.capture(state))
+    encoder.ack(1)
+
+    # The acked snapshot is pushed out by newer ones that are never acked
+    for tick in range(2, snapshot.MAX_BASELINES + 2):
+        state.tick = tick
+        assert not is_keyframe(encoder.encode(snapshot.capture(state)))
+    state.tick = snapshot.MAX_BASELINES + 2
+    assert is_keyframe(encoder.encode(snapshot.capture(state)))
+
+
+def test_keyframe_every_interval_even_with_acked_baseline():
+    state = match_state()
+    encoder = snapshot.DeltaEncoder()
+    state.tick = snapshot.KEYFRAME_INTERVAL - 1
+    encoder.encode(snapshot.capture(state))
+    encoder.ack(state.tick)
+
+    # Ticks may be skipped, the first one past the interval is the keyframe
+    state.tick = snapshot.KEYFRAME_INTERVAL + 3
+    assert is_keyframe(encoder.encode(snapshot.capture(state)))
+
+
+def test_decoder_rejects_delta_against_missing_baseline():
+    state = match_state()
+    encoder, decoder = snapshot.DeltaEncoder(), snapshot.DeltaDecoder()
+    encoder.encode(snapshot.capture(state))
+    encoder.ack(1)
+
+    # The keyframe was lost on the way
+    state.tick = 2
+    with pytest.raises(KeyError):
+        decoder.decode(encoder.encode(snapshot.capture(state)))
+
+
+def test_decoder_drops_baselines_older_than_the_one_used():
+    state = match_state()
+    encoder, decoder = snapshot.DeltaEncoder(), snapshot.DeltaDecoder()
+    for tick in range(1, 4):
+        state.tick = tick
+        decoder.decode(encoder.encode(snapshot.capture(state)))
+    encoder.ack(2)
+
+    state.tick = 4
+    decoder.decode(encoder.encode(snapshot.capture(state)))
+    assert sorted(decoder.baselines) == [2, 3, 4]
+
+
+def test_players_joining_and_leaving():
+    state = match_state(3)
+    encoder, decoder = snapshot.DeltaEncoder(), snapshot.DeltaDecoder()
+    decoder.decode(encoder.encode(snapshot.capture(state)))
+    encoder.ack(1)
+
+    leaving = next(iter(state.players))
+    del state.players[leaving]
+    snapshot.release_slot(leaving)
+    joining = str(uuid.UUID(int=100))
+    state.players[joining] = Player("joining", Team.BLUE, 300.0, 400.0)
+    state.tick = 2
+    captured = snapshot.capture(state)
+    data = encoder.encode(captured)
+    assert not is_keyframe(data)
+
+    decoded = decoder.decode(data)
+    assert_same(decoded, captured)
+    players = snapshot.to_state(decoded).players
+    assert leaving not in players
+    assert players[joining].name == "joining"
+    assert (players[joining].x, players[joining].y) == (300.0, 400.0)
+
+
+def test_decoder_rejects_other_versions():
+    data = bytearray(snapshot.DeltaEncoder().encode(snapshot.capture(match_state())))
+    data[0] = snapshot.SNAPSHOT_VERSION + 1
+    with pytest.raises(snapshot.SnapshotVersionError):
+        snapshot.DeltaDecoder().decode(bytes(data))
+
+
+@pytest.mark.parametrize("delta", [False, True])
+def test_decoder_rejects_truncated_snapshots(delta):
+    state = match_state()
+    encoder, decoder = snapshot.DeltaEncoder(), snapshot.DeltaDecoder()
+    data = encoder.encode(snapshot.capture(state))
+    if delta:
+        # Only a name changes, the snapshot ends in the middle of it
+        decoder.decode(data)
+        encoder.ack(1)
+        state.tick = 2
+        next(iter(state.players.values())).name = "renamed"
+        data = encoder.encode(snapshot.capture(state))
+
+    for length in range(1, len(data)):
+        with pytest.raises(struct.error):
+            snapshot.decode(data[:length], decoder.baselines)
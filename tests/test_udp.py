@@ -0,0 +1,106 @@
+import pytest
+import random
+import secrets
+import socket
+import time
+import uuid
+from input import INPUT_REDUNDANCY, INPUT_TOKEN_SIZE, KEY_DOWN, KEY_INPUTS, KEY_KICK, KEY_LEFT, KEY_RIGHT, KEY_UP
+from room import Room, RoomManager
+from transport import UDPTransport
+from udp_server import UDPServer
+
+
+class LossyLink:
+    """A player's UDPTransport sending to a real UDPServer through a relay
+    that forwards or drops each datagram, as the test says."""
+
+    def __init__(self):
+        self.room = Room("test")
+        self.server = UDPServer(0, RoomManager(None))
+        self.server.start()
+        self.server_address = ("127.0.0.1", self.server.sock.getsockname()[1])
+
+        self.player_id = str(uuid.uuid4())
+        token = secrets.token_bytes(INPUT_TOKEN_SIZE)
+        self.server.register(self.player_id, self.room, token)
+        self.client = self.server.clients[self.player_id]
+
+        # The transport sends its datagrams to the port of its TCP
+        # connection, where the relay listens
+        self.listener = socket.create_server(("127.0.0.1", 0))
+        self.relay = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.relay.bind(self.listener.getsockname())
+        self.relay.settimeout(1)
+        self.control = socket.create_connection(self.listener.getsockname())
+        self.transport = UDPTransport(self.control, self.player_id, token)
+
+    def send(self, keys, delivered):
+        # Every packet acks a different tick, which tells when the server has
+        # applied it: the ack is the last thing it takes from a packet
+        self.transport.decoder.last_tick = self.transport.seq + 1
+        self.transport.send_input(keys)
+        data = self.relay.recv(1024)
+        if not delivered:
+            return
+
+        self.relay.sendto(data, self.server_address)
+        deadline = time.monotonic() + 1
+        while self.client.delta_encoder.acked_tick != self.transport.seq:
+            assert time.monotonic() < deadline, "The server never applied the input"
+            time.sleep(0.001)
+
+    def input(self):
+        return self.room.inputs.get(self.player_id)
+
+    def close(self):
+        self.server.remove(self.player_id)
+        for sock in (self.transport.udp_socket, self.control, self.relay, self.listener):
+            sock.close()
+
+
+@pytest.fixture
+def link():
+    link = LossyLink()
+    yield link
+    link.close()
+
+
+def test_kick_in_lost_packets_is_recovered(link):
+    link.send(0, True)
+    link.send(KEY_KICK, False)
+    link.send(KEY_RIGHT, False)
+    link.send(KEY_RIGHT, True)
+    assert link.input() is KEY_INPUTS[KEY_RIGHT | KEY_KICK]
+
+    # Counted once, the next packet only has the movement
+    link.send(KEY_RIGHT, True)
+    assert link.input() is KEY_INPUTS[KEY_RIGHT]
+
+
+def test_random_loss_loses_no_input_within_redundancy(link):
+    rng = random.Random(0)
+    directions = [0, KEY_UP, KEY_DOWN, KEY_LEFT, KEY_RIGHT, KEY_UP | KEY_RIGHT]
+    recovered = 0
+    kicked = False
+    lost = 0
+    for n in range(600):
+        keys = rng.choice(directions) | (KEY_KICK if rng.random() < 0.1 else 0)
+        kicked |= bool(keys & KEY_KICK)
+        delivered = n == 0 or rng.random() >= 0.3
+        link.send(keys, delivered)
+        if not delivered:
+            lost += 1
+            continue
+
+        # Movement always follows the newest input. A kick in any of the
+        # lost ones arrives with this packet while they are still in its
+        # history.
+        received = link.input()
+        assert received is KEY_INPUTS[keys] or received is KEY_INPUTS[keys | KEY_KICK]
+        if lost < INPUT_REDUNDANCY:
+            assert received is KEY_INPUTS[keys | (KEY_KICK if kicked else 0)]
+            recovered += lost
+        kicked = False
+        lost = 0
+
+    assert recovered > 100
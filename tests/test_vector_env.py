@@ -0,0 +1,46 @@
+import numpy as np
+import server_loop
+from input import KEY_DOWN, KEY_KICK, KEY_LEFT, KEY_RIGHT, KEY_UP, keys_to_input
+from state import Player, State, Team
+from vector_env import VectorEnv
+
+
+def chase_ball(observation, players):
+    # Every player runs at the ball, holding kick
+    dx = observation[:, -1:, 0] - observation[:, :players, 0]
+    dy = observation[:, -1:, 1] - observation[:, :players, 1]
+    keys = np.where(dx > 5, KEY_RIGHT, 0) | np.where(dx < -5, KEY_LEFT, 0)
+    keys |= np.where(dy > 5, KEY_DOWN, 0) | np.where(dy < -5, KEY_UP, 0)
+    return keys | KEY_KICK
+
+
+def test_steps_like_simulate():
+    # One player a side, so no circle touches two others in the same tick
+    env = VectorEnv(4, team_size=1)
+    states = []
+    for _ in range(env.num_envs):
+        state = State()
+        for team in [Team.RED, Team.BLUE]:
+            state.players[f"{team}0"] = Player(f"{team}0", team)
+        server_loop.reset_ball(state)
+        server_loop.reset_players(state)
+        state.match_manager.start_match()
+        states.append(state)
+
+    rng = np.random.default_rng(0)
+    observation = env.observation()
+    for _ in range(600):
+        # Kick released at random, each match plays differently
+        actions = chase_ball(observation, env.players)
+        actions[rng.random(actions.shape) < 0.5] &= ~KEY_KICK
+        observation, _, _, _ = env.step(actions)
+        for state, keys, bodies in zip(states, actions, observation):
+            inputs = {player_id: keys_to_input(int(k)) for player_id, k in zip(state.players, keys)}
+            server_loop.simulate(state, inputs, env.dt)
+            server_loop.clear_kicks(state)
+
+            circles = [(c.x, c.y, c.vx, c.vy) for c in server_loop.moving_circles(state)]
+            np.testing.assert_allclose(bodies, circles, atol=1e-6)
+
+    # The ball was kicked around, not left at kick off
+    assert (observation[:, -1, 0] != env.start_x[-1]).all()